@@ -1,24 +1,35 @@
 import json
 import time
+import asyncio
 import requests
-import tldextract
-from hashlib import sha256
-from utils import logger, Consts, store_article_in_redis
+import httpx
+import aioredis
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from utils import logger, Consts, store_article_in_redis, store_articles_in_redis, get_shared_lsh, \
+    save_lsh_to_redis, run_lsh_check_document, run_lsh_check_batch, get_article_key
+from lsh_cache_manager import LSHCacheManager
+from latency import timed, log_latency_stats
 import metrics3_docker.metrics as metrics
-from redis_utils import RedisConnectionManager
+from redis_utils import RedisConnectionManager, REDIS_CONFIG
 
 # Instantiate RedisConnectionManager globally to manage connections
 redis_manager = RedisConnectionManager()
+# Keep-alive session for the batch consumer
+http_session = requests.Session()
+# Shared Redis indexes of the embedded dedup mode, created on first use
+embedded_lsh_cache = None
+# Embedded checks of the async consumer run on one thread, like the index writer of the server
+embedded_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="lsh-embedded")
 
 
-def get_tld_from_url(url):
-    ext = tldextract.extract(url)
-    return ext.registered_domain or ext.domain
+def get_distribution_message(document, method="NBDR"):
+    return f"{method} {json.dumps(document, default=lambda obj: getattr(obj, '__dict__', str(obj)))}"
 
 
 def push_to_distribution_queue(document, method="NBDR", queue_name="distribution"):
     try:
-        message = f"{method} {json.dumps(document, default=lambda obj: getattr(obj, '__dict__', str(obj)))}"
+        message = get_distribution_message(document, method)
         redis_connection = redis_manager.get_redis_connection(document.get('index'))
 
         if message and redis_connection:
@@ -32,39 +43,110 @@ def push_to_distribution_queue(document, method="NBDR", queue_name="distribution
         logger.critical(f"Failed to push document to distribution queue: {e}")
 
 
+def push_documents_to_distribution_queue(documents, method="NBDR", queue_name="distribution"):
+    """
+    Push a batch of documents to the distribution queue with one LPUSH per target Redis
+    """
+    messages_by_index = defaultdict(list)
+    for document in documents:
+        messages_by_index[document.get('index')].append(get_distribution_message(document, method))
+
+    for index, messages in messages_by_index.items():
+        try:
+            redis_connection = redis_manager.get_redis_connection(index)
+            if redis_connection:
+                redis_connection.lpush(queue_name, *messages)
+                metric = Consts.TOTAL_DOCUMENTS_DISTRIBUTION
+            else:
+                logger.error("Failed to push documents to distribution queue")
+                metric = Consts.TOTAL_DOCUMENTS_FAILED_DISTRIBUTION
+            for _ in messages:
+                metrics.count(metric)
+        except Exception as e:
+            logger.critical(f"Failed to push documents to distribution queue: {e}")
+
+
+def get_validation_request(body):
+    """
+    Build the DuplicateService request of a document, returning its url and the request data
+    """
+    url = body.get('topicRecord').get('url')
+    article_id, domain = get_article_key(url)
+    data = {
+        "content": body.get('topicRecord').get('topic'),
+        "language": body.get('language'),
+        "domain": domain,
+        "article_id": article_id
+    }
+    return url, data
+
+
+def get_embedded_lsh_cache():
+    global embedded_lsh_cache
+    if embedded_lsh_cache is None:
+        embedded_lsh_cache = LSHCacheManager(loader=get_shared_lsh, saver=save_lsh_to_redis,
+                                             memory_budget_mb=Consts.LSH_MEMORY_BUDGET_MB,
+                                             idle_seconds=Consts.LSH_IDLE_SECONDS)
+    return embedded_lsh_cache
+
+
+def get_duplicate_status(data):
+    """
+    Get the status of a document from the DuplicateService,
+    or from the shared indexes without the HTTP hop in embedded mode
+    """
+    if Consts.DEDUP_MODE == "embedded":
+        return run_lsh_check_document(data, get_embedded_lsh_cache())
+    response = http_session.post(f'http://{Consts.HOST}:9039/is_duplicate', json=data)
+    response.raise_for_status()
+    return response.json().get('status')
+
+
+def get_duplicate_statuses(documents):
+    """
+    Get the statuses of a batch of documents, in order, from the DuplicateService batch endpoint
+    or from the shared indexes in embedded mode
+    """
+    if Consts.DEDUP_MODE == "embedded":
+        return run_lsh_check_batch(documents, get_embedded_lsh_cache())
+    response = http_session.post(f'http://{Consts.HOST}:9039/is_duplicate_batch', json={"documents": documents})
+    response.raise_for_status()
+    return response.json().get('statuses')
+
+
+def apply_validation_status(body, message):
+    """
+    Count the status and mark the document as syndicated,
+    returning the Redis set its url should be stored in (or None)
+    """
+    body['syndicated'] = False
+    if message == Consts.SIMILARITY:
+        metrics.count(Consts.TOTAL_SIMILARITY)
+        body['syndicated'] = True
+        return "similarity"
+    elif message == Consts.DUPLICATE:
+        metrics.count(Consts.TOTAL_DUPLICATE)
+        return "duplicate"
+    elif message == Consts.DUPLICATE_KEYS:
+        metrics.count(Consts.TOTAL_DUPLICATE_KEYS)
+    elif message == Consts.UNIQUE:
+        metrics.count(Consts.TOTAL_UNIQUE)
+        logger.info("Document is not a syndication, sending to DSS")
+    else:
+        metrics.count(Consts.TOTAL_OTHER)
+    return None
+
+
 def validate_document(body):
     """
     Validate the document by sending it to the DuplicateService
     """
     try:
         logger.info("Validating document")
-        url = body.get('topicRecord').get('url')
-        article_id = sha256(url.encode()).hexdigest()
-        data = {
-            "content": body.get('topicRecord').get('topic'),
-            "language": body.get('language'),
-            "domain": get_tld_from_url(url),
-            "article_id": article_id
-        }
-        response = requests.post(f'http://{Consts.HOST}:9039/is_duplicate', json=data)
-        response.raise_for_status()
-
-        message = response.json().get('status')
-        body['syndicated'] = False
-        if message == Consts.SIMILARITY:
-            metrics.count(Consts.TOTAL_SIMILARITY)
-            store_article_in_redis(url)
-            body['syndicated'] = True
-        elif message == Consts.DUPLICATE:
-            metrics.count(Consts.TOTAL_DUPLICATE)
-            store_article_in_redis(url, queue_name="duplicate")
-        elif message == Consts.DUPLICATE_KEYS:
-            metrics.count(Consts.TOTAL_DUPLICATE_KEYS)
-        elif message == Consts.UNIQUE:
-            metrics.count(Consts.TOTAL_UNIQUE)
-            logger.info("Document is not a syndication, sending to DSS")
-        else:
-            metrics.count(Consts.TOTAL_OTHER)
+        url, data = get_validation_request(body)
+        queue_name = apply_validation_status(body, get_duplicate_status(data))
+        if queue_name:
+            store_article_in_redis(url, queue_name=queue_name)
     except requests.RequestException as e:
         metrics.count(Consts.TOTAL_DUPLICATE_REQUESTS_NOT_OK)
         logger.critical(f"Failed to get response from DuplicateService: {e.response.text}")
@@ -78,9 +160,12 @@ def process_document(body):
     Process the document by validating it and pushing it to the distribution queue
     """
     logger.info("Processing document")
-    validate_document(body)
+    with timed("validate_document"):
+        validate_document(body)
     logger.info("Pushing document to distribution queue")
-    push_to_distribution_queue(body)
+    with timed("push_to_distribution_queue"):
+        push_to_distribution_queue(body)
+    log_latency_stats(Consts.LATENCY_LOG_INTERVAL_SECONDS)
 
 
 def start_consumer():
@@ -99,9 +184,180 @@ def start_consumer():
             logger.error(f"Failed to process document: {e}")
 
 
-def main():
+def pop_messages(redis_connection, batch_size):
+    """
+    Pop up to batch_size messages in BRPOP order, blocking only while the queue is empty
+    """
+    pipe = redis_connection.pipeline()
+    pipe.lrange("syndication", -batch_size, -1)
+    pipe.ltrim("syndication", 0, -batch_size - 1)
+    messages, _ = pipe.execute()
+    if messages:
+        return messages[::-1]
+    message = redis_connection.brpop("syndication", timeout=Consts.CONSUMER_POLL_TIMEOUT_SECONDS)
+    return [message[1]] if message else []
+
+
+def validate_documents(bodies):
+    """
+    Validate a batch of documents with one call to the DuplicateService batch endpoint (or the embedded indexes)
+    and store the similar and duplicate urls with one pipeline
+    """
+    requests_data = []
+    for body in bodies:
+        try:
+            requests_data.append((body, *get_validation_request(body)))
+        except Exception as e:
+            metrics.count(Consts.TOTAL_DUPLICATE_REQUESTS_ERROR)
+            logger.critical(f"Failed to validate document: {e}")
+    if not requests_data:
+        return
+
+    try:
+        logger.info(f"Validating {len(requests_data)} documents")
+        statuses = get_duplicate_statuses([data for _, _, data in requests_data])
+
+        urls_by_queue = defaultdict(list)
+        for (body, url, _), message in zip(requests_data, statuses):
+            queue_name = apply_validation_status(body, message)
+            if queue_name:
+                urls_by_queue[queue_name].append(url)
+        store_articles_in_redis(urls_by_queue)
+    except requests.RequestException as e:
+        metrics.count(Consts.TOTAL_DUPLICATE_REQUESTS_NOT_OK)
+        logger.critical(f"Failed to get response from DuplicateService: {e}")
+    except Exception as e:
+        metrics.count(Consts.TOTAL_DUPLICATE_REQUESTS_ERROR)
+        logger.critical(f"Failed to validate documents: {e}")
+
+
+def start_batch_consumer(batch_size=Consts.CONSUMER_BATCH_SIZE):
+    logger.info(f"Starting batch consumer with up to {batch_size} documents per cycle...")
+    redis_connection = redis_manager.get_redis_connection("syndication")
+
+    while True:
+        try:
+            bodies = []
+            for message in pop_messages(redis_connection, batch_size):
+                try:
+                    bodies.append(json.loads(message))
+                except Exception as e:
+                    metrics.count(Consts.TOTAL_FAILED_PROCESS_DOCUMENT)
+                    logger.error(f"Failed to process document: {e}")
+            if bodies:
+                with timed("validate_documents"):
+                    validate_documents(bodies)
+                with timed("push_documents_to_distribution_queue"):
+                    push_documents_to_distribution_queue(bodies)
+                log_latency_stats(Consts.LATENCY_LOG_INTERVAL_SECONDS)
+        except Exception as e:
+            metrics.count(Consts.TOTAL_FAILED_PROCESS_DOCUMENT)
+            logger.error(f"Failed to process documents: {e}")
+
+
+async def validate_document_async(body, http_client, results_redis):
+    """
+    Validate the document with the DuplicateService over the shared keep-alive HTTP client,
+    or on the embedded index thread in embedded mode
+    """
     try:
+        with timed("validate_document"):
+            url, data = get_validation_request(body)
+            if Consts.DEDUP_MODE == "embedded":
+                status = await asyncio.get_running_loop().run_in_executor(embedded_executor, get_duplicate_status, data)
+            else:
+                response = await http_client.post(f'http://{Consts.HOST}:9039/is_duplicate', json=data)
+                response.raise_for_status()
+                status = response.json().get('status')
+
+            queue_name = apply_validation_status(body, status)
+            if queue_name:
+                await results_redis.sadd(queue_name, url)
+    except httpx.HTTPError as e:
+        metrics.count(Consts.TOTAL_DUPLICATE_REQUESTS_NOT_OK)
+        logger.critical(f"Failed to get response from DuplicateService: {e}")
+    except Exception as e:
+        metrics.count(Consts.TOTAL_DUPLICATE_REQUESTS_ERROR)
+        logger.critical(f"Failed to validate document: {e}")
+
+
+async def acknowledge_in_order(in_flight, queue_redis, processing_queue):
+    """
+    Push documents to the distribution queue and acknowledge them in the order they were popped,
+    once their validation is done
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        message, body, validation = await in_flight.get()
+        try:
+            await validation
+            # the distribution queue may be a Redis Cluster, which only has a blocking client
+            with timed("push_to_distribution_queue"):
+                await loop.run_in_executor(None, push_to_distribution_queue, body)
+            await queue_redis.lrem(processing_queue, 1, message)
+            log_latency_stats(Consts.LATENCY_LOG_INTERVAL_SECONDS)
+        except Exception as e:
+            logger.error(f"Failed to acknowledge document: {e}")
+        finally:
+            in_flight.task_done()
+
+
+async def requeue_unacknowledged(queue_redis, processing_queue):
+    """
+    Move the messages a previous run popped but did not acknowledge back to the syndication queue
+    """
+    requeued = 0
+    while await queue_redis.rpoplpush(processing_queue, "syndication"):
+        requeued += 1
+    if requeued:
+        logger.info(f"Requeued {requeued} unacknowledged documents")
+
+
+async def start_async_consumer(concurrency=Consts.CONSUMER_CONCURRENCY):
+    """
+    Validate up to `concurrency` documents at once with one pooled HTTP client and async Redis.
+    Popped messages are kept in a per-consumer processing list until they are acknowledged,
+    and acknowledgments follow the pop order.
+    """
+    logger.info(f"Starting async consumer with {concurrency} documents in flight...")
+    syndication = REDIS_CONFIG["syndication"][0]
+    queue_redis = aioredis.Redis(host=syndication["host"], port=syndication["port"], db=syndication.get("db", 0))
+    results_redis = aioredis.Redis(host=Consts.REDIS_HOST, port=Consts.REDIS_PORT, db=Consts.REDIS_DB)
+    processing_queue = f"syndication:processing:{Consts.CONSUMER_ID}"
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    await requeue_unacknowledged(queue_redis, processing_queue)
+    async with httpx.AsyncClient(limits=limits, timeout=Consts.VALIDATION_TIMEOUT_SECONDS) as http_client:
+        in_flight = asyncio.Queue(maxsize=concurrency)
+        ack_task = asyncio.create_task(acknowledge_in_order(in_flight, queue_redis, processing_queue))
+        try:
+            while True:
+                try:
+                    message = await queue_redis.brpoplpush("syndication", processing_queue, timeout=0)
+                    body = json.loads(message)
+                except Exception as e:
+                    metrics.count(Consts.TOTAL_FAILED_PROCESS_DOCUMENT)
+                    logger.error(f"Failed to process document: {e}")
+                    continue
+                validation = asyncio.create_task(validate_document_async(body, http_client, results_redis))
+                # blocks while `concurrency` documents are waiting for their acknowledgment
+                await in_flight.put((message, body, validation))
+        finally:
+            ack_task.cancel()
+
+
+def run_consumer():
+    if Consts.CONSUMER_MODE == "async":
+        asyncio.run(start_async_consumer())
+    elif Consts.CONSUMER_MODE == "batch":
+        start_batch_consumer()
+    else:
         start_consumer()
+
+
+def main():
+    try:
+        run_consumer()
     except Exception as e:
         handle_consumer_exception(e)
 
@@ -113,7 +369,7 @@ def handle_consumer_exception(e):
     while True:
         time.sleep(30)
         try:
-            start_consumer()
+            run_consumer()
             logger.info("Successfully reconnected to Redis.")
             break
         except Exception as e:
@@ -122,5 +378,9 @@ def handle_consumer_exception(e):
 
 
 if __name__ == '__main__':
+    if Consts.DEDUP_MODE == "embedded":
+        if Consts.LSH_STORAGE != "redis":
+            raise ValueError("DEDUP_MODE embedded needs LSH_STORAGE redis, the consumer checks the Redis indexes "
+                             "and would not see the server's")
     logger.info("Starting Redis consumer...")
     main()
@@ -4,6 +4,16 @@ from utils import logger, Consts
 import json
 import metrics3_docker.metrics as metrics
 
+REDIS_CONFIG = {
+    # "mainstream": [{"host": "localhost", "port": 6379, "db": 3}],
+    "syndication": [{"host": "tanya-032", "port": 6379, "db": 0}],
+    "mainstream": [
+        {"host": "redis-news-002", "port": "6379"},
+        {"host": "redis-news-004", "port": "6379"},
+        {"host": "redis-news-005", "port": "6379"}
+    ]
+}
+
 
 class RedisConnectionManager:
     """
@@ -85,13 +95,4 @@ class RedisConnectionManager:
         """
         Retrieves a Redis connection for a specified site type from the configuration.
         """
-        redis_config = {
-            # "mainstream": [{"host": "localhost", "port": 6379, "db": 3}],
-            "syndication": [{"host": "tanya-032", "port": 6379, "db": 0}],
-            "mainstream": [
-                {"host": "redis-news-002", "port": "6379"},
-                {"host": "redis-news-004", "port": "6379"},
-                {"host": "redis-news-005", "port": "6379"}
-            ]
-        }
-        return self.connect_to_redis(redis_config.get(site_type))
+        return self.connect_to_redis(REDIS_CONFIG.get(site_type))
@@ -0,0 +1,261 @@
+import argparse
+import gzip
+import json
+import os
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
+import numpy as np
+from consts import Consts
+from key_codec import is_article_id
+from minhash_kernel import lean_minhashes
+from minhash_lsh_ttl import logger
+from partitioned_lsh import new_memory_lsh
+from snapshot import save_snapshot_file, load_snapshot_file
+from utils import process_batch, check_signature, crawl_time
+
+STATE_FILE = "state.json"
+# Default TTL of the offline index, long enough for a whole corpus to be a single dedup window
+OFFLINE_TTL_HOURS = 24 * 365
+
+
+def open_corpus(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt")
+    return open(path)
+
+
+def read_batches(corpus, skip, batch_size):
+    """
+    :return: generator of lists of (line number, line), after the first skip lines.
+    """
+    batch = []
+    for line_number, line in enumerate(corpus):
+        if line_number < skip:
+            continue
+        batch.append((line_number, line))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def hash_lines(lines):
+    """
+    Parse and hash a batch of corpus lines in a worker process.
+
+    :return: (documents with their line number, error rows of the lines that could not be parsed,
+             process_batch result of the documents).
+    """
+    documents, errors = [], []
+    for line_number, line in lines:
+        try:
+            doc = json.loads(line)
+            if doc.get("article_id") is None or not doc.get("content"):
+                raise ValueError("article_id or content is missing")
+            article_id = str(doc["article_id"])
+            documents.append({"line": line_number, "article_id": doc["article_id"],
+                              "article_domain": doc.get("domain"),
+                              # the index only takes sha256 hex ids, other ids are indexed by their sha256
+                              "index_id": article_id if is_article_id(article_id) else
+                              sha256(article_id.encode()).hexdigest(),
+                              "language": doc.get("language") or "english", "crawled": crawl_time(doc.get("crawled")),
+                              "text": doc["content"]})
+        except (ValueError, AttributeError) as e:
+            errors.append({"line": line_number, "status": None, "error": str(e)})
+    return documents, errors, process_batch(documents) if documents else None
+
+
+class BulkDedupe:
+    """
+    Dedupes a JSONL corpus (documents with the /is_duplicate fields) offline, with one in-memory index per language.
+
+    Batches of lines are parsed and hashed by a process pool while the index checks and inserts the documents of
+    completed batches strictly in arrival order, like the live service would. Every document gets a result row,
+    the /is_duplicate result plus its line and "article_id|domain" key. Documents linked by their matches are
+    grouped into clusters, written once the corpus is done. Ids that are not sha256 hex digests are indexed by
+    their sha256, and the keys of the rows, matches and clusters are mapped back to the ids of the corpus. With a checkpoint directory, the indexes, clusters
+    and the number of processed lines are saved every checkpoint_every documents, and an interrupted run resumes
+    from its last checkpoint.
+    """
+
+    def __init__(self, output_path, checkpoint_dir=None, threshold=0.9, ttl=OFFLINE_TTL_HOURS):
+        self.output_path = output_path
+        self.checkpoint_dir = checkpoint_dir
+        self.threshold = threshold
+        self.ttl = ttl
+        self.indexes = {}
+        # union-find of the keys of clustered documents
+        self.parents = {}
+        # "article_id|domain" of the index keys of documents whose id is not a sha256 hex digest
+        self.names = {}
+        self.statuses = defaultdict(int)
+        self.documents = 0
+        self.checkpointed = 0
+        self.snapshots = {}
+        if not self._resume():
+            self.output = open(output_path, "w")
+
+    def _state_path(self):
+        return os.path.join(self.checkpoint_dir, STATE_FILE)
+
+    def _resume(self):
+        """
+        Load the last checkpoint and truncate the output to the rows written before it.
+
+        :return: True when a checkpoint was found.
+        """
+        if not self.checkpoint_dir or not os.path.exists(self._state_path()):
+            return False
+        with open(self._state_path()) as f:
+            state = json.load(f)
+        self.documents = self.checkpointed = state["documents"]
+        self.parents = state["parents"]
+        self.names = state.get("names", {})
+        self.statuses.update(state["statuses"])
+        self.snapshots = state["snapshots"]
+        for language, name in self.snapshots.items():
+            self.indexes[language] = load_snapshot_file(os.path.join(self.checkpoint_dir, name))
+        os.truncate(self.output_path, state["output_bytes"])
+        self.output = open(self.output_path, "a")
+        logger.info(f"Resumed bulk dedupe after {self.documents} lines.")
+        return True
+
+    def index(self, language):
+        lsh_with_ttl = self.indexes.get(language)
+        if lsh_with_ttl is None:
+            lsh_with_ttl = self.indexes[language] = new_memory_lsh(threshold=self.threshold, ttl=self.ttl)
+        return lsh_with_ttl
+
+    def _name(self, key):
+        return self.names.get(key, key)
+
+    def _root(self, key):
+        parent = self.parents.setdefault(key, key)
+        while parent != key:
+            # path halving
+            self.parents[key] = self.parents[parent]
+            key, parent = parent, self.parents[parent]
+        return key
+
+    def _cluster(self, key, matches):
+        root = self._root(matches[0])
+        for match in matches[1:] + [key]:
+            match_root = self._root(match)
+            if match_root != root:
+                self.parents[match_root] = root
+
+    def check_batch(self, documents, errors, hashed):
+        """
+        Check and insert the documents of a hashed batch in line order and write their result rows.
+        """
+        rows = list(errors)
+        minhashes = lean_minhashes(hashed["signatures"].astype(np.uint64)) if documents else []
+        fingerprints = hashed["fingerprints"] if documents else None
+        for i, (doc, minhash) in enumerate(zip(documents, minhashes)):
+            lsh_with_ttl = self.index(doc["language"])
+            key = lsh_with_ttl.key_codec.format_key(lsh_with_ttl.key_codec.encode(doc["index_id"],
+                                                                                  doc["article_domain"]))
+            if doc["index_id"] != doc["article_id"]:
+                self.names[key] = f"{doc['article_id']}|{doc['article_domain']}"
+            result = check_signature(lsh_with_ttl, minhash, doc["article_domain"], doc["index_id"],
+                                     fingerprint=None if fingerprints is None else fingerprints[i])
+            if result.get("matches"):
+                self._cluster(key, result["matches"])
+                result["matches"] = [self._name(match) for match in result["matches"]]
+            self.statuses[result["status"]] += 1
+            rows.append({"line": doc["line"], "article_id": doc["article_id"], "domain": doc["article_domain"],
+                         "key": self._name(key), **result})
+        rows.sort(key=lambda row: row["line"])
+        for row in rows:
+            self.output.write(json.dumps(row) + "\n")
+        self.documents = rows[-1]["line"] + 1
+
+    def checkpoint(self):
+        """
+        Save every index under a new name, then the state pointing to them, and only then delete the previous
+        snapshots, so a crash at any point leaves a consistent checkpoint.
+        """
+        if not self.checkpoint_dir:
+            return
+        start_time = time.time()
+        self.output.flush()
+        os.fsync(self.output.fileno())
+        snapshots = {}
+        for language, lsh_with_ttl in self.indexes.items():
+            snapshots[language] = f"{language}-{self.documents}.lshsnap"
+            save_snapshot_file(lsh_with_ttl, os.path.join(self.checkpoint_dir, snapshots[language]))
+        state = {"documents": self.documents, "output_bytes": self.output.tell(), "snapshots": snapshots,
+                 "statuses": self.statuses, "parents": self.parents, "names": self.names}
+        with open(f"{self._state_path()}.tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(f"{self._state_path()}.tmp", self._state_path())
+        for name in set(self.snapshots.values()) - set(snapshots.values()):
+            os.remove(os.path.join(self.checkpoint_dir, name))
+        self.snapshots = snapshots
+        self.checkpointed = self.documents
+        logger.info(f"Checkpointed bulk dedupe after {self.documents} lines in {time.time() - start_time:.3f} "
+                    f"seconds: {dict(self.statuses)}")
+
+    def write_clusters(self, path):
+        """
+        Write every cluster of at least two documents as a JSONL row of its root key, size and member keys.
+
+        :return: Number of clusters.
+        """
+        clusters = defaultdict(list)
+        for key in list(self.parents):
+            clusters[self._root(key)].append(key)
+        clusters = [(root, members) for root, members in clusters.items() if len(members) > 1]
+        with open(path, "w") as f:
+            for root, members in clusters:
+                f.write(json.dumps({"cluster": self._name(root), "size": len(members),
+                                    "members": [self._name(member) for member in members]}) + "\n")
+        return len(clusters)
+
+    def run(self, corpus_path, workers, batch_size, max_in_flight, checkpoint_every):
+        """
+        Stream the corpus through the hashing pool and the indexes, keeping at most max_in_flight batches hashed
+        ahead of the index.
+        """
+        start_time = time.time()
+        with open_corpus(corpus_path) as corpus, ProcessPoolExecutor(max_workers=workers) as executor:
+            batches = read_batches(corpus, self.documents, batch_size)
+            pending = deque()
+            while True:
+                while len(pending) < max_in_flight and (lines := next(batches, None)) is not None:
+                    pending.append(executor.submit(hash_lines, lines))
+                if not pending:
+                    break
+                self.check_batch(*pending.popleft().result())
+                if self.documents - self.checkpointed >= checkpoint_every:
+                    self.checkpoint()
+        self.checkpoint()
+        self.output.close()
+        logger.info(f"Deduped {self.documents} lines in {time.time() - start_time:.3f} seconds: "
+                    f"{dict(self.statuses)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Dedupe a JSONL corpus (gzipped when it ends with .gz) offline, "
+                                                 "one document with the /is_duplicate fields per line.")
+    parser.add_argument('corpus', help="JSONL corpus with article_id, domain, content, language and crawled")
+    parser.add_argument('--output', default="dedupe_results.jsonl", help="result of every document, in line order")
+    parser.add_argument('--clusters', default="dedupe_clusters.jsonl", help="documents linked by their matches")
+    parser.add_argument('--checkpoint-dir', help="directory of the checkpoints, to resume an interrupted run")
+    parser.add_argument('--checkpoint-every', type=int, default=100000, help="documents between checkpoints")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="hashing processes")
+    parser.add_argument('--batch-size', type=int, default=Consts.RECOVERY_BATCH_SIZE)
+    parser.add_argument('--max-in-flight', type=int, default=Consts.RECOVERY_MAX_IN_FLIGHT)
+    parser.add_argument('--threshold', type=float, default=0.9, help="Jaccard threshold of the LSH")
+    parser.add_argument('--ttl-hours', type=float, default=OFFLINE_TTL_HOURS,
+                        help="lifetime of indexed documents from their insertion, the whole run by default")
+    args = parser.parse_args()
+
+    if args.checkpoint_dir:
+        os.makedirs(args.checkpoint_dir, exist_ok=True)
+    dedupe = BulkDedupe(args.output, args.checkpoint_dir, args.threshold, args.ttl_hours)
+    dedupe.run(args.corpus, args.workers, args.batch_size, max(args.max_in_flight, args.workers), args.checkpoint_every)
+    logger.info(f"Wrote {dedupe.write_clusters(args.clusters)} clusters to {args.clusters}.")
@@ -0,0 +1,211 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import time
+from array import array
+from collections import defaultdict
+from datetime import datetime
+from itertools import islice
+import numpy as np
+from consts import Consts
+from minhash_lsh_ttl import MinHashLSHTTL
+from partitioned_lsh import PartitionedMinHashLSHTTL, new_memory_lsh
+from utils import preprocess_and_tokenize, minhash_signature, minhash_signatures, run_lsh_check
+from synthetic_corpus import add_corpus_arguments, corpus_from_arguments
+
+EXPECTED_STATUSES = {"original": Consts.UNIQUE, "syndication": Consts.SIMILARITY,
+                     "near_duplicate": Consts.DUPLICATE}
+# Index layouts whose expiry is measured: whole partitions (LSH_PARTITION_HOURS > 0, 1 hour when it is 0)
+# or key by key (LSH_PARTITION_HOURS=0)
+EXPIRY_LAYOUTS = {
+    "partitioned": lambda: PartitionedMinHashLSHTTL(threshold=0.9, num_perm=128, ttl=24,
+                                                    partition_hours=Consts.LSH_PARTITION_HOURS or 1),
+    "per_key": lambda: MinHashLSHTTL(threshold=0.9, num_perm=128, ttl=24),
+}
+
+
+def stage_result(size, stage, durations, seconds=None, operations=None):
+    """
+    Throughput and latency percentiles of a stage from its per-operation durations in seconds.
+    Stages measured as a whole pass seconds and operations instead.
+    """
+    result = {"size": size, "stage": stage}
+    if durations is not None and len(durations):
+        durations_ms = np.frombuffer(durations, dtype=np.float64) * 1000
+        seconds, operations = durations_ms.sum() / 1000, len(durations_ms)
+        p50, p90, p99 = np.percentile(durations_ms, [50, 90, 99])
+        result.update(mean_ms=round(float(durations_ms.mean()), 4), p50_ms=round(float(p50), 4),
+                      p90_ms=round(float(p90), 4), p99_ms=round(float(p99), 4),
+                      max_ms=round(float(durations_ms.max()), 4))
+    result.update(operations=operations, seconds=round(seconds, 4),
+                  ops_per_sec=round(operations / seconds, 1) if seconds else None)
+    return result
+
+
+def current_rss_mb():
+    # ru_maxrss only ever grows, the current resident size tells what the index holds
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def time_each(func, items):
+    durations = array('d')
+    for item in items:
+        start_time = time.perf_counter()
+        func(item)
+        durations.append(time.perf_counter() - start_time)
+    return durations
+
+
+def build_index(lsh_with_ttl, documents, chunk_size):
+    """
+    Hash the documents chunk by chunk and insert them, returning the insert durations and the build time.
+    """
+    insert_durations = array('d')
+    start_time = time.perf_counter()
+    while chunk := list(islice(documents, chunk_size)):
+        minhashes = minhash_signatures([(doc['content'], doc['language']) for doc in chunk])
+        for doc, minhash in zip(chunk, minhashes):
+            key = lsh_with_ttl.key_codec.encode(doc['article_id'], doc['domain'])
+            insert_start = time.perf_counter()
+            lsh_with_ttl.insert(key, minhash)
+            insert_durations.append(time.perf_counter() - insert_start)
+    return insert_durations, time.perf_counter() - start_time
+
+
+def expire_oldest(lsh_with_ttl, count):
+    """
+    Move the expiration of at least count of the oldest keys to the past, whole partitions for a partitioned index.
+
+    :return: Number of expired keys.
+    """
+    if isinstance(lsh_with_ttl, PartitionedMinHashLSHTTL):
+        expired = 0
+        for end_time in sorted(lsh_with_ttl.partitions):
+            if expired >= count:
+                break
+            partition = lsh_with_ttl.partitions.pop(end_time)
+            partition.end_time = float(expired)
+            lsh_with_ttl.partitions[partition.end_time] = partition
+            expired += partition.size()
+        return expired
+    # a sorted list is a valid heap, and moving its head to the past keeps it sorted
+    heap = sorted(lsh_with_ttl.expiration_heap)
+    heap[:count] = [(datetime.min, key) for _, key in heap[:count]]
+    lsh_with_ttl.expiration_heap = heap
+    return count
+
+
+def benchmark_cleanup(size, layout, lsh_with_ttl, count):
+    """
+    Expire at least count of the oldest keys and time cleanup_expired_keys, as the stage of the layout.
+    """
+    expired = expire_oldest(lsh_with_ttl, count)
+    start_time = time.perf_counter()
+    lsh_with_ttl.cleanup_expired_keys()
+    return stage_result(size, f"cleanup_expired_keys_{layout}", None, seconds=time.perf_counter() - start_time,
+                        operations=expired)
+
+
+def benchmark_size(args, size):
+    """
+    Index `size` synthetic documents, then measure every stage on `args.probes` further documents.
+    Expiry is measured for both EXPIRY_LAYOUTS, the one LSH_PARTITION_HOURS does not select on an index
+    of its own built from the same documents.
+    """
+    corpus = corpus_from_arguments(args)
+    lsh_with_ttl = new_memory_lsh()
+    print(f"Indexing {size} documents...")
+    rss_before_build = current_rss_mb()
+    insert_durations, build_seconds = build_index(lsh_with_ttl, corpus.documents(size), args.chunk_size)
+    index_rss_mb = current_rss_mb() - rss_before_build
+    results = [stage_result(size, "index_build", None, seconds=build_seconds, operations=size),
+               stage_result(size, "lsh_insert", insert_durations)]
+
+    probes = list(corpus.documents(args.probes))
+    results.append(stage_result(size, "preprocess_and_tokenize", time_each(
+        lambda doc: preprocess_and_tokenize(doc['content'], doc['language']), probes)))
+    minhashes = []
+    results.append(stage_result(size, "minhash_signature", time_each(
+        lambda doc: minhashes.append(minhash_signature(doc['content'], doc['language'])), probes)))
+    results.append(stage_result(size, "lsh_query", time_each(lsh_with_ttl.query, minhashes)))
+
+    statuses = defaultdict(lambda: defaultdict(int))
+
+    def check(doc):
+        status = run_lsh_check(content=doc['content'], language=doc['language'], article_domain=doc['domain'],
+                               article_id=doc['article_id'], lsh_cache=lsh_with_ttl)
+        statuses[doc['kind']][status] += 1
+    results.append(stage_result(size, "run_lsh_check", time_each(check, probes)))
+
+    estimated_bytes = lsh_with_ttl.estimated_bytes()
+    count = min(args.probes, lsh_with_ttl.size())
+    configured = "partitioned" if isinstance(lsh_with_ttl, PartitionedMinHashLSHTTL) else "per_key"
+    results.append(benchmark_cleanup(size, configured, lsh_with_ttl, count))
+
+    accuracy = {kind: round(counts[EXPECTED_STATUSES[kind]] / sum(counts.values()), 4)
+                for kind, counts in statuses.items()}
+    summary = {"size": size, "estimated_bytes": estimated_bytes, "index_rss_mb": round(index_rss_mb),
+               "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024),
+               "statuses": {kind: dict(counts) for kind, counts in statuses.items()}, "accuracy": accuracy}
+
+    del lsh_with_ttl
+    for layout, new_lsh in EXPIRY_LAYOUTS.items():
+        if layout != configured:
+            print(f"Indexing {size} documents for {layout} expiry...")
+            other_lsh = new_lsh()
+            build_index(other_lsh, corpus_from_arguments(args).documents(size), args.chunk_size)
+            results.append(benchmark_cleanup(size, layout, other_lsh, count))
+    return results, summary
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the dedup engine on a synthetic corpus, without "
+                                                 "Elasticsearch or Redis.")
+    parser.add_argument('--sizes', default="10000,100000",
+                        help="comma separated index sizes, e.g. 10000,100000,1000000,5000000")
+    parser.add_argument('--probes', type=int, default=2000, help="documents measured per stage and size")
+    parser.add_argument('--chunk-size', type=int, default=1000, help="documents hashed per batch while indexing")
+    parser.add_argument('--output', default="benchmark_results.json")
+    add_corpus_arguments(parser)
+    args = parser.parse_args()
+
+    report = {
+        "started_at": datetime.now().isoformat(),
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "parameters": vars(args),
+        "results": [],
+        "summaries": [],
+    }
+    for size in map(int, args.sizes.split(",")):
+        results, summary = benchmark_size(args, size)
+        report["results"].extend(results)
+        report["summaries"].append(summary)
+        for result in results:
+            print(f"{size:>9} {result['stage']:<32} {result['ops_per_sec'] or 0:>12.1f} ops/sec"
+                  + (f"  p50 {result['p50_ms']:.3f}ms  p99 {result['p99_ms']:.3f}ms" if "p50_ms" in result else ""))
+        print(f"{size:>9} accuracy {summary['accuracy']}, estimated {summary['estimated_bytes'] / 1024 / 1024:.1f}MB, "
+              f"index RSS {summary['index_rss_mb']}MB")
+        # written after every size so long runs keep their finished sizes
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
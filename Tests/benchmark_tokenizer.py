@@ -0,0 +1,60 @@
+import argparse
+import json
+import time
+import utils  # sets up the NLTK data path
+from tokenizer import get_tokenizer
+
+SAMPLE_TEXTS = [
+    "Good muffins cost $3.88 (roughly 3,36 euros)\nin New York.  Please buy me\ntwo of them.\nThanks.",
+    "He said “we cannot wait” — and they’re gonna vote on it… tomorrow.",
+    "U.S. stocks rose 2.5% on Monday, led by tech shares; the S&P 500 closed at a record.",
+    "«Bonjour» — l’économie française ‘va bien’, a-t-il déclaré. Gimme, lemme, gotta, wanna go.",
+    "Breaking: Officials confirmed the news at 10:30 a.m. (local time) – see https://example.com/a?b=c#d",
+]
+
+
+def load_corpus(path, limit):
+    if not path:
+        return SAMPLE_TEXTS
+    texts = []
+    with open(path) as f:
+        for line in f:
+            doc = json.loads(line)
+            text = doc.get('text') or doc.get('content')
+            if text:
+                texts.append(text)
+            if limit and len(texts) >= limit:
+                break
+    return texts
+
+
+def time_engine(engine, texts, language):
+    tokenizer = get_tokenizer(language, engine=engine, shingle_size=1)
+    start_time = time.perf_counter()
+    outputs = [tokenizer.tokenize(text) for text in texts]
+    return outputs, time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the fast tokenizer with the NLTK reference tokenizer.")
+    parser.add_argument('--corpus', help="JSONL file with a 'text' or 'content' field per line")
+    parser.add_argument('--language', default='english')
+    parser.add_argument('--limit', type=int, default=0)
+    args = parser.parse_args()
+
+    texts = load_corpus(args.corpus, args.limit)
+    reference, reference_time = time_engine("nltk", texts, args.language)
+    fast, fast_time = time_engine("fast", texts, args.language)
+
+    mismatches = [i for i, (expected, actual) in enumerate(zip(reference, fast)) if expected != actual]
+    for i in mismatches[:10]:
+        print(f"Mismatch in document {i}:\n  nltk: {reference[i]}\n  fast: {fast[i]}")
+
+    print(f"Documents: {len(texts)}, mismatches: {len(mismatches)}")
+    print(f"nltk: {reference_time:.4f} seconds ({len(texts) / reference_time:.0f} docs/sec)")
+    print(f"fast: {fast_time:.4f} seconds ({len(texts) / fast_time:.0f} docs/sec)")
+    print(f"Speedup: {reference_time / fast_time:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
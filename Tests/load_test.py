@@ -0,0 +1,227 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+from collections import Counter, defaultdict
+from hashlib import sha256
+import httpx
+import numpy as np
+from synthetic_corpus import add_corpus_arguments, corpus_from_arguments
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server.py")
+
+
+class LoadTest:
+    """
+    Drives /is_duplicate with a closed loop of `concurrency` clients, or an open loop at `rps` requests
+    per second where latency is measured from the scheduled send time. Every request is recorded in the
+    phase it started in: "serving", then "recovery" and "after_recovery" when a recovery is triggered.
+    """
+
+    def __init__(self, url, documents, read_ratio=0.0, seed=1):
+        self.url = url.rstrip("/")
+        self.documents = itertools.cycle(documents)
+        self.cycle_length = len(documents)
+        self.read_ratio = read_ratio
+        self.random = random.Random(seed)
+        self.phase = "serving"
+        self.sent = 0
+        # phase -> list of (latency_ms, error, status, kind, operation)
+        self.records = defaultdict(list)
+
+    def next_request(self):
+        document = dict(next(self.documents))
+        self.sent += 1
+        if self.sent > self.cycle_length:
+            # replayed documents get a new id so they are checked again rather than rejected as duplicate keys
+            document["article_id"] = sha256(f"{document['article_id']}-{self.sent // self.cycle_length}"
+                                            .encode()).hexdigest()
+        operation = "read" if self.random.random() < self.read_ratio else "insert"
+        document["insert"] = operation == "insert"
+        return document, operation
+
+    async def send(self, client, scheduled_time=None):
+        document, operation = self.next_request()
+        phase = self.phase
+        start_time = scheduled_time or time.perf_counter()
+        error, status = None, None
+        try:
+            response = await client.post(f"{self.url}/is_duplicate", json={
+                key: document.get(key) for key in ("content", "language", "domain", "article_id", "insert")})
+            if response.status_code == 200:
+                status = response.json().get("status")
+            else:
+                error = f"HTTP {response.status_code}"
+        except httpx.HTTPError as e:
+            error = type(e).__name__
+        latency_ms = (time.perf_counter() - start_time) * 1000
+        self.records[phase].append((latency_ms, error, status, document.get("kind"), operation))
+
+    async def run_closed_loop(self, client, concurrency, deadline):
+        async def worker():
+            while time.perf_counter() < deadline:
+                await self.send(client)
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+
+    async def run_open_loop(self, client, rps, deadline, max_in_flight):
+        in_flight = set()
+        start_time = time.perf_counter()
+        for i in itertools.count():
+            scheduled_time = start_time + i / rps
+            if scheduled_time >= deadline:
+                break
+            await asyncio.sleep(max(0.0, scheduled_time - time.perf_counter()))
+            if len(in_flight) >= max_in_flight:
+                # the server can't keep up, count the request as dropped
+                self.records[self.phase].append((None, "dropped", None, None, None))
+                continue
+            task = asyncio.create_task(self.send(client, scheduled_time))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+        if in_flight:
+            await asyncio.wait(in_flight)
+
+    async def trigger_recovery(self, client, delay, language):
+        """
+        Start a recovery after `delay` seconds and follow it through /stats.
+        """
+        await asyncio.sleep(delay)
+        response = await client.post(f"{self.url}/recover", json={"language": language})
+        response.raise_for_status()
+        self.phase = "recovery"
+        print(f"Recovery of {language} started")
+        while True:
+            await asyncio.sleep(1)
+            stats = (await client.get(f"{self.url}/stats")).json()
+            if language not in stats.get("recovering", []):
+                break
+        self.phase = "after_recovery"
+        print(f"Recovery finished: {stats.get('last_recovery')}")
+
+    def report(self, duration):
+        report = {}
+        for phase, records in self.records.items():
+            latencies = np.array([record[0] for record in records if record[1] is None])
+            errors = Counter(record[1] for record in records if record[1] is not None)
+            statuses = defaultdict(Counter)
+            for _, error, status, kind, operation in records:
+                if error is None:
+                    statuses[f"{operation}:{kind}" if kind else operation][str(status)] += 1
+            report[phase] = {
+                "requests": len(records),
+                "error_rate": round(sum(errors.values()) / len(records), 4) if records else 0,
+                "errors": dict(errors),
+                "p50_ms": round(float(np.percentile(latencies, 50)), 3) if len(latencies) else None,
+                "p95_ms": round(float(np.percentile(latencies, 95)), 3) if len(latencies) else None,
+                "p99_ms": round(float(np.percentile(latencies, 99)), 3) if len(latencies) else None,
+                "max_ms": round(float(latencies.max()), 3) if len(latencies) else None,
+                "statuses": {key: dict(counter) for key, counter in statuses.items()},
+            }
+        total = sum(len(records) for records in self.records.values())
+        report["achieved_rps"] = round(total / duration, 1)
+        return report
+
+
+def load_documents(args):
+    if args.corpus:
+        with open(args.corpus) as f:
+            documents = [json.loads(line) for line in f]
+        for document in documents:
+            document.setdefault("content", document.get("text"))
+            document.setdefault("language", "english")
+        return documents
+    return list(corpus_from_arguments(args).documents(args.documents))
+
+
+def start_server(url, timeout, recover):
+    """
+    Start server.py with the current environment, /recover enabled when recover is True,
+    and wait until it answers /health_check.
+    """
+    env = dict(os.environ, RECOVER_ENDPOINT="true") if recover else None
+    process = subprocess.Popen([sys.executable, SERVER_PATH], cwd=os.path.dirname(SERVER_PATH), env=env)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            if httpx.get(f"{url}/health_check", timeout=1).status_code == 200:
+                return process
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError(f"Server did not start within {timeout} seconds")
+
+
+async def run(args, documents):
+    load_test = LoadTest(args.url, documents, read_ratio=args.read_ratio, seed=args.seed)
+    connections = args.concurrency or args.max_in_flight
+    limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+    async with httpx.AsyncClient(limits=limits, timeout=args.timeout) as client:
+        if args.warmup:
+            await asyncio.gather(*[load_test.send(client) for _ in range(args.warmup)])
+            load_test.records.clear()
+
+        start_time = time.perf_counter()
+        deadline = start_time + args.duration
+        tasks = []
+        if args.recover_after is not None:
+            tasks.append(load_test.trigger_recovery(client, args.recover_after, args.recover_language))
+        if args.rps:
+            tasks.append(load_test.run_open_loop(client, args.rps, deadline, args.max_in_flight))
+        else:
+            tasks.append(load_test.run_closed_loop(client, args.concurrency, deadline))
+        await asyncio.gather(*tasks)
+        return load_test.report(time.perf_counter() - start_time)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test /is_duplicate at a target RPS or concurrency.")
+    parser.add_argument('--url', default="http://localhost:9039")
+    parser.add_argument('--start-server', action='store_true', help="start server.py locally for the test")
+    parser.add_argument('--startup-timeout', type=int, default=600)
+    parser.add_argument('--corpus', help="JSONL corpus with the /is_duplicate fields, synthetic when not given")
+    parser.add_argument('--documents', type=int, default=20000, help="size of the synthetic corpus")
+    parser.add_argument('--rps', type=float, help="open loop at this many requests per second")
+    parser.add_argument('--concurrency', type=int, default=16, help="closed loop clients when --rps is not set")
+    parser.add_argument('--max-in-flight', type=int, default=1000, help="open loop requests in flight before dropping")
+    parser.add_argument('--duration', type=float, default=60)
+    parser.add_argument('--warmup', type=int, default=0, help="requests sent before measuring")
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--read-ratio', type=float, default=0.0, help="share of requests that only query the index")
+    parser.add_argument('--recover-after', type=float, help="trigger /recover this many seconds into the test")
+    parser.add_argument('--recover-language', default="english")
+    parser.add_argument('--output', help="write the report as JSON")
+    add_corpus_arguments(parser)
+    args = parser.parse_args()
+    if args.rps:
+        args.concurrency = None
+
+    documents = load_documents(args)
+    server = start_server(args.url, args.startup_timeout, args.recover_after is not None) if args.start_server else None
+    try:
+        report = asyncio.run(run(args, documents))
+    finally:
+        if server:
+            server.send_signal(signal.SIGTERM)
+            try:
+                server.wait(timeout=60)
+            except subprocess.TimeoutExpired:
+                server.kill()
+
+    report["parameters"] = vars(args)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import argparse
+import json
+import resource
+import time
+import uuid
+from datetime import datetime, timezone
+from utils import *
+
+
+class RecordedElasticsearch:
+    """
+    Stand-in for the Elasticsearch client used by the recovery, replaying hits recorded in a JSONL fixture
+    (one ES hit per line). Supports search with scroll and slice, scroll and clear_scroll.
+    """
+
+    def __init__(self, path, rebase=True):
+        """
+        :param rebase: shift the crawl dates of the hits so the newest one is now, so the documents of a fixture
+                       recorded more than a TTL ago are still recovered.
+        """
+        with open(path) as f:
+            self.hits = [json.loads(line) for line in f]
+        self.scrolls = {}
+        if rebase:
+            self._rebase_crawl_dates()
+
+    def _rebase_crawl_dates(self):
+        sys_infos = [hit["_source"]["sys_info"] for hit in self.hits
+                     if hit.get("_source", {}).get("sys_info", {}).get("crawled")]
+        if not sys_infos:
+            return
+        shift = time.time() - max(crawl_time(sys_info["crawled"]) for sys_info in sys_infos)
+        for sys_info in sys_infos:
+            crawled = datetime.fromtimestamp(crawl_time(sys_info["crawled"]) + shift, timezone.utc)
+            sys_info["crawled"] = crawled.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+    def _page(self, scroll_id):
+        hits, offset, size = self.scrolls[scroll_id]
+        self.scrolls[scroll_id] = (hits, offset + size, size)
+        return {"_scroll_id": scroll_id, "hits": {"total": {"value": len(hits)}, "hits": hits[offset:offset + size]}}
+
+    def search(self, index=None, body=None, scroll=None):
+        body = body or {}
+        hits = self.hits
+        if "slice" in body:
+            hits = hits[body["slice"]["id"]::body["slice"]["max"]]
+        scroll_id = uuid.uuid4().hex
+        self.scrolls[scroll_id] = (hits, 0, body.get("size", 10))
+        return self._page(scroll_id)
+
+    def scroll(self, scroll_id=None, scroll=None):
+        return self._page(scroll_id)
+
+    def clear_scroll(self, scroll_id=None):
+        self.scrolls.pop(scroll_id, None)
+
+
+def record_fixture(path, limit, language):
+    """
+    Record the hits of the current recovery window from Elasticsearch into a JSONL fixture.
+    """
+    es_client = get_es_connection()
+    result = es_client.search(index="webhose*", body=get_query(page_size=1000, language=language), scroll="5m")
+    recorded = 0
+    with open(path, 'w') as f:
+        while result["hits"]["hits"] and recorded < limit:
+            for hit in result["hits"]["hits"]:
+                f.write(json.dumps(hit) + "\n")
+            recorded += len(result["hits"]["hits"])
+            result = es_client.scroll(scroll_id=result.get("_scroll_id"), scroll="5m")
+    es_client.clear_scroll(scroll_id=result.get("_scroll_id"))
+    print(f"Recorded {recorded} hits to {path}")
+
+
+def replay_fixture(path, language, rebase=True):
+    """
+    Run the recovery against a recorded fixture and report its duration and peak RSS.
+    """
+    es_client = RecordedElasticsearch(path, rebase)
+    start_time = time.time()
+    lsh_with_ttl = fast_recovery(es_client=es_client, language=language)
+    elapsed_time = time.time() - start_time
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"Recovered {lsh_with_ttl.size()} documents out of {len(es_client.hits)} hits "
+          f"in {elapsed_time:.2f} seconds, peak RSS {peak_rss:.0f}MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record or replay an Elasticsearch recovery fixture.")
+    parser.add_argument('fixture', help="JSONL file with one Elasticsearch hit per line")
+    parser.add_argument('--record', action='store_true', help="record the fixture from Elasticsearch first")
+    parser.add_argument('--limit', type=int, default=100000)
+    parser.add_argument('--language', default="english")
+    parser.add_argument('--no-rebase', action='store_true', help="keep the recorded crawl dates")
+    args = parser.parse_args()
+
+    if args.record:
+        record_fixture(args.fixture, args.limit, args.language)
+    replay_fixture(args.fixture, args.language, not args.no_rebase)
@@ -0,0 +1,52 @@
+import argparse
+import sys
+from partitioned_lsh import new_memory_lsh
+from utils import result_cache, run_lsh_check_batch, run_lsh_check_document
+from synthetic_corpus import SyntheticCorpus
+
+
+def batch_with_retries(seed, documents):
+    """
+    Deterministic batch of synthetic documents where every third document is followed by a retry of itself.
+    """
+    batch = []
+    for i, doc in enumerate(SyntheticCorpus(seed=seed, vocabulary_size=5000, domains=50).documents(documents)):
+        batch.append(doc)
+        if i % 3 == 0:
+            batch.append(dict(doc))
+    return batch
+
+
+def sequential_statuses(batch):
+    result_cache.entries.clear()
+    lsh_cache_dict = {"english": new_memory_lsh()}
+    return [run_lsh_check_document(doc, lsh_cache_dict) for doc in batch]
+
+
+def batch_statuses(batch):
+    result_cache.entries.clear()
+    return run_lsh_check_batch(batch, {"english": new_memory_lsh()})
+
+
+def main():
+    """
+    Check that a batch with repeated article_ids gets the statuses of the same documents sent one by one,
+    the retries answered from the result cache instead of duplicate_keys.
+    """
+    parser = argparse.ArgumentParser(description="Regression check of retried documents within a batch.")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--documents', type=int, default=60)
+    args = parser.parse_args()
+
+    batch = batch_with_retries(args.seed, args.documents)
+    expected, actual = sequential_statuses(batch), batch_statuses(batch)
+    mismatches = [(i, doc["article_id"], want, got)
+                  for i, (doc, want, got) in enumerate(zip(batch, expected, actual)) if want != got]
+    for i, article_id, want, got in mismatches:
+        print(f"Document {i} ({article_id}): expected {want}, got {got}")
+    print(f"{len(batch) - len(mismatches)}/{len(batch)} statuses match the sequential requests")
+    return 1 if mismatches or not result_cache.max_size else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,36 @@
+import sys
+import time
+from utils import crawl_time
+
+# sys_info.crawled values as Elasticsearch returns them, with their UTC timestamp
+CRAWLED_DATES = [
+    ("2024-05-01T12:34:56.000Z", 1714566896.0),
+    ("2024-05-01T12:34:56Z", 1714566896.0),
+    ("2024-05-01T12:34:56.5Z", 1714566896.5),
+    ("2024-05-01T12:34:56.123456789Z", 1714566896.123456),
+    ("2024-05-01T15:34:56.000+03:00", 1714566896.0),
+    ("2024-05-01T12:34:56.000", 1714566896.0),
+]
+
+
+def main():
+    """
+    Check that crawl_time parses Elasticsearch dates on every supported Python version, and falls back to now
+    for missing or malformed dates.
+    """
+    failures = 0
+    for crawled, expected in CRAWLED_DATES:
+        actual = crawl_time(crawled)
+        if abs(actual - expected) > 1e-6:
+            print(f"{crawled}: expected {expected}, got {actual}")
+            failures += 1
+    for crawled in (None, "", "yesterday"):
+        if abs(crawl_time(crawled) - time.time()) > 60:
+            print(f"{crawled!r}: expected the current time")
+            failures += 1
+    print(f"{len(CRAWLED_DATES) + 3 - failures}/{len(CRAWLED_DATES) + 3} crawl dates parsed as expected")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,51 @@
+import argparse
+import sys
+from datasketch import MinHash
+import utils  # sets up the NLTK data path
+from minhash_kernel import MAX_ROWS_PER_CHUNK, signature_matrix, lean_minhashes
+from tokenizer import get_tokenizer
+from synthetic_corpus import SyntheticCorpus
+
+
+def token_lists(seed, documents):
+    """
+    Tokens of deterministic synthetic documents, followed by the edge cases of the kernel: an empty document,
+    a document of one repeated token and a document with more distinct tokens than a chunk holds.
+    """
+    tokenizer = get_tokenizer("english")
+    tokens = [tokenizer.tokenize(doc["content"])
+              for doc in SyntheticCorpus(seed=seed, vocabulary_size=5000, domains=50).documents(documents)]
+    tokens += [[], ["repeated"] * 50, [f"token{i}" for i in range(MAX_ROWS_PER_CHUNK + 1)]]
+    return tokens
+
+
+def datasketch_hashvalues(tokens, num_perm):
+    minhash = MinHash(num_perm=num_perm)
+    for token in tokens:
+        minhash.update(token.encode('utf-8'))
+    return minhash.hashvalues
+
+
+def main():
+    """
+    Check that the NumPy MinHash kernel gives, byte for byte, the hashvalues of datasketch's MinHash updated
+    token by token, including across chunk boundaries.
+    """
+    parser = argparse.ArgumentParser(description="Regression check of the MinHash kernel against datasketch.")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--documents', type=int, default=200)
+    parser.add_argument('--num-perm', type=int, default=128)
+    args = parser.parse_args()
+
+    tokens = token_lists(args.seed, args.documents)
+    minhashes = lean_minhashes(signature_matrix(tokens, num_perm=args.num_perm))
+    mismatches = [i for i, (document_tokens, minhash) in enumerate(zip(tokens, minhashes))
+                  if minhash.hashvalues.tobytes() != datasketch_hashvalues(document_tokens, args.num_perm).tobytes()]
+    for i in mismatches[:10]:
+        print(f"Document {i} ({len(tokens[i])} tokens): hashvalues differ from datasketch")
+    print(f"{len(tokens) - len(mismatches)}/{len(tokens)} signatures match datasketch")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
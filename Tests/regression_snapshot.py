@@ -0,0 +1,55 @@
+import argparse
+import os
+import sys
+import tempfile
+from partitioned_lsh import new_memory_lsh
+from snapshot import save_snapshot_file, load_snapshot_file
+from utils import check_signature, document_fingerprints, minhash_signatures
+from synthetic_corpus import SyntheticCorpus
+
+
+def check_documents(lsh_with_ttl, documents, minhashes, fingerprints):
+    return [check_signature(lsh_with_ttl, minhash, doc["domain"], doc["article_id"], fingerprint=fingerprint)
+            for doc, minhash, fingerprint in zip(documents, minhashes, fingerprints)]
+
+
+def main():
+    """
+    Check that an index written to a snapshot file and loaded again answers and inserts the following documents,
+    and the retries of indexed ones, exactly like the index it was written from.
+    """
+    parser = argparse.ArgumentParser(description="Regression check of the snapshot round trip.")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--indexed', type=int, default=500, help="documents indexed before the snapshot")
+    parser.add_argument('--checked', type=int, default=250, help="documents checked after the snapshot")
+    args = parser.parse_args()
+
+    documents = list(SyntheticCorpus(seed=args.seed, vocabulary_size=5000, domains=50)
+                     .documents(args.indexed + args.checked))
+    minhashes = minhash_signatures([(doc["content"], "english") for doc in documents])
+    fingerprints = document_fingerprints(documents)
+    original = new_memory_lsh()
+    check_documents(original, documents[:args.indexed], minhashes[:args.indexed], fingerprints[:args.indexed])
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "english.lshsnap")
+        count = save_snapshot_file(original, path)
+        loaded = load_snapshot_file(path)
+    size, loaded_size = original.size(), loaded.size()
+    print(f"{count}/{size} documents written, {loaded_size} loaded")
+
+    # the checked documents followed by retries of the first indexed ones
+    checked = list(range(args.indexed, len(documents))) + list(range(min(args.checked, args.indexed)))
+    expected = check_documents(original, [documents[i] for i in checked], [minhashes[i] for i in checked],
+                               [fingerprints[i] for i in checked])
+    actual = check_documents(loaded, [documents[i] for i in checked], [minhashes[i] for i in checked],
+                             [fingerprints[i] for i in checked])
+    mismatches = [(i, want, got) for i, want, got in zip(checked, expected, actual) if want != got]
+    for i, want, got in mismatches[:10]:
+        print(f"Document {i} ({documents[i]['article_id']}): expected {want}, got {got}")
+    print(f"{len(checked) - len(mismatches)}/{len(checked)} results match the original index")
+    return 1 if mismatches or count != size or loaded_size != size else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,62 @@
+import argparse
+import random
+import sys
+import utils  # sets up the NLTK data path
+from tokenizer import get_tokenizer, SPLIT_CONTRACTIONS
+
+# Pieces the fast path has to get right: plain words, stop words, contractions, numbers, ASCII punctuation,
+# unicode quotes, dashes and ellipses, accented letters and every kind of whitespace
+WORDS = ["news", "market", "The", "of", "and", "it's", "don't", "they’re", "l’économie", "a-t-il", "U.S.",
+         "3.88", "2,5%", "10:30", "S&P", "naïve", "Ça", "straße", "https://example.com/a?b=c#d", "e-mail"]
+PUNCTUATION = [".", ",", ";", "!", "?", "(", ")", "\"", "'", "“", "”", "‘", "’", "«", "»", "—", "–", "…", "$"]
+WHITESPACE = [" ", " ", " ", "  ", "\n", "\t", "\n\n"]
+
+
+def random_text(rng, words):
+    """
+    Random text mixing WORDS, the split contractions, random letters and punctuation, glued to the words or not.
+    """
+    pieces = []
+    for _ in range(words):
+        choice = rng.random()
+        if choice < 0.5:
+            piece = rng.choice(WORDS)
+        elif choice < 0.6:
+            piece = rng.choice(sorted(SPLIT_CONTRACTIONS))
+        else:
+            piece = "".join(rng.choice("abcdefghijklmnopqrstuvwxyzéèàü'’-.") for _ in range(rng.randint(1, 8)))
+        if rng.random() < 0.3:
+            piece = rng.choice(PUNCTUATION) + piece
+        if rng.random() < 0.3:
+            piece += rng.choice(PUNCTUATION)
+        pieces.append(piece + rng.choice(WHITESPACE))
+    return "".join(pieces)
+
+
+def main():
+    """
+    Check that FastTokenizer gives the tokens of the NLTK reference tokenizer on deterministic random texts.
+    """
+    parser = argparse.ArgumentParser(description="Regression check of the fast tokenizer against NLTK.")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--texts', type=int, default=500)
+    parser.add_argument('--languages', nargs='+', default=["english", "french"])
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    texts = [random_text(rng, rng.randint(1, 60)) for _ in range(args.texts)]
+    failures = 0
+    for language in args.languages:
+        reference = get_tokenizer(language, engine="nltk", shingle_size=1)
+        fast = get_tokenizer(language, engine="fast", shingle_size=1)
+        mismatches = [i for i, text in enumerate(texts) if reference.tokenize(text) != fast.tokenize(text)]
+        for i in mismatches[:10]:
+            print(f"Mismatch in {language} text {i} {texts[i]!r}:\n  nltk: {reference.tokenize(texts[i])}\n"
+                  f"  fast: {fast.tokenize(texts[i])}")
+        print(f"{len(texts) - len(mismatches)}/{len(texts)} {language} texts match the NLTK tokenizer")
+        failures += len(mismatches)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
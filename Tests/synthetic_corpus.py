@@ -0,0 +1,125 @@
+import argparse
+import json
+import random
+from collections import deque
+from hashlib import sha256
+
+SYLLABLES = ["ka", "lo", "mi", "ter", "sun", "dra", "vel", "or", "ped", "in", "sto", "ran", "qui", "ble", "mon",
+             "ex", "tal", "ni", "por", "gen", "ux", "al", "fer", "cro", "bis", "ath", "ven", "ul", "tro", "sem"]
+STOP_WORDS = ["the", "of", "and", "to", "in", "a", "is", "that", "for", "on", "was", "with", "as", "by", "at"]
+# Originals kept around as sources for syndicated copies
+SOURCE_POOL_SIZE = 2000
+
+
+class SyntheticCorpus:
+    """
+    Deterministic generator of English-like news articles.
+
+    Every document is an original, a syndicated copy of a recent original republished on another domain
+    (expected status "similarity") or a near-duplicate republished on the same domain (expected "duplicate").
+    Copies get `edit_rate` of their words replaced.
+    """
+
+    def __init__(self, seed: int = 1, vocabulary_size: int = 50000, domains: int = 5000,
+                 syndication_rate: float = 0.2, near_duplicate_rate: float = 0.05, edit_rate: float = 0.01,
+                 min_words: int = 150, max_words: int = 600):
+        self.random = random.Random(seed)
+        self.vocabulary = sorted({self._word() for _ in range(vocabulary_size)})
+        # Zipf-like word frequencies, like natural text
+        self.cumulative_weights = []
+        total = 0.0
+        for rank in range(1, len(self.vocabulary) + 1):
+            total += 1 / rank
+            self.cumulative_weights.append(total)
+        self.random.shuffle(self.vocabulary)
+        self.domains = [f"{self._word()}{i}.com" for i in range(domains)]
+        self.syndication_rate = syndication_rate
+        self.near_duplicate_rate = near_duplicate_rate
+        self.edit_rate = edit_rate
+        self.min_words = min_words
+        self.max_words = max_words
+        self.sources = deque(maxlen=SOURCE_POOL_SIZE)
+        self.generated = 0
+
+    def _word(self):
+        return "".join(self.random.choice(SYLLABLES) for _ in range(self.random.randint(1, 4)))
+
+    def _words(self, count):
+        return self.random.choices(self.vocabulary, cum_weights=self.cumulative_weights, k=count)
+
+    def _text(self, words):
+        sentences = []
+        for start in range(0, len(words), 12):
+            sentence = []
+            for word in words[start:start + 12]:
+                sentence.append(word)
+                if self.random.random() < 0.4:
+                    sentence.append(self.random.choice(STOP_WORDS))
+            sentences.append(" ".join(sentence).capitalize() + self.random.choice([".", ".", ".", ",", "?"]))
+        return " ".join(sentences)
+
+    def _edit(self, words):
+        words = list(words)
+        for i in self.random.sample(range(len(words)), int(len(words) * self.edit_rate)):
+            words[i] = self._words(1)[0]
+        return words
+
+    def document(self):
+        """
+        :return: dict with the /is_duplicate fields ('content', 'language', 'domain', 'article_id')
+                 plus 'kind' ("original", "syndication" or "near_duplicate") and the 'source' article_id of copies.
+        """
+        self.generated += 1
+        article_id = sha256(f"synthetic-{self.generated}".encode()).hexdigest()
+        draw = self.random.random()
+        if self.sources and draw < self.syndication_rate + self.near_duplicate_rate:
+            source_id, source_domain, source_words = self.random.choice(self.sources)
+            words = self._edit(source_words)
+            if draw < self.syndication_rate:
+                kind, domain = "syndication", self.random.choice(self.domains)
+            else:
+                kind, domain = "near_duplicate", source_domain
+            source = source_id
+        else:
+            words = self._words(self.random.randint(self.min_words, self.max_words))
+            kind, domain, source = "original", self.random.choice(self.domains), None
+            self.sources.append((article_id, domain, words))
+        return {
+            "content": self._text(words),
+            "language": "english",
+            "domain": domain,
+            "article_id": article_id,
+            "kind": kind,
+            "source": source,
+        }
+
+    def documents(self, count):
+        for _ in range(count):
+            yield self.document()
+
+
+def add_corpus_arguments(parser):
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--syndication-rate', type=float, default=0.2,
+                        help="share of documents copied from a recent article on another domain")
+    parser.add_argument('--near-duplicate-rate', type=float, default=0.05,
+                        help="share of documents copied from a recent article on the same domain")
+    parser.add_argument('--edit-rate', type=float, default=0.01, help="share of words replaced in copies")
+
+
+def corpus_from_arguments(args):
+    return SyntheticCorpus(seed=args.seed, syndication_rate=args.syndication_rate,
+                           near_duplicate_rate=args.near_duplicate_rate, edit_rate=args.edit_rate)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic news corpus as JSONL.")
+    parser.add_argument('output')
+    parser.add_argument('--documents', type=int, default=10000)
+    add_corpus_arguments(parser)
+    args = parser.parse_args()
+
+    with open(args.output, 'w') as f:
+        for document in corpus_from_arguments(args).documents(args.documents):
+            f.write(json.dumps(document) + "\n")
+    print(f"Wrote {args.documents} documents to {args.output}")
@@ -0,0 +1,313 @@
+import numpy as np
+from key_codec import KEY_BYTES
+from minhash_kernel import jaccard_estimates
+
+# Smallest number of rows allocated, capacities are powers of two
+MIN_CAPACITY = 1024
+# Share of removed rows above which compact rebuilds the arrays without them
+COMPACTION_RATIO = 0.25
+# Rows whose band hashes are computed at a time, bounding the temporary products
+HASH_CHUNK_ROWS = 16384
+# Odd multipliers of the hashvalues, fixed so every process computes the same band hashes
+BAND_COEFFICIENTS = np.random.default_rng(0x1F5A).integers(1, 1 << 63, size=4096, dtype=np.uint64) * 2 + 1
+MIX_MULTIPLIER = np.uint64(0xBF58476D1CE4E5B9)
+KEY_MULTIPLIER = 0x9E3779B97F4A7C15
+UINT64_MASK = (1 << 64) - 1
+
+
+def band_hashes(signatures, hashranges):
+    """
+    64-bit hash of every band of every signature: the sum of the band hashvalues times fixed odd
+    multipliers, mixed like splitmix64 so the low bits pick the table slot.
+
+    :param signatures: hashvalues matrix of shape (count, num_perm).
+    :return: uint64 matrix of shape (count, len(hashranges)).
+    """
+    starts = [start for start, _ in hashranges]
+    end = hashranges[-1][1]
+    hashes = np.empty((len(signatures), len(hashranges)), dtype=np.uint64)
+    for first in range(0, len(signatures), HASH_CHUNK_ROWS):
+        chunk = np.asarray(signatures[first:first + HASH_CHUNK_ROWS, :end], dtype=np.uint64)
+        band = np.add.reduceat(chunk * BAND_COEFFICIENTS[:end], starts, axis=1)
+        band ^= band >> np.uint64(31)
+        band *= MIX_MULTIPLIER
+        band ^= band >> np.uint64(29)
+        hashes[first:first + HASH_CHUNK_ROWS] = band
+    return hashes
+
+
+def key_bytes_matrix(keys):
+    """
+    :param keys: Integer keys of KeyCodec.
+    :return: uint8 matrix of the little-endian KEY_BYTES of every key.
+    """
+    return np.frombuffer(b"".join(key.to_bytes(KEY_BYTES, 'little') for key in keys),
+                         dtype=np.uint8).reshape(len(keys), KEY_BYTES)
+
+
+def key_hashes(key_bytes):
+    # the low 64 bits of the document id are already a hash, the domain id is spread over them
+    key_bytes = np.ascontiguousarray(key_bytes)
+    documents = key_bytes[:, 4:12].copy().view("<u8")[:, 0]
+    domains = key_bytes[:, :4].copy().view("<u4")[:, 0].astype(np.uint64)
+    return documents ^ domains * np.uint64(KEY_MULTIPLIER)
+
+
+def key_hash(key):
+    return ((key >> 32) & UINT64_MASK) ^ ((key & 0xFFFFFFFF) * KEY_MULTIPLIER & UINT64_MASK)
+
+
+def _chain(heads, next_rows, slots, rows):
+    """
+    Link ascending rows into the chains of their slots at once, the last row of a slot becoming its head.
+    """
+    order = np.argsort(slots, kind="stable")
+    slots, rows = slots[order], rows[order]
+    firsts = np.ones(len(rows), dtype=bool)
+    firsts[1:] = slots[1:] != slots[:-1]
+    lasts = np.ones(len(rows), dtype=bool)
+    lasts[:-1] = firsts[1:]
+    previous = np.empty(len(rows), dtype=np.int32)
+    previous[1:] = rows[:-1] + 1
+    previous[firsts] = heads[slots[firsts]]
+    next_rows[rows] = previous
+    heads[slots[lasts]] = rows[lasts] + 1
+
+
+class CompactBandIndex:
+    """
+    Band tables, keys and signatures of an LSH index held in NumPy arrays instead of a dict of sets per band,
+    so a key costs a few hundred bytes and no Python object.
+
+    Every key has a row holding its encoded key, its signature (uint32 hashvalues), the hash of each of its
+    bands and its content fingerprint. Every band has a chained hash table over the band hashes, and keys
+    and fingerprints have one each, with chains storing row + 1 like SharedMemoryLSHTTL. Removed rows are
+    tombstoned and skipped by lookups until compact drops them. The arrays double when full.
+    """
+
+    def __init__(self, num_perm: int, hashranges, capacity: int = MIN_CAPACITY):
+        """
+        :param hashranges: (start, end) hashvalues of every band, from MinHashLSH.
+        """
+        self.num_perm = num_perm
+        self.hashranges = hashranges
+        self.bands = len(hashranges)
+        # rows used, and rows of keys not removed
+        self.rows = 0
+        self.live_rows = 0
+        # compactions move the rows, so a copy taken a chunk at a time starts over after one
+        self.compactions = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        self.capacity = capacity
+        # tables have two slots per row
+        self.slot_mask = 2 * capacity - 1
+        self.signatures = np.zeros((capacity, self.num_perm), dtype=np.uint32)
+        self.keys = np.zeros((capacity, KEY_BYTES), dtype=np.uint8)
+        self.band_hashes = np.zeros((capacity, self.bands), dtype=np.uint64)
+        self.key_hashes = np.zeros(capacity, dtype=np.uint64)
+        self.fingerprints = np.zeros(capacity, dtype=np.uint64)
+        self.live = np.zeros(capacity, dtype=bool)
+        self.band_next = np.zeros((capacity, self.bands), dtype=np.int32)
+        self.key_next = np.zeros(capacity, dtype=np.int32)
+        self.fingerprint_next = np.zeros(capacity, dtype=np.int32)
+        self.band_heads = np.zeros((self.bands, 2 * capacity), dtype=np.int32)
+        self.key_heads = np.zeros(2 * capacity, dtype=np.int32)
+        self.fingerprint_heads = np.zeros(2 * capacity, dtype=np.int32)
+
+    def _rebuild(self, kept_rows, capacity):
+        """
+        Reallocate the arrays with capacity rows, moving kept_rows to the first rows and relinking them.
+        """
+        kept = {name: getattr(self, name)[kept_rows]
+                for name in ("signatures", "keys", "band_hashes", "key_hashes", "fingerprints", "live")}
+        self._allocate(capacity)
+        for name, values in kept.items():
+            getattr(self, name)[:len(kept_rows)] = values
+        self.rows = len(kept_rows)
+        self._link(np.arange(self.rows))
+
+    def _slots(self, hashes):
+        return (hashes & np.uint64(self.slot_mask)).astype(np.intp)
+
+    def _link(self, rows):
+        for band in range(self.bands):
+            _chain(self.band_heads[band], self.band_next[:, band], self._slots(self.band_hashes[rows, band]), rows)
+        _chain(self.key_heads, self.key_next, self._slots(self.key_hashes[rows]), rows)
+        rows = rows[self.fingerprints[rows] != 0]
+        _chain(self.fingerprint_heads, self.fingerprint_next, self._slots(self.fingerprints[rows]), rows)
+
+    def _grow(self, count):
+        """
+        Make room for count more rows, at least doubling the capacity.
+        """
+        needed = self.rows + count
+        if needed > self.capacity:
+            self._rebuild(np.arange(self.rows), max(2 * self.capacity, 1 << (needed - 1).bit_length()))
+
+    def hash_bands(self, hashvalues):
+        return band_hashes(np.asarray(hashvalues)[np.newaxis], self.hashranges)[0]
+
+    def add(self, key: int, hashvalues, fingerprint: int = None, hashes=None):
+        """
+        Add a key that is not indexed yet.
+
+        :param hashes: band_hashes of hashvalues, computed when not given.
+        """
+        self._grow(1)
+        row = self.rows
+        self.rows += 1
+        self.live_rows += 1
+        hashes = self.hash_bands(hashvalues) if hashes is None else hashes
+        hashed = key_hash(key)
+        self.signatures[row] = hashvalues
+        self.keys[row] = np.frombuffer(key.to_bytes(KEY_BYTES, 'little'), dtype=np.uint8)
+        self.band_hashes[row] = hashes
+        self.key_hashes[row] = hashed
+        self.live[row] = True
+        for band, band_hash in enumerate(hashes.tolist()):
+            slot = band_hash & self.slot_mask
+            self.band_next[row, band] = self.band_heads[band, slot]
+            self.band_heads[band, slot] = row + 1
+        self.key_next[row] = self.key_heads[hashed & self.slot_mask]
+        self.key_heads[hashed & self.slot_mask] = row + 1
+        if fingerprint:
+            self.fingerprints[row] = fingerprint
+            self.fingerprint_next[row] = self.fingerprint_heads[fingerprint & self.slot_mask]
+            self.fingerprint_heads[fingerprint & self.slot_mask] = row + 1
+
+    def add_many(self, key_bytes, signatures, fingerprints=None):
+        """
+        Add keys that are not indexed yet and are distinct, hashing and linking them a whole band at a time.
+
+        :param key_bytes: uint8 matrix of shape (count, KEY_BYTES), see key_bytes_matrix.
+        :param signatures: hashvalues matrix of shape (count, num_perm).
+        :param fingerprints: content_fingerprint of every key, 0 when unknown.
+        """
+        self._grow(len(key_bytes))
+        rows = np.arange(self.rows, self.rows + len(key_bytes))
+        self.signatures[rows] = signatures
+        self.keys[rows] = key_bytes
+        self.band_hashes[rows] = band_hashes(signatures, self.hashranges)
+        self.key_hashes[rows] = key_hashes(key_bytes)
+        if fingerprints is not None:
+            self.fingerprints[rows] = fingerprints
+        self.live[rows] = True
+        self.rows += len(rows)
+        self.live_rows += len(rows)
+        self._link(rows)
+
+    def _find(self, hashed, key_bytes):
+        row = self.key_heads[hashed & self.slot_mask] - 1
+        while row >= 0:
+            if self.live[row] and int(self.key_hashes[row]) == hashed and self.keys[row].tobytes() == key_bytes:
+                return row
+            row = self.key_next[row] - 1
+        return -1
+
+    def find(self, key: int):
+        """
+        :return: the row of key, -1 when it is not indexed.
+        """
+        return self._find(key_hash(key), key.to_bytes(KEY_BYTES, 'little'))
+
+    def __contains__(self, key):
+        return self.find(key) >= 0
+
+    def contains_many(self, key_bytes):
+        """
+        :return: bool array telling which of the keys of key_bytes are indexed.
+        """
+        hashes = key_hashes(key_bytes)
+        found = np.zeros(len(key_bytes), dtype=bool)
+        live_hashes = self.key_hashes[:self.rows][self.live[:self.rows]]
+        for i in np.flatnonzero(np.isin(hashes, live_hashes)).tolist():
+            found[i] = self._find(int(hashes[i]), key_bytes[i].tobytes()) >= 0
+        return found
+
+    def key(self, row):
+        return int.from_bytes(self.keys[row].tobytes(), 'little')
+
+    def query_rows(self, hashes):
+        """
+        :param hashes: band_hashes of the queried signature.
+        :return: rows sharing at least one band with it.
+        """
+        rows = set()
+        for band, hashed in enumerate(hashes.tolist()):
+            row = self.band_heads[band, hashed & self.slot_mask] - 1
+            while row >= 0:
+                if self.live[row] and int(self.band_hashes[row, band]) == hashed:
+                    rows.add(int(row))
+                row = self.band_next[row, band] - 1
+        return sorted(rows)
+
+    def scores(self, rows, hashvalues):
+        return jaccard_estimates(self.signatures[rows], hashvalues).tolist() if rows else []
+
+    def fingerprint_row(self, fingerprint: int):
+        """
+        :return: the newest row with this content_fingerprint, -1 when there is none.
+        """
+        row = self.fingerprint_heads[fingerprint & self.slot_mask] - 1
+        while row >= 0:
+            if self.live[row] and int(self.fingerprints[row]) == fingerprint:
+                return row
+            row = self.fingerprint_next[row] - 1
+        return -1
+
+    def remove_row(self, row):
+        # the row stays linked until compact drops it, lookups skip it meanwhile
+        self.live[row] = False
+        self.live_rows -= 1
+
+    def compact(self, ratio: float = COMPACTION_RATIO):
+        """
+        Drop the removed rows once they are more than ratio of the rows, shrinking the arrays to fit.
+
+        :return: True when the index was compacted.
+        """
+        tombstones = self.rows - self.live_rows
+        if not tombstones or tombstones <= ratio * self.rows:
+            return False
+        kept_rows = np.flatnonzero(self.live[:self.rows])
+        self._rebuild(kept_rows, max(MIN_CAPACITY, 1 << max(len(kept_rows) - 1, 0).bit_length()))
+        self.compactions += 1
+        return True
+
+    def live_records(self, chunk_rows: int):
+        """
+        :return: generator of (key bytes, fingerprints, signatures) of the live rows, chunk_rows at a time.
+                 Rows may be added or removed between two chunks, and the rows are read again from the first
+                 one after a compaction, so a key can be returned twice but no live key is missed.
+        """
+        start, compactions = 0, self.compactions
+        while start < self.rows:
+            if self.compactions != compactions:
+                start, compactions = 0, self.compactions
+            live = np.flatnonzero(self.live[start:start + chunk_rows]) + start
+            start += chunk_rows
+            if len(live):
+                yield self.keys[live], self.fingerprints[live], self.signatures[live]
+
+    def bucket_sizes(self, sample_size: int):
+        """
+        :return: (number of non-empty slots of all band tables, chain lengths of up to sample_size slots per band).
+        """
+        bucket_count = int(np.count_nonzero(self.band_heads))
+        sizes = []
+        for band in range(self.bands):
+            for head in self.band_heads[band][np.flatnonzero(self.band_heads[band])[:sample_size]]:
+                size, row = 0, head - 1
+                while row >= 0:
+                    size += 1
+                    row = self.band_next[row, band] - 1
+                sizes.append(size)
+        return bucket_count, sizes
+
+    def nbytes(self):
+        return sum(array.nbytes for array in (
+            self.signatures, self.keys, self.band_hashes, self.key_hashes, self.fingerprints, self.live,
+            self.band_next, self.key_next, self.fingerprint_next, self.band_heads, self.key_heads,
+            self.fingerprint_heads))
@@ -1,3 +1,6 @@
+import os
+
+
 class Consts:
     HOST = "tanya-032"
     REDIS_HOST = "tanya-032"
@@ -8,8 +11,83 @@ class Consts:
     MAX_MESSAGES_IN_QUEUE = 100000
     QUEUE_NAME = 'SyndicationQueue'
     DUPLICATE_KEYS = "duplicate_keys"
+    INVALID_ARTICLE_ID = "article_id must be a lowercase sha256 hex digest"
     UNIQUE = "unique"
     MAX_HOURS_FOR_RECOVERY = 12
+    # Languages recovered from Elasticsearch when their index is missing, others start empty
+    RECOVERY_LANGUAGES = ["english"]
+    RECOVERY_SLICES = int(os.getenv("RECOVERY_SLICES", 4))
+    RECOVERY_WORKERS = int(os.getenv("RECOVERY_WORKERS", 4))
+    RECOVERY_BATCH_SIZE = 1000
+    RECOVERY_MAX_IN_FLIGHT = 8
+    # POST /recover rebuilds an index next to the current one, doubling its memory while it runs, so it is only
+    # served when enabled, for load tests
+    RECOVER_ENDPOINT = os.getenv("RECOVER_ENDPOINT", "false").lower() == "true"
+
+    # Uvicorn worker processes of the server, more than one needs a shared LSH_STORAGE
+    SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", 1))
+    # Execution mode of the CPU-bound work in the server: "inline", "thread" or "process"
+    EXECUTION_MODE = os.getenv("EXECUTION_MODE", "process")
+    HASH_WORKERS = int(os.getenv("HASH_WORKERS", max(1, (os.cpu_count() or 1) // SERVER_WORKERS)))
+
+    # Tokenization: engine name ("fast" or "nltk"), per-language overrides ("french:nltk,english:fast")
+    # and words per shingle
+    TOKENIZER_ENGINE = os.getenv("TOKENIZER_ENGINE", "fast")
+    LANGUAGE_TOKENIZERS = {language.strip(): engine.strip() for language, engine in
+                           (item.split(":", 1) for item in os.getenv("LANGUAGE_TOKENIZERS", "").split(",")
+                            if item.strip())}
+    SHINGLE_SIZE = int(os.getenv("SHINGLE_SIZE", 1))
+    # Reuse the signature of an indexed document with the same normalized content instead of hashing again
+    EXACT_DUPLICATE_FAST_PATH = os.getenv("EXACT_DUPLICATE_FAST_PATH", "true").lower() == "true"
+
+    # LSH storage: "memory" keeps the index in the process, "redis" shares it between replicas
+    # and "shm" shares it between the worker processes of a host
+    LSH_STORAGE = os.getenv("LSH_STORAGE", "memory")
+    LSH_REDIS_HOST = os.getenv("LSH_REDIS_HOST", REDIS_HOST)
+    LSH_REDIS_PORT = int(os.getenv("LSH_REDIS_PORT", REDIS_PORT))
+    LSH_REDIS_DB = int(os.getenv("LSH_REDIS_DB", 5))
+    SHARED_INDEX_DIR = os.getenv("SHARED_INDEX_DIR", "/dev/shm")
+    # Keys per language of a "shm" index, about 650 bytes each once used
+    SHARED_INDEX_CAPACITY = int(os.getenv("SHARED_INDEX_CAPACITY", 2000000))
+
+    # Consumer: "sync" handles one document at a time, "async" keeps CONSUMER_CONCURRENCY in flight
+    # and "batch" pops, validates and pushes up to CONSUMER_BATCH_SIZE documents per cycle
+    CONSUMER_MODE = os.getenv("CONSUMER_MODE", "sync")
+    CONSUMER_CONCURRENCY = int(os.getenv("CONSUMER_CONCURRENCY", 32))
+    CONSUMER_BATCH_SIZE = int(os.getenv("CONSUMER_BATCH_SIZE", 100))
+    CONSUMER_POLL_TIMEOUT_SECONDS = 5
+    CONSUMER_ID = os.getenv("CONSUMER_ID", os.getenv("HOSTNAME", "consumer"))
+    # Dedup: "http" asks the DuplicateService, "embedded" checks documents in the consumer
+    # against the shared Redis indexes (see LSH_STORAGE)
+    DEDUP_MODE = os.getenv("DEDUP_MODE", "http")
+    # Results of inserted documents answering retries of the same article_id
+    RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", 100000))
+    RESULT_CACHE_TTL_SECONDS = int(os.getenv("RESULT_CACHE_TTL_SECONDS", 3600))
+    # Per-stage latency percentiles are logged by the consumer at most this often
+    LATENCY_LOG_INTERVAL_SECONDS = 60
+    VALIDATION_TIMEOUT_SECONDS = 30
+
+    # In-memory indexes journal their inserts to a Redis stream, flushed every JOURNAL_FLUSH_INTERVAL_SECONDS
+    # or JOURNAL_BATCH_SIZE inserts, and are checkpointed (snapshot saved, journal trimmed) periodically
+    LSH_JOURNAL = os.getenv("LSH_JOURNAL", "true").lower() == "true"
+    JOURNAL_FLUSH_INTERVAL_SECONDS = 1
+    JOURNAL_BATCH_SIZE = 500
+    JOURNAL_MAX_BUFFER = 100000
+    LSH_CHECKPOINT_INTERVAL_SECONDS = int(os.getenv("LSH_CHECKPOINT_INTERVAL_SECONDS", 600))
+    # Snapshots of in-memory indexes are written as files to LSH_SNAPSHOT_DIR when it is set,
+    # to Redis as values of at most SNAPSHOT_CHUNK_BYTES otherwise
+    LSH_SNAPSHOT_DIR = os.getenv("LSH_SNAPSHOT_DIR", "")
+    SNAPSHOT_CHUNK_BYTES = 64 * 1024 * 1024
+
+    # In-memory indexes are split into partitions of LSH_PARTITION_HOURS by expiration time, dropped whole every
+    # LSH_EXPIRY_INTERVAL_SECONDS once expired, 0 keeps one index with per-key expiration
+    LSH_PARTITION_HOURS = float(os.getenv("LSH_PARTITION_HOURS", 1))
+    LSH_EXPIRY_INTERVAL_SECONDS = 60
+
+    # Indexes idle for LSH_IDLE_SECONDS are spilled to Redis while their total exceeds the budget
+    LSH_MEMORY_BUDGET_MB = int(os.getenv("LSH_MEMORY_BUDGET_MB", 4096))
+    LSH_IDLE_SECONDS = int(os.getenv("LSH_IDLE_SECONDS", 3600))
+    LSH_EVICTION_INTERVAL_SECONDS = 60
 
     # Metrics
     TOTAL_LSH_OBJECT_CREATED = "total_lsh_object_created"
@@ -22,6 +100,12 @@ class Consts:
     TOTAL_DUPLICATE_REQUESTS_NOT_OK = "duplicate_requests_bad_response_total"
     TOTAL_FAILED_CONSUME = "total_failed_consume"
     TOTAL_DUPLICATE_KEYS = "total_duplicate_keys"
+    TOTAL_FINGERPRINT_HITS = "total_fingerprint_hits"
+    TOTAL_RESULT_CACHE_HITS = "total_result_cache_hits"
+    TOTAL_RESULT_CACHE_MISSES = "total_result_cache_misses"
+    TOTAL_JOURNAL_ERRORS = "total_journal_errors"
+    TOTAL_EXPIRED_PARTITIONS = "total_expired_partitions"
+    TOTAL_COMPACTED_PARTITIONS = "total_compacted_partitions"
     TOTAL_FAILED_REDIS_CONNECTION = "total_failed_redis_connection"
     TOTAL_DOCUMENTS_FAILED_DISTRIBUTION = "total_documents_failed_distribution"
     TOTAL_FAILED_FAILED_RABBIT_CONNECTION = "total_failed_failed_rabbit_connection"
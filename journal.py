@@ -0,0 +1,122 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import numpy as np
+import metrics3_docker.metrics as metrics
+from redis import Redis
+from consts import Consts
+from minhash_lsh_ttl import logger
+
+# Journal entries read per XRANGE while replaying
+REPLAY_BATCH_SIZE = 5000
+# Appends of every journal are sent by one thread, in the order they were flushed
+appender = ThreadPoolExecutor(max_workers=1, thread_name_prefix="lsh-journal")
+
+
+class InsertJournal:
+    """
+    Write-ahead journal of the inserts into an in-memory index, kept as a Redis stream next to its snapshot.
+
+    Inserts are buffered and appended in one pipeline every JOURNAL_BATCH_SIZE entries or when flush is
+    called, so at most JOURNAL_FLUSH_INTERVAL_SECONDS of inserts are lost on a crash. The thread that inserts
+    only hands the buffer over, the pipeline is sent by the appender thread. A checkpoint flushes the journal
+    and starts copying the index on the thread that inserts, saves the snapshot of the copy elsewhere, then
+    trims the stream up to the last entry appended before the copy, so loading the snapshot and replaying the
+    stream restores the index. Replayed inserts of keys already in the snapshot are skipped, so a checkpoint
+    interrupted before the stream is trimmed is harmless.
+    """
+
+    def __init__(self, redis_pool, language: str, batch_size: int = Consts.JOURNAL_BATCH_SIZE,
+                 max_buffer: int = Consts.JOURNAL_MAX_BUFFER):
+        """
+        :param redis_pool: Connection pool of the Redis holding the snapshots.
+        :param batch_size: Buffered entries that trigger an append.
+        :param max_buffer: Entries kept while Redis is unreachable, the oldest are dropped beyond it.
+        """
+        self.redis_pool = redis_pool
+        self.stream_key = f"{language}:lsh_journal"
+        self.batch_size = batch_size
+        self.buffer = []
+        # entries handed to the appender and not appended yet, only used by the appender thread
+        self.pending = deque(maxlen=max_buffer)
+        # id of the last entry appended or replayed, so every entry up to it is in the index
+        self.last_id = None
+
+    def append(self, key, minhash, expire_time: datetime, fingerprint=None):
+        entry = {"k": str(key), "s": minhash.hashvalues.astype(np.uint32).tobytes(), "e": expire_time.timestamp()}
+        if fingerprint is not None:
+            entry["f"] = fingerprint
+        self.buffer.append(entry)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Hand the buffered entries over to the appender thread.
+
+        :return: Future of last_id once they are appended, or kept pending when Redis fails.
+        """
+        entries, self.buffer = self.buffer, []
+        return appender.submit(self._append, entries)
+
+    def _append(self, entries):
+        self.pending.extend(entries)
+        if not self.pending:
+            return self.last_id
+        try:
+            with Redis(connection_pool=self.redis_pool) as redis_connection:
+                pipe = redis_connection.pipeline(transaction=False)
+                for entry in self.pending:
+                    pipe.xadd(self.stream_key, entry)
+                entry_ids = pipe.execute()
+        except Exception as e:
+            metrics.count(Consts.TOTAL_JOURNAL_ERRORS)
+            logger.error(f"Failed to append {len(self.pending)} entries to {self.stream_key}: {e}")
+            return self.last_id
+        self.pending.clear()
+        self.last_id = entry_ids[-1]
+        return self.last_id
+
+    def checkpointed(self, redis_connection, last_id):
+        """
+        Drop the journaled entries once the snapshot holding them is saved, keeping those appended after it.
+
+        :param last_id: last_id of the journal when the index was copied for the snapshot.
+        """
+        if last_id is None:
+            return
+        milliseconds, sequence = (last_id.decode() if isinstance(last_id, bytes) else last_id).split("-")
+        # MINID drops the entries before the given id, the entries up to last_id
+        redis_connection.execute_command("XTRIM", self.stream_key, "MINID", f"{milliseconds}-{int(sequence) + 1}")
+
+    def replay(self, lsh_with_ttl):
+        """
+        Insert the unexpired entries journaled since the last checkpoint into lsh_with_ttl, with one insert_bulk
+        per page of entries.
+
+        :return: Number of inserted entries.
+        """
+        start_time = time.time()
+        # entries flushed by an index of the language dropped or replaced meanwhile are appended first
+        appender.submit(lambda: None).result()
+        inserted = 0
+        last_id = None
+        with Redis(connection_pool=self.redis_pool) as redis_connection:
+            while entries := redis_connection.xrange(self.stream_key, min=last_id or "-", count=REPLAY_BATCH_SIZE):
+                now = time.time()
+                # ranges start at the last entry of the previous page
+                live = [fields for entry_id, fields in entries if entry_id != last_id and float(fields[b"e"]) > now]
+                if live:
+                    keys = [fields[b"k"].decode() for fields in live]
+                    signatures = np.frombuffer(b"".join(fields[b"s"] for fields in live), dtype=np.uint32)
+                    inserted += lsh_with_ttl.insert_bulk(
+                        [int(key) if key.isdigit() else key for key in keys], signatures.reshape(len(live), -1),
+                        [datetime.fromtimestamp(float(fields[b"e"])) for fields in live],
+                        np.array([int(fields.get(b"f", 0)) for fields in live], dtype=np.uint64))
+                if entries[-1][0] == last_id:
+                    break
+                last_id = entries[-1][0]
+        self.last_id = last_id or self.last_id
+        logger.info(f"Replayed {inserted} entries of {self.stream_key} in {time.time() - start_time:.3f} seconds.")
+        return inserted
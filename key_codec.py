@@ -0,0 +1,182 @@
+import fcntl
+import json
+import os
+import re
+import threading
+import zlib
+from contextlib import contextmanager
+from hashlib import sha256
+
+# Low bits of a key holding the interned domain id, the high bits hold the 256-bit document id
+DOMAIN_BITS = 32
+DOMAIN_MASK = (1 << DOMAIN_BITS) - 1
+# Bytes of a key stored as a fixed-size little-endian value, a 256-bit document id and a 32-bit domain id
+KEY_BYTES = 36
+# article_ids accepted by the API, the only ones format_key gives back as they were sent
+ARTICLE_ID = re.compile(r"[0-9a-f]{64}")
+
+
+def is_article_id(article_id):
+    """
+    Whether an article_id is a lowercase sha256 hex digest, like the sha256 of its url sent by the consumer.
+    """
+    return isinstance(article_id, str) and ARTICLE_ID.fullmatch(article_id) is not None
+
+
+def document_id(article_id):
+    """
+    256-bit integer id of an article, its sha256 hex id itself or the sha256 of any other id.
+    Other ids can not be formatted back, the API rejects them (see is_article_id), they only come from keys
+    saved as "article_id|domain" strings by older versions.
+    """
+    article_id = str(article_id)
+    if len(article_id) == 64:
+        try:
+            return int(article_id, 16)
+        except ValueError:
+            pass
+    return int.from_bytes(sha256(article_id.encode()).digest(), 'big')
+
+
+class KeyCodec:
+    """
+    Encodes the (article_id, domain) key of an index entry as a single integer,
+    `document_id << DOMAIN_BITS | domain_id`, with domains interned to small ids.
+    The same key object is referenced by the key table, every band bucket and the expiration heap,
+    and comparing domains of candidates is an integer compare.
+    """
+
+    def __init__(self):
+        self.domain_ids = {}
+        self.domain_names = {}
+
+    def domain_id(self, domain):
+        domain_id = self.domain_ids.get(domain)
+        if domain_id is None:
+            domain_id = self.domain_ids[domain] = len(self.domain_ids)
+            self.domain_names[domain_id] = domain
+        return domain_id
+
+    def domain_name(self, domain_id):
+        return self.domain_names.get(domain_id)
+
+    def encode(self, article_id, domain):
+        return document_id(article_id) << DOMAIN_BITS | self.domain_id(domain)
+
+    def decode(self, key):
+        """
+        Integer form of a key, converting keys stored as "article_id|domain" strings by older versions.
+        """
+        if isinstance(key, int):
+            return key
+        article_id, domain = key.split('|', 1)
+        return self.encode(article_id, domain)
+
+    def format_key(self, key):
+        """
+        Readable "document_id|domain" form of a key, the document id being the sha256 hex article id.
+        """
+        key = self.decode(key)
+        return f"{key >> DOMAIN_BITS:064x}|{self.domain_name(key & DOMAIN_MASK)}"
+
+
+class RedisKeyCodec(KeyCodec):
+    """
+    KeyCodec whose domain table lives in Redis, so every replica sharing an index assigns the same domain ids.
+    """
+
+    def __init__(self, redis, basename: bytes):
+        super().__init__()
+        self.redis = redis
+        self.domains_key = basename + b"_domains"
+        self.sequence_key = basename + b"_domain_sequence"
+        self.names_key = basename + b"_domain_names"
+
+    def domain_id(self, domain):
+        domain_id = self.domain_ids.get(domain)
+        if domain_id is None:
+            field = str(domain)
+            # the first replica to set the domain wins, the others read its id
+            new_id = self.redis.incr(self.sequence_key)
+            if self.redis.hsetnx(self.domains_key, field, new_id):
+                self.redis.hset(self.names_key, new_id, field)
+            domain_id = self.domain_ids[domain] = int(self.redis.hget(self.domains_key, field))
+            self.domain_names[domain_id] = field
+        return domain_id
+
+    def domain_name(self, domain_id):
+        domain = self.domain_names.get(domain_id)
+        if domain is None:
+            domain = self.redis.hget(self.names_key, domain_id)
+            if domain is not None:
+                domain = self.domain_names[domain_id] = domain.decode()
+        return domain
+
+
+class FileKeyCodec(KeyCodec):
+    """
+    KeyCodec whose domain table is a file shared by the processes of a host, so every process sharing an index
+    assigns and names the same domain ids. The file has one JSON [domain_id, domain] line per domain, appended
+    and read under an exclusive flock of the file and a thread lock. A domain gets the CRC32 of its name as id,
+    or the next free id when another domain already holds it.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.file = open(path, "a+b")
+        self.thread_lock = threading.Lock()
+        # bytes of the file already read into the tables
+        self.offset = 0
+
+    @contextmanager
+    def _locked(self):
+        with self.thread_lock:
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.file, fcntl.LOCK_UN)
+
+    def _read(self):
+        self.file.seek(self.offset)
+        data = self.file.read()
+        self.offset += len(data)
+        for line in data.splitlines():
+            domain_id, domain = json.loads(line)
+            self.domain_ids[domain] = domain_id
+            self.domain_names[domain_id] = domain
+
+    def domain_id(self, domain):
+        field = str(domain)
+        domain_id = self.domain_ids.get(field)
+        if domain_id is None:
+            with self._locked():
+                self._read()
+                domain_id = self.domain_ids.get(field)
+                if domain_id is None:
+                    domain_id = zlib.crc32(field.encode())
+                    while domain_id in self.domain_names:
+                        domain_id = (domain_id + 1) & DOMAIN_MASK
+                    self.file.write((json.dumps([domain_id, field]) + "\n").encode())
+                    self.file.flush()
+                    self._read()
+        return domain_id
+
+    def domain_name(self, domain_id):
+        domain = self.domain_names.get(domain_id)
+        if domain is None and os.fstat(self.file.fileno()).st_size != self.offset:
+            with self._locked():
+                self._read()
+            domain = self.domain_names.get(domain_id)
+        # ids of rows written before the domain table existed are the CRC32 of a domain missing from it
+        return domain if domain is not None else f"domain-{domain_id}"
+
+    def clear(self):
+        """
+        Empty the domain table, for an index file that was just created.
+        """
+        with self._locked():
+            self.file.truncate(0)
+            self.offset = 0
+            self.domain_ids.clear()
+            self.domain_names.clear()
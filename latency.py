@@ -0,0 +1,116 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger()
+
+# Upper bounds of the histogram buckets in milliseconds, the last bucket is unbounded
+BUCKET_BOUNDS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class LatencyHistogram:
+    """
+    Fixed-bucket histogram of the durations of one stage.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, duration_ms):
+        self.buckets[bisect.bisect_left(BUCKET_BOUNDS_MS, duration_ms)] += 1
+        self.count += 1
+        self.total_ms += duration_ms
+        self.max_ms = max(self.max_ms, duration_ms)
+
+    def percentile(self, q):
+        """
+        Upper bound of the bucket holding the q-th percentile, the maximum for the unbounded bucket.
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKET_BOUNDS_MS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return round(min(bound, self.max_ms), 3)
+        return round(self.max_ms, 3)
+
+    def snapshot(self):
+        labels = [f"le_{bound}" for bound in BUCKET_BOUNDS_MS] + ["le_inf"]
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total_ms / self.count, 3) if self.count else None,
+            "p50_ms": self.percentile(0.5),
+            "p90_ms": self.percentile(0.9),
+            "p99_ms": self.percentile(0.99),
+            "max_ms": round(self.max_ms, 3),
+            "buckets": {label: count for label, count in zip(labels, self.buckets) if count},
+        }
+
+
+histograms = {}
+lock = threading.Lock()
+# Observations of the current thread are collected here instead of the histograms while capturing
+capture = threading.local()
+last_log_time = time.time()
+
+
+def observe(stage, duration_ms):
+    observations = getattr(capture, "observations", None)
+    if observations is not None:
+        observations.append((stage, duration_ms))
+        return
+    with lock:
+        histogram = histograms.get(stage)
+        if histogram is None:
+            histogram = histograms[stage] = LatencyHistogram()
+        histogram.observe(duration_ms)
+
+
+def record(observations):
+    for stage, duration_ms in observations:
+        observe(stage, duration_ms)
+
+
+@contextmanager
+def timed(stage):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, (time.perf_counter() - start_time) * 1000)
+
+
+def call_captured(func, *args):
+    """
+    Call func, returning its result with the stage durations observed during the call, so calls made in
+    a worker process can be recorded by the parent with `record`.
+    """
+    capture.observations = []
+    try:
+        return func(*args), capture.observations
+    finally:
+        capture.observations = None
+
+
+def latency_stats():
+    with lock:
+        return {stage: histogram.snapshot() for stage, histogram in sorted(histograms.items())}
+
+
+def log_latency_stats(interval_seconds):
+    """
+    Log the p50/p99 of every stage at most once per interval_seconds.
+    """
+    global last_log_time
+    now = time.time()
+    if now - last_log_time < interval_seconds:
+        return
+    last_log_time = now
+    for stage, stats in latency_stats().items():
+        logger.info(f"Latency of {stage}: count={stats['count']} mean={stats['mean_ms']}ms "
+                    f"p50<={stats['p50_ms']}ms p99<={stats['p99_ms']}ms max={stats['max_ms']}ms")
@@ -0,0 +1,137 @@
+import time
+import logging
+from nltk.corpus import stopwords
+
+logger = logging.getLogger()
+
+
+class LSHCacheManager:
+    """
+    Mapping of language to MinHashLSHTTL where indexes are created on first use for any language with
+    stopwords, and indexes that go idle are spilled to a snapshot while the total exceeds a memory budget.
+    A spilled index is loaded back from its snapshot on its next use.
+    """
+
+    def __init__(self, loader, saver, memory_budget_mb: int, idle_seconds: int):
+        """
+        :param loader: Callable returning the index of a language, loading its snapshot if one exists.
+        :param saver: Callable saving a {language: index} dict as snapshots, returning True on success.
+        :param memory_budget_mb: Total estimated size above which idle indexes are spilled.
+        :param idle_seconds: Time without access after which an index may be spilled.
+        """
+        self.loader = loader
+        self.saver = saver
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self.idle_seconds = idle_seconds
+        self.indexes = {}
+        self.last_access = {}
+        self.evictions = {}
+        self.supported_languages = set(stopwords.fileids()) - {"README"}
+
+    def supports(self, language):
+        return language in self.supported_languages
+
+    def get(self, language, default=None, load=True):
+        """
+        :param load: False to only return a resident index, so the caller can load it elsewhere and put it.
+        """
+        if not language:
+            return default
+        lsh_with_ttl = self.indexes.get(language)
+        if lsh_with_ttl is None:
+            if not load or not self.supports(language):
+                return default
+            logger.info(f"Creating LSH index for {language}")
+            lsh_with_ttl = self.loader(language)
+            if lsh_with_ttl is None:
+                return default
+            self.indexes[language] = lsh_with_ttl
+        self.last_access[language] = time.time()
+        return lsh_with_ttl
+
+    def put(self, language, lsh_with_ttl):
+        self.indexes[language] = lsh_with_ttl
+        self.last_access[language] = time.time()
+
+    def __getitem__(self, language):
+        return self.indexes[language]
+
+    def __contains__(self, language):
+        return language in self.indexes
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def items(self):
+        return list(self.indexes.items())
+
+    def estimated_bytes(self):
+        return {language: lsh_with_ttl.estimated_bytes() for language, lsh_with_ttl in self.indexes.items()}
+
+    def spill_candidates(self):
+        """
+        :return: The least recently used idle languages to spill to bring the total under the budget.
+        """
+        sizes = self.estimated_bytes()
+        total = sum(sizes.values())
+        candidates = []
+        now = time.time()
+        for language in sorted(self.indexes, key=self.last_access.get):
+            if total <= self.memory_budget or now - self.last_access[language] < self.idle_seconds:
+                break
+            candidates.append(language)
+            total -= sizes[language]
+        return candidates
+
+    def evict(self, language, lsh_with_ttl, saved_at):
+        """
+        Drop the index of a language once its snapshot is saved, unless it was replaced or used since the
+        snapshot was taken at saved_at.
+
+        :return: True when the index was dropped.
+        """
+        if self.indexes.get(language) is not lsh_with_ttl or self.last_access[language] > saved_at:
+            return False
+        size = lsh_with_ttl.estimated_bytes()
+        del self.indexes[language]
+        self.evictions[language] = self.evictions.get(language, 0) + 1
+        logger.info(f"Spilled idle LSH index for {language} ({size / 1024 / 1024:.1f}MB)")
+        return True
+
+    def evict_idle(self):
+        """
+        Spill the least recently used idle indexes to their snapshots until the total is under the budget.
+
+        :return: List of spilled languages.
+        """
+        evicted = []
+        for language in self.spill_candidates():
+            lsh_with_ttl = self.indexes[language]
+            saved_at = time.time()
+            if not self.saver({language: lsh_with_ttl}):
+                logger.error(f"Failed to spill LSH index for {language}, keeping it in memory")
+                continue
+            if self.evict(language, lsh_with_ttl, saved_at):
+                evicted.append(language)
+        return evicted
+
+    def stats(self):
+        sizes = self.estimated_bytes()
+        now = time.time()
+        languages = {}
+        for language in set(self.last_access) | set(self.indexes):
+            lsh_with_ttl = self.indexes.get(language)
+            languages[language] = {
+                "resident": lsh_with_ttl is not None,
+                "keys": lsh_with_ttl.size() if lsh_with_ttl is not None else None,
+                "expiration_entries": lsh_with_ttl.expiration_size() if lsh_with_ttl is not None else None,
+                "band_buckets": lsh_with_ttl.bucket_stats() if lsh_with_ttl is not None else None,
+                "estimated_bytes": sizes.get(language, 0),
+                "idle_seconds": round(now - self.last_access[language]) if language in self.last_access else None,
+                "evictions": self.evictions.get(language, 0),
+            }
+        return {
+            "memory_budget_bytes": self.memory_budget,
+            "estimated_bytes": sum(sizes.values()),
+            "languages": languages,
+        }
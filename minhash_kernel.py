@@ -0,0 +1,79 @@
+from functools import lru_cache
+from hashlib import sha1
+import numpy as np
+from datasketch import MinHash, LeanMinHash
+from datasketch.minhash import _mersenne_prime, _max_hash
+
+SEED = 1
+# Upper bound of (token, permutation) rows hashed in one matrix operation, ~8MB of uint64
+MAX_ROWS_PER_CHUNK = 8192
+
+
+@lru_cache(maxsize=None)
+def get_permutations(num_perm: int, seed: int = SEED):
+    # Same permutations as datasketch.MinHash(num_perm, seed), generated once per process
+    return MinHash(num_perm=num_perm, seed=seed).permutations
+
+
+def hash_tokens(tokens):
+    """
+    32-bit SHA1 hash of every distinct token, matching datasketch's sha1_hash32.
+    Duplicates are dropped since they cannot change the minimum.
+    """
+    unique_tokens = set(tokens)
+    return np.fromiter((int.from_bytes(sha1(token.encode('utf-8')).digest()[:4], 'little')
+                        for token in unique_tokens), dtype=np.uint64, count=len(unique_tokens))
+
+
+def _apply_permutations(token_hashes, hashvalues, a, b):
+    lengths = np.array([len(hashes) for hashes in token_hashes])
+    non_empty = np.flatnonzero(lengths)
+    if not len(non_empty):
+        return
+    hv = np.concatenate(token_hashes)[:, np.newaxis]
+    phv = (hv * a + b) % _mersenne_prime & _max_hash
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))[non_empty]
+    hashvalues[non_empty] = np.minimum.reduceat(phv, offsets, axis=0)
+
+
+def signature_matrix(token_lists, num_perm: int = 128, seed: int = SEED):
+    """
+    Compute the MinHash hashvalues of many documents at once.
+
+    Tokens are hashed once into a NumPy array and all permutations are applied as a single matrix operation
+    per chunk of documents. Row i is byte-identical to the hashvalues of a datasketch MinHash updated with the
+    tokens of document i.
+
+    :param token_lists: list of token lists, one per document.
+    :return: uint64 array of shape (len(token_lists), num_perm).
+    """
+    a, b = get_permutations(num_perm, seed)
+    hashvalues = np.full((len(token_lists), num_perm), _max_hash, dtype=np.uint64)
+
+    start, rows, token_hashes = 0, 0, []
+    for i, tokens in enumerate(token_lists):
+        hashes = hash_tokens(tokens)
+        if token_hashes and rows + len(hashes) > MAX_ROWS_PER_CHUNK:
+            _apply_permutations(token_hashes, hashvalues[start:i], a, b)
+            start, rows, token_hashes = i, 0, []
+        token_hashes.append(hashes)
+        rows += len(hashes)
+    if token_hashes:
+        _apply_permutations(token_hashes, hashvalues[start:], a, b)
+    return hashvalues
+
+
+def lean_minhashes(hashvalues, seed: int = SEED):
+    return [LeanMinHash(seed=seed, hashvalues=row) for row in hashvalues]
+
+
+def jaccard_estimates(signatures, hashvalues):
+    """
+    Estimated Jaccard similarity of every row of a signature matrix with one signature,
+    the fraction of equal hashvalues.
+
+    :param signatures: array of shape (N, num_perm).
+    :param hashvalues: array of shape (num_perm,).
+    :return: float array of shape (N,).
+    """
+    return np.count_nonzero(signatures == hashvalues.astype(signatures.dtype), axis=1) / len(hashvalues)
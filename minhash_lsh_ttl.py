@@ -1,9 +1,18 @@
 import metrics3_docker.metrics as metrics
 from datasketch import MinHashLSH, MinHash
 from datetime import datetime, timedelta
+import gc
 import heapq
+import itertools
 import logging
+import sys
+from contextlib import contextmanager
+import numpy as np
 from consts import Consts
+from key_codec import KeyCodec
+from compact_lsh import key_bytes_matrix
+from minhash_kernel import jaccard_estimates
+from latency import timed
 
 logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
 logger = logging.getLogger()
@@ -11,8 +20,176 @@ logger = logging.getLogger()
 logging.getLogger('redis').setLevel(logging.WARNING)
 logging.getLogger('rediscluster').setLevel(logging.WARNING)
 
+# Approximate CPython sizes of a set entry and of an expiration heap entry (tuple, datetime and list slot)
+SET_ENTRY_BYTES = 32
+HEAP_ENTRY_BYTES = 128
+# Buckets per band table whose size is sampled for the stats
+BUCKET_SAMPLE_SIZE = 1000
+
+
+def bucket_size_label(size):
+    # power of two ranges: 1, 2, 3-4, 5-8, ...
+    if size <= 2:
+        return str(size)
+    upper = 1 << (size - 1).bit_length()
+    return f"{upper // 2 + 1}-{upper}"
+
+
+@contextmanager
+def gc_paused():
+    # the collector would scan the growing tables over and over while millions of sets are created
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def insert_into_tables(lsh, signature_store, keys, signatures, fingerprints=None):
+    """
+    Add the keys missing from lsh to its band tables and to signature_store. The band hashes of a whole band
+    are computed at once from the signature matrix and the tables are filled a band at a time.
+
+    :param signatures: hashvalues matrix of shape (len(keys), num_perm).
+    :param fingerprints: content_fingerprint of every key, 0 when unknown.
+    :return: dict of the inserted keys to their position in keys.
+    """
+    key_table = lsh.keys._dict
+    new_keys = {}
+    for i, key in enumerate(keys):
+        if key not in key_table and key not in new_keys:
+            new_keys[key] = i
+    if not new_keys:
+        return new_keys
+    rows = list(new_keys.values())
+    # datasketch hashes a band as the bytes of its byteswapped uint64 hashvalues
+    band_hashes = []
+    for start, end in lsh.hashranges:
+        band = np.ascontiguousarray(signatures[rows, start:end], dtype=">u8").tobytes()
+        width = (end - start) * 8
+        band_hashes.append([band[i:i + width] for i in range(0, len(band), width)])
+    with gc_paused():
+        for hashes, hashtable in zip(band_hashes, lsh.hashtables):
+            buckets = hashtable._dict
+            for H, key in zip(hashes, new_keys):
+                buckets[H].add(key)
+        for key, *Hs in zip(new_keys, *band_hashes):
+            key_table[key] = Hs
+        signature_store.add_many(list(new_keys), signatures[rows],
+                                 None if fingerprints is None else np.asarray(fingerprints, dtype=np.uint64)[rows])
+    return new_keys
+
+
+class SignatureStore:
+    """
+    Hashvalues of indexed signatures kept in one preallocated uint32 matrix (MinHash values fit in 32 bits),
+    one row per key. Rows of removed keys are reused and the matrix doubles when full.
+    Rows can also be found by the content fingerprint of their document.
+    """
+
+    def __init__(self, num_perm: int, capacity: int = 64):
+        self.matrix = np.zeros((capacity, num_perm), dtype=np.uint32)
+        self.rows = {}
+        self.free_rows = []
+        self.next_row = 0
+        self.fingerprint_rows = {}
+        self.row_fingerprints = {}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__.setdefault("fingerprint_rows", {})
+        self.__dict__.setdefault("row_fingerprints", {})
+
+    def reserve(self, count):
+        """
+        Grow the matrix at once to hold count more rows, at least doubling it.
+        """
+        missing = self.next_row + count - len(self.matrix)
+        if missing > 0:
+            missing = max(missing, len(self.matrix))
+            self.matrix = np.concatenate((self.matrix, np.zeros((missing, self.matrix.shape[1]), dtype=np.uint32)))
+
+    def add(self, key, hashvalues, fingerprint=None):
+        row = self.rows.get(key)
+        if row is None:
+            if self.free_rows:
+                row = self.free_rows.pop()
+            else:
+                row = self.next_row
+                self.next_row += 1
+                if row == len(self.matrix):
+                    self.matrix = np.concatenate((self.matrix, np.zeros_like(self.matrix)))
+            self.rows[key] = row
+        self.matrix[row] = hashvalues
+        if fingerprint is not None:
+            self._set_fingerprint(row, fingerprint)
+
+    def add_many(self, keys, hashvalues, fingerprints=None):
+        """
+        Add keys that are not stored yet, in consecutive rows after the last used one.
+
+        :param hashvalues: Matrix of shape (len(keys), num_perm).
+        :param fingerprints: Fingerprint of every key, 0 when unknown.
+        """
+        self.reserve(len(keys))
+        start = self.next_row
+        self.next_row += len(keys)
+        self.matrix[start:self.next_row] = hashvalues
+        self.rows.update(zip(keys, range(start, self.next_row)))
+        if fingerprints is not None:
+            for row, fingerprint in zip(range(start, self.next_row), fingerprints.tolist()):
+                if fingerprint:
+                    self._set_fingerprint(row, fingerprint)
+
+    def _set_fingerprint(self, row, fingerprint):
+        # the newest document with the content is the one that expires last
+        self._forget_fingerprint(row)
+        self._forget_fingerprint(self.fingerprint_rows.get(fingerprint))
+        self.fingerprint_rows[fingerprint] = row
+        self.row_fingerprints[row] = fingerprint
+
+    def _forget_fingerprint(self, row):
+        fingerprint = self.row_fingerprints.pop(row, None)
+        if fingerprint is not None:
+            del self.fingerprint_rows[fingerprint]
+
+    def remove(self, key):
+        row = self.rows.pop(key, None)
+        if row is not None:
+            self._forget_fingerprint(row)
+            self.free_rows.append(row)
+
+    def fingerprint_signature(self, fingerprint):
+        row = self.fingerprint_rows.get(fingerprint)
+        return None if row is None else self.matrix[row].copy()
+
+    def scores(self, keys, hashvalues):
+        """
+        Estimated Jaccard similarity of the stored signature of every key with hashvalues,
+        None for keys without a stored signature.
+        """
+        rows = [self.rows.get(key) for key in keys]
+        known = [i for i, row in enumerate(rows) if row is not None]
+        scores = [None] * len(keys)
+        if known:
+            estimates = jaccard_estimates(self.matrix[[rows[i] for i in known]], hashvalues)
+            for i, score in zip(known, estimates.tolist()):
+                scores[i] = score
+        return scores
+
+    def nbytes(self):
+        return (self.matrix.nbytes + sys.getsizeof(self.rows) + sys.getsizeof(self.free_rows)
+                + sys.getsizeof(self.fingerprint_rows) + sys.getsizeof(self.row_fingerprints))
+
 
 class MinHashLSHTTL:
+    # True when the index lives outside the process and must not be pickled
+    shared = False
+    # InsertJournal recording the inserts made since the last snapshot, None when not journaled
+    journal = None
+
     def __init__(self, threshold: float, num_perm: int, ttl: int = 24):
         """
         Initialize the MinHashLSH with TTL.
@@ -22,24 +199,213 @@ class MinHashLSHTTL:
         :param ttl: Time-to-live for each entry in hours (default is 24 hours).
         """
         self.lsh = MinHashLSH(threshold=threshold, num_perm=num_perm)
+        self.threshold = threshold
         self.ttl = ttl
         self.expiration_heap = []
+        self.key_codec = KeyCodec()
+        self.signatures = SignatureStore(num_perm)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("journal", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # snapshots saved before keys were encoded keep their string keys until they expire,
+        # and their keys without a stored signature are not verified
+        self.__dict__.setdefault("key_codec", KeyCodec())
+        self.__dict__.setdefault("threshold", 0.9)
+        self.__dict__.setdefault("signatures", SignatureStore(self.lsh.h))
 
-    def insert(self, key: str, minhash: MinHash):
+    def insert(self, key: str, minhash: MinHash, expire_time: datetime = None, fingerprint: int = None):
         # Insert the MinHash into the LSH
         self.lsh.insert(key, minhash)
+        self.signatures.add(key, minhash.hashvalues, fingerprint)
         # Set the expiration time for the key
-        expire_time = datetime.now() + timedelta(hours=self.ttl)
+        expire_time = expire_time or datetime.now() + timedelta(hours=self.ttl)
         heapq.heappush(self.expiration_heap, (expire_time, key))
+        if self.journal:
+            self.journal.append(key, minhash, expire_time, fingerprint)
+
+    def insert_batch(self, keys, minhashes):
+        """
+        Insert many keys expiring after the TTL from now with insert_bulk.
+        """
+        if keys:
+            expire_time = datetime.now() + timedelta(hours=self.ttl)
+            self.insert_bulk(keys, np.vstack([minhash.hashvalues for minhash in minhashes]),
+                             [expire_time] * len(keys))
+
+    def insert_bulk(self, keys, signatures, expire_times, fingerprints=None):
+        """
+        Insert many keys with their own expiration times, much faster than insert for large batches
+        (see insert_into_tables). Keys already indexed are skipped.
+
+        :param signatures: hashvalues matrix of shape (len(keys), num_perm).
+        :param expire_times: datetime of every key.
+        :param fingerprints: content_fingerprint of every key, 0 when unknown.
+        :return: Number of inserted keys.
+        """
+        with gc_paused():
+            new_keys = insert_into_tables(self.lsh, self.signatures, keys, signatures, fingerprints)
+            entries = [(expire_times[i], key) for key, i in new_keys.items()]
+            if len(entries) < len(self.expiration_heap):
+                for entry in entries:
+                    heapq.heappush(self.expiration_heap, entry)
+            else:
+                self.expiration_heap.extend(entries)
+                heapq.heapify(self.expiration_heap)
+        return len(entries)
 
     def query(self, minhash: MinHash):
         # Clean up expired keys before querying
-        self.cleanup_expired_keys()
+        with timed("cleanup_expired_keys"):
+            self.cleanup_expired_keys()
         # Query
-        return self.lsh.query(minhash)
+        with timed("lsh_query"):
+            return self.lsh.query(minhash)
+
+    def query_with_scores(self, minhash: MinHash):
+        """
+        Query the LSH and verify the candidates against their stored signatures.
+
+        :return: list of (key, estimated Jaccard similarity) of the candidates scoring at least the threshold,
+                 candidates without a stored signature are kept with a None score.
+        """
+        candidates = self.query(minhash)
+        with timed("verify_candidates"):
+            scores = self.signature_scores(candidates, minhash.hashvalues)
+        return [(key, score) for key, score in zip(candidates, scores) if score is None or score >= self.threshold]
+
+    def check_and_insert(self, key, minhash: MinHash, insert: bool = True, fingerprint: int = None):
+        """
+        Query the LSH and insert the key in one pass: the band hashes are computed once, the candidates are
+        collected from their buckets before the key is added to them and then verified like query_with_scores.
+
+        :param insert: False to only query.
+        :param fingerprint: content_fingerprint of the document, to find its signature with fingerprint_signature.
+        :return: list of (key, estimated Jaccard similarity) like query_with_scores, without the key itself,
+                 or None when the key is already indexed and insert is True.
+        """
+        with timed("cleanup_expired_keys"):
+            self.cleanup_expired_keys()
+        with timed("lsh_check_and_insert"):
+            lsh = self.lsh
+            if insert and key in lsh.keys:
+                return None
+            Hs = [lsh._H(minhash.hashvalues[start:end]) for start, end in lsh.hashranges]
+            candidates = set()
+            for H, hashtable in zip(Hs, lsh.hashtables):
+                candidates.update(hashtable.get(H))
+            candidates.discard(key)
+            candidates = list(candidates)
+            if insert:
+                lsh.keys.insert(key, *Hs)
+                for H, hashtable in zip(Hs, lsh.hashtables):
+                    hashtable.insert(H, key)
+                self.signatures.add(key, minhash.hashvalues, fingerprint)
+                expire_time = datetime.now() + timedelta(hours=self.ttl)
+                heapq.heappush(self.expiration_heap, (expire_time, key))
+                if self.journal:
+                    self.journal.append(key, minhash, expire_time, fingerprint)
+        with timed("verify_candidates"):
+            scores = self.signature_scores(candidates, minhash.hashvalues)
+        return [(candidate, score) for candidate, score in zip(candidates, scores)
+                if score is None or score >= self.threshold]
+
+    def signature_scores(self, keys, hashvalues):
+        return self.signatures.scores(keys, hashvalues)
+
+    def fingerprint_signature(self, fingerprint: int):
+        """
+        :return: the uint32 hashvalues of an indexed document with this content_fingerprint, None if there is none.
+        """
+        return self.signatures.fingerprint_signature(fingerprint)
+
+    def reserve(self, count: int):
+        """
+        Preallocate the signatures of count more keys.
+        """
+        self.signatures.reserve(count)
+
+    def snapshot_size(self):
+        # keys without a stored signature (from snapshots older than signature verification) are left out
+        return len(self.signatures.rows)
+
+    def snapshot_chunks(self, chunk_records: int):
+        """
+        :return: generator of (key bytes matrix, expiration timestamps, fingerprints, signatures) of up to
+                 chunk_records keys at a time, the snapshot_size keys with a stored signature in all.
+                 The index may change between two chunks: the keys are those of the expiration heap when the
+                 first chunk is taken, without the ones removed since.
+        """
+        entries = list(self.expiration_heap)
+        for start in range(0, len(entries), chunk_records):
+            chunk = [(expire_time, key) for expire_time, key in entries[start:start + chunk_records]
+                     if key in self.signatures.rows]
+            rows = [self.signatures.rows[key] for _, key in chunk]
+            yield (key_bytes_matrix([self.key_codec.decode(key) for _, key in chunk]),
+                   np.array([expire_time.timestamp() for expire_time, _ in chunk], dtype=np.float64),
+                   np.array([self.signatures.row_fingerprints.get(row, 0) for row in rows], dtype=np.uint64),
+                   self.signatures.matrix[rows])
+
+    def unsigned_expiration(self):
+        """
+        :return: Latest expiration timestamp of the keys without a stored signature, which snapshots leave out,
+                 None when every key has one.
+        """
+        if len(self.signatures.rows) >= self.size():
+            return None
+        expire_times = [expire_time for expire_time, key in self.expiration_heap if key not in self.signatures.rows]
+        return max(expire_times).timestamp() if expire_times else None
 
     def remove(self, key: str):
         self.lsh.remove(key)
+        self.signatures.remove(key)
+
+    def size(self):
+        return self.lsh.keys.size()
+
+    def expiration_size(self):
+        return len(self.expiration_heap)
+
+    def bucket_sizes(self, sample_size: int = BUCKET_SAMPLE_SIZE):
+        """
+        :return: (number of buckets of all band tables, sizes of up to sample_size buckets per table).
+        """
+        bucket_count = sum(table.size() for table in self.lsh.hashtables)
+        sizes = [len(bucket) for table in self.lsh.hashtables
+                 for bucket in itertools.islice(table._dict.values(), sample_size)]
+        return bucket_count, sizes
+
+    def bucket_stats(self):
+        bucket_count, sizes = self.bucket_sizes()
+        distribution = {}
+        for size in sorted(sizes):
+            label = bucket_size_label(size)
+            distribution[label] = distribution.get(label, 0) + 1
+        return {
+            "buckets": bucket_count,
+            "sampled": len(sizes),
+            "mean_size": round(sum(sizes) / len(sizes), 3) if sizes else None,
+            "max_size": max(sizes, default=None),
+            "size_distribution": distribution,
+        }
+
+    def estimated_bytes(self):
+        """
+        Rough in-process footprint of the index: per key its string, its list of band hashes,
+        one bucket set entry per band and its expiration heap entry, plus the signature matrix.
+        """
+        size = self.size()
+        if not size:
+            return 0
+        sample_key = next(iter(self.lsh.keys.keys()))
+        band_hash_bytes = sys.getsizeof(b"\0" * self.lsh.r * 8)
+        bytes_per_key = (sys.getsizeof(sample_key) + sys.getsizeof([None] * self.lsh.b)
+                         + self.lsh.b * (band_hash_bytes + SET_ENTRY_BYTES) + HEAP_ENTRY_BYTES)
+        return size * bytes_per_key + self.signatures.nbytes()
 
     def cleanup_expired_keys(self):
         """
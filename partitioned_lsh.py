@@ -0,0 +1,216 @@
+import math
+import time
+from datetime import datetime, timedelta
+import numpy as np
+import metrics3_docker.metrics as metrics
+from datasketch import MinHashLSH, MinHash
+from consts import Consts
+from key_codec import KeyCodec
+from compact_lsh import CompactBandIndex, band_hashes, key_bytes_matrix
+from minhash_lsh_ttl import MinHashLSHTTL, logger, BUCKET_SAMPLE_SIZE
+from latency import timed
+
+
+class LSHPartition(CompactBandIndex):
+    """
+    Keys expiring in one time window, dropped as a whole once it has passed.
+    """
+
+    def __init__(self, num_perm: int, hashranges, end_time: float):
+        """
+        :param end_time: Timestamp at which every key of the partition has expired.
+        """
+        super().__init__(num_perm, hashranges)
+        self.end_time = end_time
+
+    def size(self):
+        return self.live_rows
+
+
+class PartitionedMinHashLSHTTL(MinHashLSHTTL):
+    """
+    MinHashLSHTTL split into partitions of partition_hours by expiration time. Keys expire with their partition,
+    at most partition_hours after their TTL, and queries fan out across the partitions that have not expired yet.
+    Expired partitions are dropped at once by cleanup_expired_keys, which the server runs in the background
+    instead of before every query.
+    Partitions keep their keys in a CompactBandIndex rather than datasketch tables, and keys are KeyCodec integers.
+    """
+
+    def __init__(self, threshold: float, num_perm: int, ttl: int = 24,
+                 partition_hours: float = Consts.LSH_PARTITION_HOURS):
+        """
+        :param partition_hours: Width of the expiration window of a partition.
+        """
+        # holds no key, only the band parameters shared by every partition
+        self.lsh = MinHashLSH(threshold=threshold, num_perm=num_perm)
+        self.threshold = threshold
+        self.ttl = ttl
+        self.partition_seconds = partition_hours * 3600
+        self.partitions = {}
+        self.key_codec = KeyCodec()
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def partition(self, expire_time: float):
+        """
+        :return: the partition of the keys expiring at the expire_time timestamp, created if needed.
+        """
+        end_time = math.ceil(expire_time / self.partition_seconds) * self.partition_seconds
+        partition = self.partitions.get(end_time)
+        if partition is None:
+            partition = self.partitions[end_time] = LSHPartition(self.lsh.h, self.lsh.hashranges, end_time)
+        return partition
+
+    def live_partitions(self):
+        now = time.time()
+        return [partition for partition in self.partitions.values() if partition.end_time > now]
+
+    def indexed(self, key: int):
+        return any(key in partition for partition in self.live_partitions())
+
+    def insert(self, key, minhash: MinHash, expire_time: datetime = None, fingerprint: int = None):
+        if len(minhash) != self.lsh.h:
+            raise ValueError("Expecting minhash with length %d, got %d" % (self.lsh.h, len(minhash)))
+        key = self.key_codec.decode(key)
+        if self.indexed(key):
+            raise ValueError("The given key already exists")
+        expire_time = expire_time or datetime.now() + timedelta(hours=self.ttl)
+        self._insert(key, minhash, band_hashes(minhash.hashvalues[np.newaxis], self.lsh.hashranges)[0],
+                     expire_time, fingerprint)
+
+    def _insert(self, key, minhash, hashes, expire_time, fingerprint):
+        self.partition(expire_time.timestamp()).add(key, minhash.hashvalues, fingerprint, hashes)
+        if self.journal:
+            self.journal.append(key, minhash, expire_time, fingerprint)
+
+    def insert_bulk(self, keys, signatures, expire_times, fingerprints=None):
+        """
+        Like MinHashLSHTTL.insert_bulk, inserting the keys of every partition together with
+        CompactBandIndex.add_many.
+        """
+        keys = [self.key_codec.decode(key) for key in keys]
+        key_bytes = key_bytes_matrix(keys)
+        indexed = np.zeros(len(keys), dtype=bool)
+        for partition in self.live_partitions():
+            indexed |= partition.contains_many(key_bytes)
+        positions, batch_keys = {}, set()
+        for i, key in enumerate(keys):
+            if not indexed[i] and key not in batch_keys:
+                batch_keys.add(key)
+                positions.setdefault(self.partition(expire_times[i].timestamp()), []).append(i)
+        if fingerprints is not None:
+            fingerprints = np.asarray(fingerprints, dtype=np.uint64)
+        for partition, rows in positions.items():
+            partition.add_many(key_bytes[rows], signatures[rows], None if fingerprints is None else fingerprints[rows])
+        return len(batch_keys)
+
+    def query(self, minhash: MinHash):
+        with timed("lsh_query"):
+            hashes = band_hashes(minhash.hashvalues[np.newaxis], self.lsh.hashranges)[0]
+            return [partition.key(row) for partition in self.live_partitions() for row in partition.query_rows(hashes)]
+
+    def check_and_insert(self, key, minhash: MinHash, insert: bool = True, fingerprint: int = None):
+        """
+        Like MinHashLSHTTL.check_and_insert, reading the buckets of every live partition
+        and adding the key to the partition of its expiration time.
+        """
+        with timed("lsh_check_and_insert"):
+            key = self.key_codec.decode(key)
+            partitions = self.live_partitions()
+            if insert and any(key in partition for partition in partitions):
+                return None
+            hashes = band_hashes(minhash.hashvalues[np.newaxis], self.lsh.hashranges)[0]
+            candidates = [(partition, partition.query_rows(hashes)) for partition in partitions]
+        with timed("verify_candidates"):
+            scored_candidates = []
+            for partition, rows in candidates:
+                for row, score in zip(rows, partition.scores(rows, minhash.hashvalues)):
+                    if score >= self.threshold:
+                        candidate = partition.key(row)
+                        if candidate != key:
+                            scored_candidates.append((candidate, score))
+        if insert:
+            self._insert(key, minhash, hashes, datetime.now() + timedelta(hours=self.ttl), fingerprint)
+        return scored_candidates
+
+    def signature_scores(self, keys, hashvalues):
+        scores = [None] * len(keys)
+        for partition in self.live_partitions():
+            for i, key in enumerate(keys):
+                row = partition.find(self.key_codec.decode(key))
+                if row >= 0:
+                    scores[i] = partition.scores([row], hashvalues)[0]
+        return scores
+
+    def fingerprint_signature(self, fingerprint: int):
+        # the newest partition holds the document that expires last
+        for partition in sorted(self.live_partitions(), key=lambda partition: -partition.end_time):
+            row = partition.fingerprint_row(fingerprint)
+            if row >= 0:
+                return partition.signatures[row].copy()
+        return None
+
+    def reserve(self, count: int):
+        # the partitions of the keys are not known yet
+        pass
+
+    def snapshot_size(self):
+        return sum(partition.size() for partition in self.live_partitions())
+
+    def snapshot_chunks(self, chunk_records: int):
+        for partition in self.live_partitions():
+            for key_bytes, fingerprints, signatures in partition.live_records(chunk_records):
+                yield key_bytes, np.full(len(key_bytes), partition.end_time), fingerprints, signatures
+
+    def unsigned_expiration(self):
+        # partitions only hold keys with their signature
+        return None
+
+    def remove(self, key):
+        key = self.key_codec.decode(key)
+        for partition in self.partitions.values():
+            row = partition.find(key)
+            if row >= 0:
+                partition.remove_row(row)
+
+    def size(self):
+        return sum(partition.size() for partition in self.partitions.values())
+
+    def expiration_size(self):
+        # every key expires with its partition
+        return self.size()
+
+    def bucket_sizes(self, sample_size: int = BUCKET_SAMPLE_SIZE):
+        bucket_count, sizes = 0, []
+        for partition in self.partitions.values():
+            partition_buckets, partition_sizes = partition.bucket_sizes(sample_size)
+            bucket_count += partition_buckets
+            sizes += partition_sizes
+        return bucket_count, sizes
+
+    def estimated_bytes(self):
+        return sum(partition.nbytes() for partition in self.partitions.values())
+
+    def cleanup_expired_keys(self):
+        """
+        Drop the partitions whose keys have all expired, and compact the others once enough of their keys
+        were removed.
+        """
+        metrics.count(Consts.GET_EXPIRED_KEYS_TOTAL)
+        now = time.time()
+        for end_time in [end_time for end_time in self.partitions if end_time <= now]:
+            partition = self.partitions.pop(end_time)
+            metrics.count(Consts.TOTAL_EXPIRED_PARTITIONS)
+            logger.info(f"Dropped LSH partition expired at {datetime.fromtimestamp(end_time)} "
+                        f"({partition.size()} keys).")
+        for partition in self.partitions.values():
+            if partition.compact():
+                metrics.count(Consts.TOTAL_COMPACTED_PARTITIONS)
+
+
+# New in-memory LSH, partitioned by expiration time unless LSH_PARTITION_HOURS is 0
+def new_memory_lsh(threshold: float = 0.9, num_perm: int = 128, ttl: int = 24):
+    if Consts.LSH_PARTITION_HOURS:
+        return PartitionedMinHashLSHTTL(threshold=threshold, num_perm=num_perm, ttl=ttl)
+    return MinHashLSHTTL(threshold=threshold, num_perm=num_perm, ttl=ttl)
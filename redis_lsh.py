@@ -0,0 +1,271 @@
+import pickle
+import time
+import numpy as np
+import metrics3_docker.metrics as metrics
+from datasketch import MinHashLSH
+from consts import Consts
+from minhash_lsh_ttl import MinHashLSHTTL, logger, BUCKET_SAMPLE_SIZE
+from key_codec import RedisKeyCodec
+from minhash_kernel import jaccard_estimates
+from latency import timed
+
+# Maximum number of expired keys removed by a request, each one costs a few round trips
+REQUEST_CLEANUP_KEYS = 4
+# Maximum number of expired keys removed by a single cleanup_expired_keys
+CLEANUP_BATCH_SIZE = 1000
+
+
+class RedisMinHashLSH(MinHashLSH):
+    """
+    MinHashLSH over datasketch's Redis storage where every insert, query and remove
+    is sent as one pipeline instead of one round trip per band.
+    """
+
+    def __init__(self, threshold: float, num_perm: int, redis_config: dict, basename: bytes):
+        super().__init__(threshold=threshold, num_perm=num_perm,
+                         storage_config={"type": "redis", "basename": basename, "redis": redis_config})
+
+    @property
+    def redis(self):
+        return self.keys._redis
+
+    def band_hashes(self, minhash):
+        return [self._H(minhash.hashvalues[start:end]) for start, end in self.hashranges]
+
+    def _insert(self, key, minhash, check_duplication=True, buffer=False):
+        if len(minhash) != self.h:
+            raise ValueError("Expecting minhash with length %d, got %d" % (self.h, len(minhash)))
+        key = pickle.dumps(key)
+        key_entry = self.keys.redis_key(key)
+        # HSETNX claims the key atomically, so concurrent replicas cannot insert it twice
+        if check_duplication and not self.redis.hsetnx(self.keys._name, key, key_entry):
+            raise ValueError("The given key already exists")
+
+        pipe = self.redis.pipeline(transaction=False)
+        if not check_duplication:
+            pipe.hset(self.keys._name, key, key_entry)
+        self.queue_insert(pipe, key, self.band_hashes(minhash))
+        pipe.execute()
+
+    def queue_insert(self, pipe, pickled_key, Hs):
+        """
+        Queue the commands adding a claimed key to the buckets of its band hashes on pipe.
+        """
+        pipe.rpush(self.keys.redis_key(pickled_key), *Hs)
+        for H, hashtable in zip(Hs, self.hashtables):
+            pipe.hset(hashtable._name, H, hashtable.redis_key(H))
+            pipe.sadd(hashtable.redis_key(H), pickled_key)
+
+    def check_and_insert(self, key, minhash, insert=True, pipe=None):
+        """
+        Read the buckets of the minhash and add the key to them in one pipeline, the reads are queued first
+        so the key is not among the candidates. Commands queued on pipe by the caller are sent with it.
+
+        :return: the candidate keys, or None when the key is already indexed and insert is True.
+        """
+        if len(minhash) != self.h:
+            raise ValueError("Expecting minhash with length %d, got %d" % (self.h, len(minhash)))
+        pickled_key = pickle.dumps(key)
+        key_entry = self.keys.redis_key(pickled_key)
+        if insert and not self.redis.hsetnx(self.keys._name, pickled_key, key_entry):
+            return None
+
+        Hs = self.band_hashes(minhash)
+        if pipe is None:
+            pipe = self.redis.pipeline(transaction=False)
+        commands = len(pipe)
+        for H, hashtable in zip(Hs, self.hashtables):
+            pipe.smembers(hashtable.redis_key(H))
+        if insert:
+            self.queue_insert(pipe, pickled_key, Hs)
+        buckets = pipe.execute()[commands:commands + len(Hs)]
+        candidates = set().union(*buckets)
+        candidates.discard(pickled_key)
+        return [pickle.loads(candidate) for candidate in candidates]
+
+    def query(self, minhash):
+        if len(minhash) != self.h:
+            raise ValueError("Expecting minhash with length %d, got %d" % (self.h, len(minhash)))
+        pipe = self.redis.pipeline(transaction=False)
+        for H, hashtable in zip(self.band_hashes(minhash), self.hashtables):
+            pipe.smembers(hashtable.redis_key(H))
+        candidates = set().union(*pipe.execute())
+        return [pickle.loads(key) for key in candidates]
+
+    def remove(self, key):
+        key = pickle.dumps(key)
+        key_entry = self.keys.redis_key(key)
+        Hs = self.redis.lrange(key_entry, 0, -1)
+        if not Hs:
+            raise ValueError("The given key does not exist")
+
+        pipe = self.redis.pipeline(transaction=False)
+        for H, hashtable in zip(Hs, self.hashtables):
+            pipe.srem(hashtable.redis_key(H), key)
+        pipe.hdel(self.keys._name, key)
+        pipe.delete(key_entry)
+        for H, hashtable in zip(Hs, self.hashtables):
+            pipe.exists(hashtable.redis_key(H))
+        bucket_exists = pipe.execute()[-len(Hs):]
+
+        # drop the index entries of the buckets left empty
+        pipe = self.redis.pipeline(transaction=False)
+        for H, hashtable, exists in zip(Hs, self.hashtables, bucket_exists):
+            if not exists:
+                pipe.hdel(hashtable._name, H)
+        pipe.execute()
+
+
+class RedisMinHashLSHTTL(MinHashLSHTTL):
+    """
+    MinHashLSHTTL whose band tables, keys and expiration times live in Redis,
+    so several server replicas can share one index.
+    """
+    shared = True
+
+    def __init__(self, threshold: float, num_perm: int, ttl: int = 24, redis_config: dict = None,
+                 basename: bytes = b"lsh"):
+        """
+        :param redis_config: Keyword arguments of redis.Redis for the index database.
+        :param basename: Prefix of every Redis key of this index, one per language.
+        """
+        self.lsh = RedisMinHashLSH(threshold=threshold, num_perm=num_perm, redis_config=redis_config,
+                                   basename=basename)
+        self.threshold = threshold
+        self.ttl = ttl
+        self.expiration_key = basename + b"_expiration"
+        self.signatures_key = basename + b"_signatures"
+        self.fingerprint_prefix = basename + b"_fingerprint_"
+        self.key_codec = RedisKeyCodec(self.redis, basename)
+
+    @property
+    def redis(self):
+        return self.lsh.redis
+
+    def insert(self, key: str, minhash):
+        self.lsh.insert(key, minhash)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zadd(self.expiration_key, {key: time.time() + self.ttl * 3600})
+        pipe.hset(self.signatures_key, str(key), minhash.hashvalues.astype(np.uint32).tobytes())
+        pipe.execute()
+
+    def check_and_insert(self, key, minhash, insert=True, fingerprint=None):
+        """
+        Like MinHashLSHTTL.check_and_insert, with one HSETNX, one pipeline for the buckets, the expiration
+        and the signature, and one HMGET for the candidate signatures.
+        The signature of a fingerprint is stored under its own key, expiring with the TTL.
+        Only REQUEST_CLEANUP_KEYS expired keys are removed, the background cleanup removes the rest.
+        """
+        with timed("cleanup_expired_keys"):
+            self._cleanup()
+        with timed("lsh_check_and_insert"):
+            pipe = self.redis.pipeline(transaction=False)
+            if insert:
+                pipe.zadd(self.expiration_key, {key: time.time() + self.ttl * 3600})
+                signature = minhash.hashvalues.astype(np.uint32).tobytes()
+                pipe.hset(self.signatures_key, str(key), signature)
+                if fingerprint is not None:
+                    pipe.set(self.fingerprint_prefix + str(fingerprint).encode(), signature, ex=self.ttl * 3600)
+            candidates = self.lsh.check_and_insert(key, minhash, insert, pipe)
+            if candidates is None:
+                return None
+        with timed("verify_candidates"):
+            scores = self.signature_scores(candidates, minhash.hashvalues)
+        return [(candidate, score) for candidate, score in zip(candidates, scores)
+                if score is None or score >= self.threshold]
+
+    def query(self, minhash):
+        with timed("cleanup_expired_keys"):
+            self._cleanup()
+        with timed("lsh_query"):
+            return self.lsh.query(minhash)
+
+    def insert_bulk(self, keys, signatures, expire_times, fingerprints=None):
+        """
+        Like MinHashLSHTTL.insert_bulk, claiming the keys with one pipeline of HSETNX
+        and inserting the claimed ones with another.
+        """
+        lsh = self.lsh
+        pickled_keys = [pickle.dumps(key) for key in keys]
+        pipe = self.redis.pipeline(transaction=False)
+        for pickled_key in pickled_keys:
+            pipe.hsetnx(lsh.keys._name, pickled_key, lsh.keys.redis_key(pickled_key))
+        claimed = pipe.execute()
+        now = time.time()
+        for i, key in enumerate(keys):
+            if not claimed[i]:
+                continue
+            hashvalues = np.asarray(signatures[i], dtype=np.uint64)
+            lsh.queue_insert(pipe, pickled_keys[i], [lsh._H(hashvalues[start:end]) for start, end in lsh.hashranges])
+            expire_time = expire_times[i].timestamp()
+            pipe.zadd(self.expiration_key, {key: expire_time})
+            signature = hashvalues.astype(np.uint32).tobytes()
+            pipe.hset(self.signatures_key, str(key), signature)
+            if fingerprints is not None and fingerprints[i]:
+                pipe.set(self.fingerprint_prefix + str(fingerprints[i]).encode(), signature,
+                         ex=max(1, int(expire_time - now)))
+        pipe.execute()
+        return sum(1 for result in claimed if result)
+
+    def signature_scores(self, keys, hashvalues):
+        signatures = self.redis.hmget(self.signatures_key, [str(key) for key in keys]) if keys else []
+        known = [i for i, signature in enumerate(signatures) if signature]
+        scores = [None] * len(keys)
+        if known:
+            matrix = np.frombuffer(b"".join(signatures[i] for i in known), dtype=np.uint32).reshape(len(known), -1)
+            for i, score in zip(known, jaccard_estimates(matrix, hashvalues).tolist()):
+                scores[i] = score
+        return scores
+
+    def fingerprint_signature(self, fingerprint):
+        signature = self.redis.get(self.fingerprint_prefix + str(fingerprint).encode())
+        return None if signature is None else np.frombuffer(signature, dtype=np.uint32)
+
+    def remove(self, key):
+        self.lsh.remove(key)
+        self.redis.hdel(self.signatures_key, str(key))
+
+    def expiration_size(self):
+        return self.redis.zcard(self.expiration_key)
+
+    def bucket_sizes(self, sample_size: int = BUCKET_SAMPLE_SIZE):
+        pipe = self.redis.pipeline(transaction=False)
+        for hashtable in self.lsh.hashtables:
+            pipe.hlen(hashtable._name)
+        bucket_count = sum(pipe.execute())
+        for hashtable in self.lsh.hashtables:
+            _, buckets = self.redis.hscan(hashtable._name, count=sample_size)
+            for bucket_key in list(buckets.values())[:sample_size]:
+                pipe.scard(bucket_key)
+        return bucket_count, pipe.execute()
+
+    def estimated_bytes(self):
+        # everything lives in Redis
+        return 0
+
+    def _cleanup(self, limit=REQUEST_CLEANUP_KEYS):
+        """
+        Remove up to limit expired keys, the oldest first.
+        """
+        metrics.count(Consts.GET_EXPIRED_KEYS_TOTAL)
+        expired_keys = self.redis.zrangebyscore(self.expiration_key, "-inf", time.time(), start=0, num=limit)
+        for key in expired_keys:
+            # only the replica that wins the ZREM removes the key
+            if not self.redis.zrem(self.expiration_key, key):
+                continue
+            try:
+                metrics.count(Consts.MINHASH_LSH_TTL_EXPIRED_KEYS_TOTAL)
+                key = key.decode()
+                # encoded keys are stored as their decimal form, older keys as "article_id|domain"
+                self.remove(int(key) if key.isdigit() else key)
+            except ValueError:
+                pass
+            except Exception as e:
+                logger.error(f"Error cleaning up expired keys: {e}")
+                break
+
+    def cleanup_expired_keys(self):
+        """
+        Clean up expired keys from the LSH, at most CLEANUP_BATCH_SIZE per call.
+        """
+        self._cleanup(CLEANUP_BATCH_SIZE)
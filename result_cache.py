@@ -0,0 +1,64 @@
+import threading
+import time
+from collections import OrderedDict
+import metrics3_docker.metrics as metrics
+from consts import Consts
+
+
+class ResultCache:
+    """
+    Bounded LRU cache of the check results of inserted documents by article_id, so a retried request gets the
+    verdict of its first attempt instead of duplicate_keys. Entries expire ttl_seconds after they are stored.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: int):
+        """
+        :param max_size: Maximum number of results, the least recently used are dropped beyond it. 0 disables the cache.
+        :param ttl_seconds: Time during which a result answers the retries of its document.
+        """
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, article_id):
+        """
+        :return: the cached result of the document, None when there is none.
+        """
+        if article_id is None or not self.max_size:
+            return None
+        with self.lock:
+            entry = self.entries.get(article_id)
+            if entry is not None and entry[0] < time.time():
+                del self.entries[article_id]
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.entries.move_to_end(article_id)
+                self.hits += 1
+        metrics.count(Consts.TOTAL_RESULT_CACHE_MISSES if entry is None else Consts.TOTAL_RESULT_CACHE_HITS)
+        return None if entry is None else entry[1]
+
+    def put(self, article_id, result):
+        if article_id is None or not self.max_size:
+            return
+        with self.lock:
+            self.entries[article_id] = (time.time() + self.ttl_seconds, result)
+            self.entries.move_to_end(article_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
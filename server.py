@@ -1,11 +1,15 @@
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import JSONResponse
 from utils import *
+from lsh_cache_manager import LSHCacheManager
+from latency import timed, record, call_captured, latency_stats
 import asyncio
 import uvicorn
 from contextlib import asynccontextmanager
 import logging
 import signal
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
 logger = logging.getLogger()
@@ -13,6 +17,14 @@ logger = logging.getLogger()
 ADDRESS = "0.0.0.0"
 PORT = 9039
 lsh_cache_dict = {}
+hash_executor = None
+index_executor = None
+# Recovery tasks of the languages whose index is being rebuilt by /recover
+recovering = {}
+# Loading tasks of the languages whose index is being created or loaded from its snapshot
+loading = {}
+# Checkpoint saves in progress, which need the writer until their copies are taken
+checkpoint_saves = set()
 
 
 class GracefulShutdown:
@@ -34,24 +46,133 @@ class GracefulShutdown:
         await self.shutdown_event.wait()
 
 
+def create_executors(mode, workers):
+    """
+    Create the executors for the CPU-bound work of a request.
+
+    Tokenization and MinHash run in a pool of `workers` processes (or threads), while every LSH insert and
+    query goes through a single writer thread so the shared lsh_cache_dict is never mutated concurrently.
+    In "inline" mode everything runs on the event loop.
+
+    :return: (hash_executor, index_executor), both None in "inline" mode.
+    """
+    if mode == "inline":
+        return None, None
+    if mode == "process":
+        # spawn so workers don't inherit the index or the loop's signal handlers
+        hash_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    elif mode == "thread":
+        hash_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hash")
+    else:
+        raise ValueError(f"Unknown execution mode: {mode}")
+    return hash_pool, ThreadPoolExecutor(max_workers=1, thread_name_prefix="lsh-writer")
+
+
+async def run_hashing(func, *args):
+    if hash_executor is None:
+        return func(*args)
+    # stage durations observed in a worker are recorded here
+    result, observations = await asyncio.get_running_loop().run_in_executor(hash_executor, call_captured, func, *args)
+    record(observations)
+    return result
+
+
+async def run_index(func, *args):
+    if index_executor is None:
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(index_executor, func, *args)
+
+
+async def save_off_writer(copies):
+    """
+    Take the checkpoint copies and save them on a thread of the default executor. The copies are taken a chunk
+    at a time on the writer, which serves the requests queued between two chunks.
+    """
+    loop = asyncio.get_running_loop()
+
+    def on_writer(func):
+        return asyncio.run_coroutine_threadsafe(run_index(func), loop).result()
+
+    saving = loop.run_in_executor(None, save_checkpoints, copies, on_writer)
+    checkpoint_saves.add(saving)
+    saving.add_done_callback(checkpoint_saves.discard)
+    # a cancelled task leaves the save running, shutdown waits for it
+    return await asyncio.shield(saving)
+
+
+async def evict_idle_indexes():
+    while True:
+        await asyncio.sleep(Consts.LSH_EVICTION_INTERVAL_SECONDS)
+        try:
+            saved_at, copies = await run_index(spill_copies, lsh_cache_dict)
+            if copies and await save_off_writer(copies):
+                await run_index(evict_spilled, lsh_cache_dict, copies, saved_at)
+        except Exception as e:
+            logger.error(f"Failed to evict idle LSH indexes: {e}")
+
+
+async def flush_journals_periodically():
+    while True:
+        await asyncio.sleep(Consts.JOURNAL_FLUSH_INTERVAL_SECONDS)
+        try:
+            await run_index(flush_journals, lsh_cache_dict)
+        except Exception as e:
+            logger.error(f"Failed to flush LSH journals: {e}")
+
+
+async def checkpoint_indexes():
+    while True:
+        await asyncio.sleep(Consts.LSH_CHECKPOINT_INTERVAL_SECONDS)
+        try:
+            with timed("checkpoint"):
+                await save_off_writer(await run_index(checkpoint_copies, lsh_cache_dict))
+        except Exception as e:
+            logger.error(f"Failed to checkpoint LSH indexes: {e}")
+
+
+async def expire_indexes_periodically():
+    while True:
+        await asyncio.sleep(Consts.LSH_EXPIRY_INTERVAL_SECONDS)
+        try:
+            await run_index(expire_indexes, lsh_cache_dict)
+        except Exception as e:
+            logger.error(f"Failed to expire LSH indexes: {e}")
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global lsh_cache_dict
+    global lsh_cache_dict, hash_executor, index_executor
 
     graceful_shutdown = GracefulShutdown()
     graceful_shutdown.__enter__()
 
     logger.info("Starting up...")
-    lsh_cache_dict = {
-        "english": get_lsh_from_redis(lsh_key="english:lsh_index"),
-        # add more languages if necessary
-    }
+    # indexes of other languages are created on first use
+    lsh_cache_dict = LSHCacheManager(loader=get_lsh, saver=save_lsh_to_redis,
+                                     memory_budget_mb=Consts.LSH_MEMORY_BUDGET_MB, idle_seconds=Consts.LSH_IDLE_SECONDS)
+    for language in Consts.RECOVERY_LANGUAGES:
+        lsh_cache_dict.get(language)
     logger.info("Initialized LSH cache with TTL for supported languages.")
+    hash_executor, index_executor = create_executors(Consts.EXECUTION_MODE, Consts.HASH_WORKERS)
+    logger.info(f"Execution mode: {Consts.EXECUTION_MODE} with {Consts.HASH_WORKERS} hashing workers.")
+    eviction_task = asyncio.create_task(evict_idle_indexes())
+    expiry_task = asyncio.create_task(expire_indexes_periodically())
+    journal_tasks = [asyncio.create_task(flush_journals_periodically()), asyncio.create_task(checkpoint_indexes())]
 
     yield  # Control is returned to FastAPI here
 
     logger.info("Shutting down...")
     await graceful_shutdown.wait()  # Wait for the shutdown signal
+    eviction_task.cancel()
+    expiry_task.cancel()
+    for task in journal_tasks:
+        task.cancel()
+    await asyncio.gather(*checkpoint_saves, return_exceptions=True)
+    if index_executor:
+        # let in-flight index writes finish before the snapshot is taken
+        index_executor.shutdown(wait=True)
+    if hash_executor:
+        hash_executor.shutdown(wait=False, cancel_futures=True)
     save_lsh_to_redis(lsh_cache_dict)
     logger.info("Saved LSH cache to Redis.")
 
@@ -61,27 +182,132 @@ async def lifespan(app: FastAPI):
 app = FastAPI(lifespan=lifespan)
 
 
+async def run_check(documents, indexes):
+    """
+    Run check_documents, its hashing stages on the hashing workers and its index stages on the writer thread.
+    """
+    stages = check_documents(documents, indexes, Consts.HASH_WORKERS)
+    results = None
+    while True:
+        try:
+            stage, calls = stages.send(results)
+        except StopIteration as stop:
+            return stop.value
+        run = run_hashing if stage == HASHING_STAGE else run_index
+        results = await asyncio.gather(*[run(func, *args) for func, args in calls])
+
+
+async def load_index(language):
+    try:
+        # snapshots are loaded and journals replayed outside the writer, which only swaps the index in
+        lsh_with_ttl = await asyncio.get_running_loop().run_in_executor(None, lsh_cache_dict.loader, language)
+        if lsh_with_ttl is not None:
+            await run_index(lsh_cache_dict.put, language, lsh_with_ttl)
+        return lsh_with_ttl
+    finally:
+        loading.pop(language, None)
+
+
+async def get_index(language):
+    """
+    :return: index of the language, loaded on first use, None for unsupported languages.
+    """
+    lsh_with_ttl = await run_index(lsh_cache_dict.get, language, None, False)
+    if lsh_with_ttl is not None or not lsh_cache_dict.supports(language):
+        return lsh_with_ttl
+    if language not in loading:
+        logger.info(f"Creating LSH index for {language}")
+        loading[language] = asyncio.create_task(load_index(language))
+    # a cancelled request must not cancel a load other requests wait for
+    return await asyncio.shield(loading[language])
+
+
+async def get_indexes(documents):
+    """
+    :return: dict of the language of every document to its index, None for unsupported languages.
+    """
+    languages = list({doc.get('language') for doc in documents})
+    return dict(zip(languages, await asyncio.gather(*[get_index(language) for language in languages])))
+
+
 @app.post("/is_duplicate")
 async def is_duplicate(request: Request):
     global lsh_cache_dict
     try:
-        json_data = await request.json()
-        language = json_data.get('language')
-        lsh_cache = lsh_cache_dict.get(language)
-        status = run_lsh_check(content=json_data.get('content'), language=language, lsh_cache=lsh_cache,
-                               article_domain=json_data.get('domain'), article_id=json_data.get('article_id'))
-        return JSONResponse(content={"status": status})
-    except ValueError as e:
-        return JSONResponse(content={"status": "duplicate_keys"})
+        with timed("is_duplicate"):
+            json_data = await request.json()
+            result = (await run_check([json_data], await get_indexes([json_data])))[0]
+        return JSONResponse(content=result)
+    except Exception as e:
+        logger.critical(f"Internal Server Error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
+
+
+@app.post("/is_duplicate_batch")
+async def is_duplicate_batch(request: Request):
+    global lsh_cache_dict
+    try:
+        with timed("is_duplicate_batch"):
+            json_data = await request.json()
+            documents = json_data.get('documents', [])
+            results = await run_check(documents, await get_indexes(documents))
+        return JSONResponse(content={"statuses": [result["status"] for result in results], "results": results})
     except Exception as e:
         logger.critical(f"Internal Server Error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
 
+async def recover_language(language):
+    """
+    Rebuild the index of a language from Elasticsearch while requests keep being served by the current one,
+    then swap it in. Shared indexes are recovered in place, concurrently with the requests: their operations
+    are atomic in Redis or hold the lock of the shared memory index.
+    """
+    try:
+        lsh_with_ttl = await get_index(language)
+        # recovery runs its own process pool, so it only needs a thread here
+        recovered = await asyncio.get_running_loop().run_in_executor(None, recover_lsh, lsh_with_ttl, language)
+        await run_index(replace_lsh, lsh_cache_dict, language, recovered)
+        logger.info(f"Recovered LSH index for {language}")
+    except Exception as e:
+        logger.critical(f"Failed to recover LSH index for {language}: {e}")
+    finally:
+        recovering.pop(language, None)
+
+
+@app.post('/recover')
+async def recover_endpoint(request: Request):
+    if not Consts.RECOVER_ENDPOINT:
+        raise HTTPException(status_code=404, detail="Not Found")
+    json_data = await request.json()
+    language = json_data.get('language', 'english')
+    if language not in Consts.RECOVERY_LANGUAGES:
+        raise HTTPException(status_code=400, detail=f"Recovery is not supported for {language}")
+    if language in recovering:
+        return {"status": "running"}
+    recovering[language] = asyncio.create_task(recover_language(language))
+    return {"status": "started"}
+
+
+@app.get('/stats')
+async def stats_endpoint():
+    stats = await run_index(lsh_cache_dict.stats)
+    stats["recovering"] = sorted(recovering)
+    stats["last_recovery"] = last_recovery or None
+    stats["result_cache"] = result_cache.stats()
+    stats["latency"] = latency_stats()
+    return stats
+
+
 @app.get('/health_check')
 async def health_endpoint():
     return {"message": "I'm OK"}
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host=ADDRESS, port=PORT)
+    if Consts.SERVER_WORKERS > 1:
+        if Consts.LSH_STORAGE == "memory":
+            raise ValueError("SERVER_WORKERS > 1 needs LSH_STORAGE shm or redis, every worker would have its own index")
+        uvicorn.run("server:app", host=ADDRESS, port=PORT, workers=Consts.SERVER_WORKERS)
+    else:
+        uvicorn.run(app, host=ADDRESS, port=PORT)
@@ -0,0 +1,360 @@
+import fcntl
+import mmap
+import os
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+import numpy as np
+import metrics3_docker.metrics as metrics
+from datasketch import MinHashLSH
+from consts import Consts
+from key_codec import FileKeyCodec, KEY_BYTES
+from minhash_kernel import jaccard_estimates, lean_minhashes
+from minhash_lsh_ttl import MinHashLSHTTL, logger, BUCKET_SAMPLE_SIZE
+
+MAGIC = b"DSLSHv02"
+# magic, capacity, num_perm, bands, rows per band, table size
+HEADER_FIELDS = 6
+# cursor (rows ever inserted), tail (oldest row still linked), live keys
+STATE_FIELDS = 3
+# Maximum number of expired rows unlinked by a request, more than the row it inserts so the cleanup keeps up
+REQUEST_CLEANUP_ROWS = 16
+# Maximum number of expired rows unlinked by a single cleanup_expired_keys
+CLEANUP_BATCH_SIZE = 1000
+
+
+def _aligned(offset):
+    return (offset + 7) // 8 * 8
+
+
+class SharedMemoryLSHTTL(MinHashLSHTTL):
+    """
+    MinHashLSHTTL held in a memory-mapped file (on /dev/shm by default), so every worker process on a host
+    serves the same index.
+
+    Rows are allocated as a ring in insertion order. A row holds the signature (uint32 hashvalues), the
+    encoded key and the expiration time. Recovered documents expire from their crawl time, so a row can
+    expire before rows inserted ahead of it: the cleanup unlinks expired rows from the oldest one and stops
+    at the first live row, and every lookup checks the expiration of the rows it visits, so expired rows
+    still linked behind a live one are never returned.
+
+    Every band has a chained hash table over the band values of the signature matrix, keys have one for
+    duplicate checks and content fingerprints one for fingerprint_signature. Chains store row + 1 so a
+    zero-filled file is an empty index and untouched pages stay unallocated.
+    Every operation holds an exclusive flock on the index, and a thread lock since the flock of one file is
+    shared by the threads of a process, while tokenization and MinHash, most of the work of a request, run
+    concurrently in the workers.
+    """
+    shared = True
+
+    def __init__(self, path: str, threshold: float, num_perm: int, ttl: int = 24,
+                 capacity: int = Consts.SHARED_INDEX_CAPACITY):
+        """
+        :param path: File of the index, created on first use and reused by the other workers and restarts.
+                     Its domain table is kept next to it, in path + ".domains".
+        :param capacity: Maximum number of keys, the oldest keys are dropped when it is reached.
+        """
+        lsh = MinHashLSH(threshold=threshold, num_perm=num_perm)
+        self.bands, self.band_rows, self.hashranges = lsh.b, lsh.r, lsh.hashranges
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.ttl = ttl
+        self.capacity = capacity
+        self.table_size = 2 * capacity
+        self.path = path
+        self.key_codec = FileKeyCodec(path + ".domains")
+        self.lock_file = open(path + ".lock", "a+")
+        self.thread_lock = threading.Lock()
+        self.created = self._map()
+
+    def _layout(self):
+        shapes = [
+            ("header", np.int64, (HEADER_FIELDS,)),
+            ("state", np.int64, (STATE_FIELDS,)),
+            ("signatures", np.uint32, (self.capacity, self.num_perm)),
+            ("keys", np.uint8, (self.capacity, KEY_BYTES)),
+            ("expirations", np.float64, (self.capacity,)),
+            ("band_next", np.int32, (self.capacity, self.bands)),
+            ("key_next", np.int32, (self.capacity,)),
+            ("fingerprints", np.uint64, (self.capacity,)),
+            ("fingerprint_next", np.int32, (self.capacity,)),
+            ("band_heads", np.int32, (self.bands, self.table_size)),
+            ("key_heads", np.int32, (self.table_size,)),
+            ("fingerprint_heads", np.int32, (self.table_size,)),
+        ]
+        offset, layout = 0, []
+        for name, dtype, shape in shapes:
+            layout.append((name, dtype, shape, offset))
+            offset = _aligned(offset + int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        return layout, offset
+
+    def _header(self):
+        return [int.from_bytes(MAGIC, 'little'), self.capacity, self.num_perm, self.bands, self.band_rows,
+                self.table_size]
+
+    def _map(self):
+        """
+        Map the index file, creating it when it is missing or was created with other parameters.
+
+        :return: True when the file was created.
+        """
+        layout, total_size = self._layout()
+        created = False
+        with self._locked():
+            if not self._is_compatible(total_size):
+                if os.path.exists(self.path):
+                    logger.error(f"Shared LSH index {self.path} has other parameters, recreating it")
+                    os.unlink(self.path)
+                with open(self.path, "w+b") as f:
+                    f.truncate(total_size)
+                created = True
+            with open(self.path, "r+b") as f:
+                self.mmap = mmap.mmap(f.fileno(), total_size)
+            for name, dtype, shape, offset in layout:
+                setattr(self, name, np.ndarray(shape, dtype=dtype, buffer=self.mmap, offset=offset))
+            if created:
+                self.header[:] = self._header()
+                self.key_codec.clear()
+        return created
+
+    def _is_compatible(self, total_size):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) != total_size:
+            return False
+        with open(self.path, "rb") as f:
+            header = np.frombuffer(f.read(HEADER_FIELDS * 8), dtype=np.int64)
+        return header.tolist() == self._header()
+
+    @contextmanager
+    def _locked(self):
+        with self.thread_lock:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def _band_slots(self, hashvalues):
+        return [zlib.crc32(hashvalues[start:end].tobytes()) % self.table_size for start, end in self.hashranges]
+
+    def _find_key(self, key_bytes):
+        now = time.time()
+        row = self.key_heads[zlib.crc32(key_bytes) % self.table_size] - 1
+        while row >= 0:
+            if self.expirations[row] > now and self.keys[row].tobytes() == key_bytes:
+                return row
+            row = self.key_next[row] - 1
+        return -1
+
+    def _unlink_chain(self, heads, slot, next_rows, row):
+        previous, current = -1, heads[slot] - 1
+        while current >= 0 and current != row:
+            previous, current = current, next_rows[current] - 1
+        if current < 0:
+            return
+        if previous < 0:
+            heads[slot] = next_rows[row]
+        else:
+            next_rows[previous] = next_rows[row]
+        next_rows[row] = 0
+
+    def _unlink(self, row):
+        for band, slot in enumerate(self._band_slots(self.signatures[row])):
+            self._unlink_chain(self.band_heads[band], slot, self.band_next[:, band], row)
+        self._unlink_chain(self.key_heads, zlib.crc32(self.keys[row].tobytes()) % self.table_size,
+                           self.key_next, row)
+        if self.fingerprints[row]:
+            self._unlink_chain(self.fingerprint_heads, int(self.fingerprints[row]) % self.table_size,
+                               self.fingerprint_next, row)
+            self.fingerprints[row] = 0
+        if self.expirations[row]:
+            self.state[2] -= 1
+            self.expirations[row] = 0
+
+    def _insert(self, key, minhash, expire_time, slots=None, fingerprint=None):
+        key_bytes = self.key_codec.decode(key).to_bytes(KEY_BYTES, 'little')
+        if self._find_key(key_bytes) >= 0:
+            raise ValueError("The given key already exists")
+        hashvalues = minhash.hashvalues.astype(np.uint32)
+        slots = slots or self._band_slots(hashvalues)
+        cursor, tail, _ = self.state
+        if cursor - tail >= self.capacity:
+            # full, drop the oldest key
+            metrics.count(Consts.MINHASH_LSH_TTL_EXPIRED_KEYS_TOTAL)
+            self._unlink(tail % self.capacity)
+            self.state[1] += 1
+        row = cursor % self.capacity
+        self.signatures[row] = hashvalues
+        self.keys[row] = np.frombuffer(key_bytes, dtype=np.uint8)
+        self.expirations[row] = expire_time
+        # the row is written before it is linked
+        for band, slot in enumerate(slots):
+            self.band_next[row, band] = self.band_heads[band, slot]
+            self.band_heads[band, slot] = row + 1
+        slot = zlib.crc32(key_bytes) % self.table_size
+        self.key_next[row] = self.key_heads[slot]
+        self.key_heads[slot] = row + 1
+        if fingerprint:
+            slot = fingerprint % self.table_size
+            self.fingerprints[row] = fingerprint
+            self.fingerprint_next[row] = self.fingerprint_heads[slot]
+            self.fingerprint_heads[slot] = row + 1
+        self.state[0] += 1
+        self.state[2] += 1
+
+    def _cleanup(self, limit=REQUEST_CLEANUP_ROWS):
+        """
+        Unlink up to limit expired rows from the oldest one.
+
+        :return: Number of unlinked rows.
+        """
+        metrics.count(Consts.GET_EXPIRED_KEYS_TOTAL)
+        now = time.time()
+        unlinked = 0
+        while self.state[1] < self.state[0] and unlinked < limit:
+            row = self.state[1] % self.capacity
+            if self.expirations[row] >= now:
+                break
+            if self.expirations[row]:
+                metrics.count(Consts.MINHASH_LSH_TTL_EXPIRED_KEYS_TOTAL)
+            self._unlink(row)
+            self.state[1] += 1
+            unlinked += 1
+        return unlinked
+
+    def _query_rows(self, hashvalues, slots=None):
+        now = time.time()
+        rows = set()
+        for band, ((start, end), slot) in enumerate(zip(self.hashranges, slots or self._band_slots(hashvalues))):
+            band_values = hashvalues[start:end]
+            row = self.band_heads[band, slot] - 1
+            while row >= 0:
+                if self.expirations[row] > now and np.array_equal(self.signatures[row, start:end], band_values):
+                    rows.add(row)
+                row = self.band_next[row, band] - 1
+        return sorted(rows)
+
+    def _key(self, row):
+        return int.from_bytes(self.keys[row].tobytes(), 'little')
+
+    def insert(self, key, minhash):
+        with self._locked():
+            self._insert(key, minhash, time.time() + self.ttl * 3600)
+
+    def insert_batch(self, keys, minhashes):
+        expire_time = time.time() + self.ttl * 3600
+        with self._locked():
+            for key, minhash in zip(keys, minhashes):
+                try:
+                    self._insert(key, minhash, expire_time)
+                except ValueError:
+                    pass
+
+    def insert_bulk(self, keys, signatures, expire_times, fingerprints=None):
+        """
+        Insert many keys with their own expiration times under one lock, in expiration order within the batch.
+
+        :return: Number of inserted keys.
+        """
+        order = sorted(range(len(keys)), key=lambda i: expire_times[i])
+        minhashes = lean_minhashes(np.asarray(signatures, dtype=np.uint64)[order])
+        inserted = 0
+        with self._locked():
+            for i, minhash in zip(order, minhashes):
+                try:
+                    self._insert(keys[i], minhash, expire_times[i].timestamp(),
+                                 fingerprint=int(fingerprints[i]) if fingerprints is not None else None)
+                    inserted += 1
+                except ValueError:
+                    pass
+        return inserted
+
+    def query(self, minhash):
+        with self._locked():
+            self._cleanup()
+            return [self._key(row) for row in self._query_rows(minhash.hashvalues.astype(np.uint32))]
+
+    def query_with_scores(self, minhash):
+        hashvalues = minhash.hashvalues.astype(np.uint32)
+        with self._locked():
+            self._cleanup()
+            return self._scored_rows(self._query_rows(hashvalues), hashvalues)
+
+    def _scored_rows(self, rows, hashvalues):
+        scores = jaccard_estimates(self.signatures[rows], hashvalues).tolist() if rows else []
+        return [(self._key(row), score) for row, score in zip(rows, scores) if score >= self.threshold]
+
+    def check_and_insert(self, key, minhash, insert=True, fingerprint=None):
+        """
+        Like MinHashLSHTTL.check_and_insert, under a single lock.
+        """
+        hashvalues = minhash.hashvalues.astype(np.uint32)
+        slots = self._band_slots(hashvalues)
+        with self._locked():
+            self._cleanup()
+            key_bytes = self.key_codec.decode(key).to_bytes(KEY_BYTES, 'little')
+            if insert and self._find_key(key_bytes) >= 0:
+                return None
+            rows = [row for row in self._query_rows(hashvalues, slots) if self.keys[row].tobytes() != key_bytes]
+            scored_rows = self._scored_rows(rows, hashvalues)
+            if insert:
+                self._insert(key, minhash, time.time() + self.ttl * 3600, slots, fingerprint)
+            return scored_rows
+
+    def signature_scores(self, keys, hashvalues):
+        with self._locked():
+            rows = [self._find_key(self.key_codec.decode(key).to_bytes(KEY_BYTES, 'little')) for key in keys]
+            return [float(jaccard_estimates(self.signatures[[row]], hashvalues)[0]) if row >= 0 else None
+                    for row in rows]
+
+    def fingerprint_signature(self, fingerprint):
+        now = time.time()
+        with self._locked():
+            row = self.fingerprint_heads[fingerprint % self.table_size] - 1
+            while row >= 0:
+                if int(self.fingerprints[row]) == fingerprint and self.expirations[row] > now:
+                    return self.signatures[row].copy()
+                row = self.fingerprint_next[row] - 1
+        return None
+
+    def remove(self, key):
+        with self._locked():
+            row = self._find_key(self.key_codec.decode(key).to_bytes(KEY_BYTES, 'little'))
+            if row < 0:
+                raise ValueError("The given key does not exist")
+            # the row stays linked until the cleanup reaches it, queries skip it meanwhile
+            self.expirations[row] = 0
+            self.state[2] -= 1
+
+    def cleanup_expired_keys(self):
+        """
+        Clean up expired keys from the LSH, at most CLEANUP_BATCH_SIZE per call.
+        """
+        with self._locked():
+            self._cleanup(CLEANUP_BATCH_SIZE)
+
+    def size(self):
+        return int(self.state[2])
+
+    def expiration_size(self):
+        return int(self.state[0] - self.state[1])
+
+    def bucket_sizes(self, sample_size: int = BUCKET_SAMPLE_SIZE):
+        with self._locked():
+            bucket_count = int(np.count_nonzero(self.band_heads))
+            sizes = []
+            for band in range(self.bands):
+                for head in self.band_heads[band][np.flatnonzero(self.band_heads[band])[:sample_size]]:
+                    size, row = 0, head - 1
+                    while row >= 0:
+                        size += 1
+                        row = self.band_next[row, band] - 1
+                    sizes.append(size)
+        return bucket_count, sizes
+
+    def estimated_bytes(self):
+        # the index is shared by the workers, outside of any process' budget
+        return 0
+
+    def __getstate__(self):
+        raise TypeError("A shared memory LSH index can not be pickled")
@@ -0,0 +1,278 @@
+import json
+import os
+import tempfile
+import time
+from datetime import datetime
+import numpy as np
+from consts import Consts
+from key_codec import KeyCodec, KEY_BYTES
+from minhash_lsh_ttl import logger
+from partitioned_lsh import new_memory_lsh
+
+MAGIC = b"LSHSNAP1"
+VERSION = 1
+# Records converted to or from the index at a time
+CHUNK_RECORDS = 65536
+
+
+def record_dtype(num_perm):
+    """
+    One fixed-size record per key, so a snapshot can be read in any number of records at a time.
+    Band tables are not stored, they are rebuilt from the signatures a band at a time.
+    """
+    return np.dtype([("key", np.uint8, (KEY_BYTES,)), ("expire_time", "<f8"), ("fingerprint", "<u8"),
+                     ("signature", "<u4", (num_perm,))])
+
+
+def index_header(lsh_with_ttl):
+    return {
+        "num_perm": lsh_with_ttl.lsh.h,
+        "threshold": lsh_with_ttl.threshold,
+        "ttl": lsh_with_ttl.ttl,
+        "domains": list(lsh_with_ttl.key_codec.domain_ids.items()),
+    }
+
+
+def snapshot_header(index, count):
+    header = json.dumps({"version": VERSION, **index, "count": count, "created_at": time.time()}).encode()
+    # records start 8-byte aligned
+    header += b" " * (-(len(MAGIC) + 4 + len(header)) % 8)
+    return MAGIC + len(header).to_bytes(4, 'little') + header
+
+
+def parse_header(data):
+    """
+    :return: (header dict, offset of the first record).
+    """
+    if bytes(data[:len(MAGIC)]) != MAGIC:
+        raise ValueError("Not an LSH snapshot")
+    length = int.from_bytes(bytes(data[len(MAGIC):len(MAGIC) + 4]), 'little')
+    offset = len(MAGIC) + 4
+    header = json.loads(bytes(data[offset:offset + length]))
+    if header["version"] != VERSION:
+        raise ValueError(f"Unsupported LSH snapshot version {header['version']}")
+    return header, offset + length
+
+
+def index_records(lsh_with_ttl):
+    """
+    :return: generator of the records of the index, CHUNK_RECORDS at a time.
+    """
+    dtype = record_dtype(lsh_with_ttl.lsh.h)
+    for key_bytes, expire_times, fingerprints, signatures in lsh_with_ttl.snapshot_chunks(CHUNK_RECORDS):
+        records = np.zeros(len(key_bytes), dtype=dtype)
+        records["key"] = key_bytes
+        records["expire_time"] = expire_times
+        records["fingerprint"] = fingerprints
+        records["signature"] = signatures
+        yield records
+
+
+class SnapshotCopy:
+    """
+    Records of an index copied for a snapshot a chunk at a time on the thread that owns the index, so it keeps
+    serving between chunks, and spooled to a temporary file so the copy does not hold a second index in memory.
+    Keys inserted while the copy is taken may be left out of it or copied twice: the journal entries after
+    the copy started hold them, and loading inserts a key once.
+    """
+
+    def __init__(self, lsh_with_ttl):
+        self.lsh_with_ttl = lsh_with_ttl
+        self.chunks = index_records(lsh_with_ttl)
+        self.index = None
+        self.count = 0
+        self.spool = None
+        # keys without a signature are left out, they are kept by the pickled index they were loaded from
+        self.unsigned_until = lsh_with_ttl.unsigned_expiration()
+
+    def copy_chunk(self):
+        """
+        Copy the next CHUNK_RECORDS records, on the thread that owns the index.
+
+        :return: the records, None once every record is copied.
+        """
+        records = next(self.chunks, None)
+        if records is None:
+            # taken last, so it names the domains of every copied key
+            self.index = index_header(self.lsh_with_ttl)
+            self.lsh_with_ttl = None
+        return records
+
+    def take(self, on_owner=None):
+        """
+        Copy every chunk with on_owner(copy_chunk), or on this thread without it, and spool it.
+        """
+        self.spool = tempfile.TemporaryFile(dir=Consts.LSH_SNAPSHOT_DIR or None)
+        while (records := on_owner(self.copy_chunk) if on_owner else self.copy_chunk()) is not None:
+            self.spool.write(records.tobytes())
+            self.count += len(records)
+        return self
+
+    def spooled_chunks(self):
+        self.spool.seek(0)
+        while data := self.spool.read(Consts.SNAPSHOT_CHUNK_BYTES):
+            yield data
+
+
+def write_snapshot(lsh_with_ttl, write):
+    """
+    Write an index, or a taken SnapshotCopy of it, as a snapshot through write(bytes).
+
+    :return: Number of written keys.
+    """
+    snapshot = lsh_with_ttl if isinstance(lsh_with_ttl, SnapshotCopy) else SnapshotCopy(lsh_with_ttl).take()
+    try:
+        write(snapshot_header(snapshot.index, snapshot.count))
+        for data in snapshot.spooled_chunks():
+            write(data)
+    finally:
+        snapshot.spool.close()
+    return snapshot.count
+
+
+def insert_records(lsh_with_ttl, records):
+    """
+    Insert the unexpired records of a snapshot into the index.
+    """
+    records = records[records["expire_time"] > time.time()]
+    key_bytes = records["key"].tobytes()
+    keys = [int.from_bytes(key_bytes[i:i + KEY_BYTES], 'little') for i in range(0, len(key_bytes), KEY_BYTES)]
+    expire_times = [datetime.fromtimestamp(expire_time) for expire_time in records["expire_time"].tolist()]
+    return lsh_with_ttl.insert_bulk(keys, records["signature"], expire_times, records["fingerprint"])
+
+
+def new_index(header):
+    lsh_with_ttl = new_memory_lsh(threshold=header["threshold"], num_perm=header["num_perm"], ttl=header["ttl"])
+    lsh_with_ttl.key_codec = KeyCodec()
+    for domain, domain_id in header["domains"]:
+        lsh_with_ttl.key_codec.domain_ids[domain] = domain_id
+        lsh_with_ttl.key_codec.domain_names[domain_id] = domain
+    return lsh_with_ttl
+
+
+def save_snapshot_file(lsh_with_ttl, path):
+    """
+    Write the snapshot next to path and move it in place, so a crash never leaves a partial snapshot.
+    """
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb") as f:
+        count = write_snapshot(lsh_with_ttl, f.write)
+    os.replace(temporary_path, path)
+    return count
+
+
+def load_snapshot_file(path):
+    """
+    Map a snapshot file and insert its records a chunk at a time, so only one chunk of records
+    is materialized besides the index.
+
+    :return: the index, None when there is no snapshot.
+    """
+    if not os.path.exists(path):
+        return None
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    header, offset = parse_header(data)
+    records = np.ndarray((header["count"],), dtype=record_dtype(header["num_perm"]), buffer=data, offset=offset)
+    lsh_with_ttl = new_index(header)
+    lsh_with_ttl.reserve(header["count"])
+    for start in range(0, len(records), CHUNK_RECORDS):
+        insert_records(lsh_with_ttl, records[start:start + CHUNK_RECORDS])
+    return lsh_with_ttl
+
+
+class RedisSnapshotWriter:
+    """
+    File-like sink splitting a snapshot into values of at most chunk_bytes under a new generation of keys.
+    The generation only becomes current on commit, and the previous one is deleted then.
+    """
+
+    def __init__(self, redis_connection, name, chunk_bytes=Consts.SNAPSHOT_CHUNK_BYTES):
+        self.redis = redis_connection
+        self.name = name
+        self.chunk_bytes = chunk_bytes
+        self.generation = int(self.redis.incr(f"{name}:generation"))
+        self.buffer = bytearray()
+        self.chunks = 0
+
+    def chunk_key(self, generation, index):
+        return f"{self.name}:{generation}:{index}"
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.chunk_bytes:
+            self._set_chunk(self.buffer[:self.chunk_bytes])
+            del self.buffer[:self.chunk_bytes]
+
+    def _set_chunk(self, data):
+        self.redis.set(self.chunk_key(self.generation, self.chunks), bytes(data))
+        self.chunks += 1
+
+    def commit(self):
+        if self.buffer:
+            self._set_chunk(self.buffer)
+            self.buffer = bytearray()
+        previous = self.redis.get(self.name)
+        self.redis.set(self.name, json.dumps({"generation": self.generation, "chunks": self.chunks}))
+        if previous:
+            previous = json.loads(previous)
+            keys = [self.chunk_key(previous["generation"], index) for index in range(previous["chunks"])]
+            if keys:
+                self.redis.delete(*keys)
+
+
+def save_snapshot_redis(lsh_with_ttl, redis_connection, name):
+    writer = RedisSnapshotWriter(redis_connection, name)
+    count = write_snapshot(lsh_with_ttl, writer.write)
+    writer.commit()
+    return count
+
+
+def load_snapshot_redis(redis_connection, name):
+    """
+    Read a snapshot from Redis a value at a time, inserting the records of each value before reading the next.
+
+    :return: the index, None when there is no snapshot.
+    """
+    current = redis_connection.get(name)
+    if not current:
+        return None
+    current = json.loads(current)
+    lsh_with_ttl, dtype, pending = None, None, bytearray()
+    for index in range(current["chunks"]):
+        data = redis_connection.get(f"{name}:{current['generation']}:{index}")
+        if data is None:
+            raise ValueError(f"Chunk {index} of LSH snapshot {name} is missing")
+        pending += data
+        if lsh_with_ttl is None:
+            header, offset = parse_header(pending)
+            lsh_with_ttl = new_index(header)
+            lsh_with_ttl.reserve(header["count"])
+            dtype = record_dtype(header["num_perm"])
+            del pending[:offset]
+        count = len(pending) // dtype.itemsize
+        insert_records(lsh_with_ttl, np.frombuffer(pending, dtype=dtype, count=count).copy())
+        del pending[:count * dtype.itemsize]
+    return lsh_with_ttl
+
+
+# Save the snapshot of an in-memory index, or of a SnapshotCopy, to LSH_SNAPSHOT_DIR when it is set, to Redis otherwise
+def save_snapshot(lsh_with_ttl, language, redis_connection):
+    start_time = time.time()
+    if Consts.LSH_SNAPSHOT_DIR:
+        count = save_snapshot_file(lsh_with_ttl, os.path.join(Consts.LSH_SNAPSHOT_DIR, f"{language}.lshsnap"))
+    else:
+        count = save_snapshot_redis(lsh_with_ttl, redis_connection, f"{language}:lsh_snapshot")
+    logger.info(f"Saved LSH snapshot of {language} ({count} keys) in {time.time() - start_time:.3f} seconds.")
+
+
+# Load the snapshot of a language from LSH_SNAPSHOT_DIR when it is set, from Redis otherwise
+def load_snapshot(language, redis_connection):
+    start_time = time.time()
+    if Consts.LSH_SNAPSHOT_DIR:
+        lsh_with_ttl = load_snapshot_file(os.path.join(Consts.LSH_SNAPSHOT_DIR, f"{language}.lshsnap"))
+    else:
+        lsh_with_ttl = load_snapshot_redis(redis_connection, f"{language}:lsh_snapshot")
+    if lsh_with_ttl is not None:
+        logger.info(f"Loaded LSH snapshot of {language} ({lsh_with_ttl.size()} keys) "
+                    f"in {time.time() - start_time:.3f} seconds.")
+    return lsh_with_ttl
@@ -0,0 +1,118 @@
+import re
+import string
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from hashlib import blake2b
+from nltk.corpus import stopwords
+from nltk.tokenize import word_tokenize, NLTKWordTokenizer
+from consts import Consts
+
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+SIMPLE_TOKEN = re.compile(r"\w+")
+# Words that NLTK splits even without punctuation, e.g. "cannot" -> "can", "not"
+SPLIT_CONTRACTIONS = frozenset(["cannot", "gimme", "gonna", "gotta", "lemme", "wanna"])
+
+
+def content_fingerprint(text):
+    """
+    64-bit fingerprint of the text as the tokenizers see it: lowercase, without punctuation and with
+    whitespace collapsed. Texts with equal fingerprints get equal tokens, so equal MinHash signatures.
+    """
+    normalized = " ".join(text.lower().translate(PUNCTUATION_TABLE).split())
+    return int.from_bytes(blake2b(normalized.encode(), digest_size=8).digest(), 'little')
+
+
+@lru_cache(maxsize=None)
+def get_stop_words(language):
+    return frozenset(stopwords.words(language))
+
+
+def shingle(tokens, shingle_size):
+    """
+    Join every `shingle_size` consecutive tokens into one token.
+    A document shorter than the shingle size becomes a single shingle.
+    """
+    if len(tokens) <= shingle_size:
+        return [" ".join(tokens)] if tokens else []
+    return [" ".join(tokens[i:i + shingle_size]) for i in range(len(tokens) - shingle_size + 1)]
+
+
+class Tokenizer(ABC):
+    """
+    Base tokenizer holding the precompiled resources of one language.
+    Subclasses only decide how the normalized text is split into words.
+    """
+
+    def __init__(self, language: str, shingle_size: int = 1):
+        """
+        :param language: NLTK stopwords language.
+        :param shingle_size: Number of consecutive words per token, 1 disables shingling.
+        """
+        self.language = language
+        self.shingle_size = shingle_size
+        self.stop_words = get_stop_words(language)
+
+    @abstractmethod
+    def split(self, text: str):
+        """
+        Split the lowercase text, stripped of ASCII punctuation, into words.
+        """
+
+    def tokenize(self, text: str):
+        text = text.lower().translate(PUNCTUATION_TABLE)
+        tokens = [token for token in self.split(text) if token not in self.stop_words]
+        if self.shingle_size > 1:
+            tokens = shingle(tokens, self.shingle_size)
+        return tokens
+
+
+class NLTKTokenizer(Tokenizer):
+    """
+    Reference tokenizer: Punkt sentence splitting followed by the NLTK word tokenizer.
+    """
+
+    def split(self, text: str):
+        return word_tokenize(text)
+
+
+class FastTokenizer(Tokenizer):
+    """
+    Whitespace split with a word-boundary fast path.
+
+    Once ASCII punctuation is stripped, Punkt finds no sentence boundaries and the NLTK word tokenizer leaves
+    plain words untouched, so only the words holding other characters (unicode quotes, dashes...) or one of
+    the split contractions go through the NLTK word tokenizer. The output matches NLTKTokenizer.
+    """
+    word_tokenizer = NLTKWordTokenizer()
+
+    def split(self, text: str):
+        tokens = []
+        for word in text.split():
+            if SIMPLE_TOKEN.fullmatch(word) and word not in SPLIT_CONTRACTIONS:
+                tokens.append(word)
+            else:
+                tokens.extend(self.word_tokenizer.tokenize(word))
+        return tokens
+
+
+TOKENIZERS = {
+    "nltk": NLTKTokenizer,
+    "fast": FastTokenizer,
+}
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer(language, engine=None, shingle_size=None):
+    """
+    Get the tokenizer of a language, built once per (language, engine, shingle_size).
+
+    :param language: NLTK stopwords language.
+    :param engine: Name in TOKENIZERS, defaults to the language's entry in Consts.LANGUAGE_TOKENIZERS
+                   and then to Consts.TOKENIZER_ENGINE.
+    :param shingle_size: Defaults to Consts.SHINGLE_SIZE.
+    """
+    engine = engine or Consts.LANGUAGE_TOKENIZERS.get(language, Consts.TOKENIZER_ENGINE)
+    shingle_size = shingle_size or Consts.SHINGLE_SIZE
+    if engine not in TOKENIZERS:
+        raise ValueError(f"Unknown tokenizer engine: {engine}")
+    return TOKENIZERS[engine](language, shingle_size=shingle_size)
@@ -1,21 +1,35 @@
 import pickle
-import string
-from datetime import datetime, timedelta
+from hashlib import sha256
+from datetime import datetime, timedelta, timezone
 import nltk
 from consts import Consts
 from minhash_lsh_ttl import MinHashLSHTTL
+from partitioned_lsh import new_memory_lsh
+from redis_lsh import RedisMinHashLSHTTL
+from shared_memory_lsh import SharedMemoryLSHTTL
+from result_cache import ResultCache
+from journal import InsertJournal
+from snapshot import SnapshotCopy, save_snapshot, load_snapshot, index_records, insert_records
 from redis import ConnectionPool, Redis
-from datasketch import MinHash
-from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
+from minhash_kernel import signature_matrix, lean_minhashes
+from tokenizer import get_tokenizer, content_fingerprint
+from key_codec import DOMAIN_BITS, DOMAIN_MASK, is_article_id
+from latency import timed, observe
 import logging
 import time
 import os
+import numpy as np
 import metrics3_docker.metrics as metrics
 from elasticsearch import Elasticsearch
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import tldextract
+import queue
+import re
+import itertools
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 redis_pool = ConnectionPool(host=Consts.REDIS_HOST, port=Consts.REDIS_PORT, db=Consts.REDIS_DB)
+result_cache = ResultCache(max_size=Consts.RESULT_CACHE_SIZE, ttl_seconds=Consts.RESULT_CACHE_TTL_SECONDS)
 
 logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s",
                     level=logging.INFO)
@@ -56,21 +70,45 @@ except LookupError:
 
 # Preprocess and tokenize the input text
 def preprocess_and_tokenize(text, language):
-    text = text.lower()
-    text = text.translate(str.maketrans('', '', string.punctuation))
-    tokens = word_tokenize(text)
-    stop_words = set(stopwords.words(language))
-    tokens = [token for token in tokens if token not in stop_words]
-    return tokens
+    with timed("tokenize"):
+        return get_tokenizer(language).tokenize(text)
 
 
 # Generate MinHash signature for a document
 def minhash_signature(document, language, num_perm=128):
-    minhash = MinHash(num_perm=num_perm)
     tokens = preprocess_and_tokenize(document, language)
-    for token in tokens:
-        minhash.update(token.encode('utf-8'))
-    return minhash
+    with timed("minhash"):
+        return lean_minhashes(signature_matrix([tokens], num_perm=num_perm))[0]
+
+
+# Generate MinHash signatures for a batch of (content, language) pairs in one pass
+def minhash_signatures(documents, num_perm=128):
+    token_lists = [preprocess_and_tokenize(content, language) for content, language in documents]
+    with timed("minhash_batch"):
+        return lean_minhashes(signature_matrix(token_lists, num_perm=num_perm))
+
+
+# Content fingerprint of a document for the exact-duplicate fast path, None when the fast path is disabled
+def document_fingerprint(content):
+    if not Consts.EXACT_DUPLICATE_FAST_PATH or content is None:
+        return None
+    with timed("fingerprint"):
+        return content_fingerprint(content)
+
+
+# Signature of an indexed document with the same content, so exact copies skip tokenization and MinHash
+def fingerprint_minhash(lsh_cache, fingerprint):
+    if fingerprint is None:
+        return None
+    hashvalues = lsh_cache.fingerprint_signature(fingerprint)
+    if hashvalues is None:
+        return None
+    metrics.count(Consts.TOTAL_FINGERPRINT_HITS)
+    return lean_minhashes([hashvalues.astype(np.uint64)])[0]
+
+
+# Duration, document count and end time of the last recovery of this process
+last_recovery = {}
 
 
 def get_es_connection():
@@ -82,19 +120,19 @@ def get_es_connection():
         return None
 
 
-def get_query(scroll_id=None, page_size=500, max_hours=Consts.MAX_HOURS_FOR_RECOVERY):
-    today = datetime.now()
+def get_query(scroll_id=None, page_size=500, max_hours=Consts.MAX_HOURS_FOR_RECOVERY, language="english"):
+    today = datetime.now(timezone.utc)
     yesterday = today - timedelta(hours=max_hours)
     today = today.strftime("%Y-%m-%dT%H:%M:%S.000Z")
     yesterday = yesterday.strftime("%Y-%m-%dT%H:%M:%S.000Z")
 
     query = {
-        "_source": ["text", "_id", "thread.site"],
+        "_source": ["text", "url", "thread.site", "language", "sys_info.crawled"],
         "query": {
             "bool": {
                 "must": [
                     {"match": {"thread.site_type": "news"}},
-                    {"match": {"language": "english"}},
+                    {"match": {"language": language}},
                     {"match": {"is_first": True}},
                     {
                         "range": {
@@ -116,119 +154,198 @@ def get_query(scroll_id=None, page_size=500, max_hours=Consts.MAX_HOURS_FOR_RECO
     return query
 
 
-def get_texts_from_es(language="english"):
+def get_tld_from_url(url):
+    ext = tldextract.extract(url)
+    return ext.registered_domain or ext.domain
+
+
+# article_id and domain of a url, as the consumer sends them to /is_duplicate
+def get_article_key(url):
+    return sha256(url.encode()).hexdigest(), get_tld_from_url(url)
+
+
+def get_document_from_hit(hit):
+    source = hit.get("_source", {})
+    text = source.get("text")
+    if not text:
+        return None
+    url = source.get("url")
+    # documents without url cannot match live traffic by key, they keep the Elasticsearch id and site
+    article_id, article_domain = get_article_key(url) if url else (hit.get("_id"),
+                                                                   source.get("thread", {}).get("site"))
+    return {
+        "article_id": article_id,
+        "article_domain": article_domain,
+        "language": source.get("language") or "english",
+        "crawled": crawl_time(source.get("sys_info", {}).get("crawled")),
+        "text": text,
+    }
+
+
+# Timestamp of a sys_info.crawled date, now when it is missing or malformed. Dates without offset are UTC.
+def crawl_time(crawled):
+    if isinstance(crawled, str):
+        # Elasticsearch dates end with Z and have 1 to 9 fraction digits, fromisoformat only accepts them
+        # from Python 3.11, so Z becomes an offset and the fraction 6 digits
+        crawled = re.sub(r"[Zz]$", "+00:00", crawled)
+        crawled = re.sub(r"\.(\d+)", lambda match: "." + match.group(1)[:6].ljust(6, "0"), crawled, count=1)
+    try:
+        crawl_date = datetime.fromisoformat(crawled)
+    except (TypeError, ValueError):
+        return time.time()
+    if crawl_date.tzinfo is None:
+        crawl_date = crawl_date.replace(tzinfo=timezone.utc)
+    return crawl_date.timestamp()
+
+
+def read_slice(es_client, slice_id, slices, batch_queue, batch_size, language="english",
+               max_hours=Consts.MAX_HOURS_FOR_RECOVERY):
     """
-    Retrieve texts from Elasticsearch and insert MinHash signatures into LSH.
+    Read one slice of a sliced scroll over the recovery window of a language and put its documents on
+    batch_queue, one batch per page. A None is put on the queue once the slice is exhausted.
     """
-    documents = []
-    es_client = get_es_connection()
-    if not es_client:
-        logger.error("Failed to connect to Elasticsearch.")
-        return documents
+    query = get_query(page_size=batch_size, max_hours=max_hours, language=language)
+    if slices > 1:
+        query["slice"] = {"id": slice_id, "max": slices}
 
-    # Perform the initial search to get the initial scroll ID
-    initial_query = get_query()
+    scroll_id = None
     try:
-        result = es_client.search(index="webhose*", body=initial_query, scroll="5m")
+        result = es_client.search(index="webhose*", body=query, scroll="5m")
+        while True:
+            scroll_id = result.get("_scroll_id")
+            hits = result["hits"]["hits"]
+            if not hits:
+                break  # No more results, break out of the loop
+            batch = [doc for doc in map(get_document_from_hit, hits) if doc]
+            if batch:
+                batch_queue.put(batch)
+            result = es_client.scroll(scroll_id=scroll_id, scroll="5m")
     except Exception as e:
-        logger.error(f"Error during initial search: {e}")
-        return documents
-
-    scroll_id = result.get("_scroll_id")
-    total_hits = result["hits"]["total"]["value"]
+        logger.error(f"Error while reading slice {slice_id}: {e}")
+    finally:
+        # Clear the scroll to release resources on the server
+        if scroll_id:
+            try:
+                es_client.clear_scroll(scroll_id=scroll_id)
+            except Exception as e:
+                logger.error(f"Error during clearing scroll: {e}")
+        batch_queue.put(None)
 
-    total_pages = total_hits // 500 + 1
 
-    for i in range(total_pages):
-        logger.info(f"Processing page {i + 1} of {total_pages}")
-        hits = result["hits"]["hits"]
+def process_batch(documents):
+    """
+    Hash a batch of recovered documents.
 
-        if not hits:
-            break  # No more results, break out of the loop
+    :return: dict of the (article_id, article_domain) of every document, their uint32 signature matrix,
+             crawl timestamps and content fingerprints (None when the fast path is disabled).
+    """
+    token_lists = [preprocess_and_tokenize(doc['text'], doc['language']) for doc in documents]
+    with timed("minhash_batch"):
+        signatures = signature_matrix(token_lists).astype(np.uint32)
+    fingerprints = [document_fingerprint(doc['text']) for doc in documents]
+    logger.info(f"Processed {len(documents)} documents.")
+    return {
+        "keys": [(doc['article_id'], doc['article_domain']) for doc in documents],
+        "signatures": signatures,
+        "crawled": [doc['crawled'] for doc in documents],
+        "fingerprints": None if None in fingerprints else fingerprints,
+    }
 
-        for hit in hits:
-            text = hit.get("_source", {}).get("text")
-            if not text:
-                continue
-            article_id = hit.get("_id")
-            article_domain = hit.get("_source", {}).get("thread", {}).get("site")
-            documents.append({
-                "article_id": article_id,
-                "article_domain": article_domain,
-                "text": text,
-            })
 
-        try:
-            # Use the scroll ID to retrieve the next batch of results
-            scroll_id = result.get("_scroll_id")
-            result = es_client.scroll(scroll_id=scroll_id, scroll="5m")
-        except Exception as e:
-            logger.error(f"Error during scrolling: {e}")
-            break
+def insert_batch_results(lsh_with_ttl, batch):
+    """
+    Insert a hashed batch with the keys of live traffic, every document expiring TTL hours after its crawl time.
+    Documents that have already expired are skipped.
 
-    # Clear the scroll to release resources on the server
-    try:
-        es_client.clear_scroll(scroll_id=scroll_id)
-    except Exception as e:
-        logger.error(f"Error during clearing scroll: {e}")
+    :return: Number of inserted documents.
+    """
+    ttl_seconds = lsh_with_ttl.ttl * 3600
+    now = time.time()
+    live = [i for i, crawled in enumerate(batch["crawled"]) if crawled + ttl_seconds > now]
+    if not live:
+        return 0
+    keys = [lsh_with_ttl.key_codec.encode(*batch["keys"][i]) for i in live]
+    expire_times = [datetime.fromtimestamp(batch["crawled"][i] + ttl_seconds) for i in live]
+    fingerprints = None if batch["fingerprints"] is None else [batch["fingerprints"][i] for i in live]
+    return lsh_with_ttl.insert_bulk(keys, batch["signatures"][live], expire_times, fingerprints)
+
+
+def process_batches(lsh_with_ttl, es_client, slices=Consts.RECOVERY_SLICES, workers=Consts.RECOVERY_WORKERS,
+                    batch_size=Consts.RECOVERY_BATCH_SIZE, max_in_flight=Consts.RECOVERY_MAX_IN_FLIGHT,
+                    language="english", max_hours=Consts.MAX_HOURS_FOR_RECOVERY):
+    """
+    Stream the recovery window of a language from Elasticsearch into the LSH.
 
-    return documents
+    Every slice of a sliced scroll is read by its own thread, batches are hashed in a process pool while the
+    next pages are fetched, and signatures are inserted as soon as their batch completes. At most
+    max_in_flight batches are queued and max_in_flight are being hashed, which bounds memory.
 
+    :return: Number of inserted documents.
+    """
+    batch_queue = queue.Queue(maxsize=max_in_flight)
+    inserted = 0
+    with ThreadPoolExecutor(max_workers=slices) as readers, ProcessPoolExecutor(max_workers=workers) as executor:
+        for slice_id in range(slices):
+            readers.submit(read_slice, es_client, slice_id, slices, batch_queue, batch_size, language, max_hours)
+
+        running_slices = slices
+        pending = set()
+        while running_slices or pending:
+            # Keep the hashing workers busy without waiting on ES while results are ready to insert
+            while running_slices and len(pending) < max_in_flight:
+                try:
+                    batch = batch_queue.get(timeout=0.1 if pending else None)
+                except queue.Empty:
+                    break
+                if batch is None:
+                    running_slices -= 1
+                    continue
+                pending.add(executor.submit(process_batch, batch))
+
+            if not pending:
+                continue
+            done, pending = wait(pending, timeout=0.1 if running_slices else None, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    inserted += insert_batch_results(lsh_with_ttl, future.result())
+                except Exception as e:
+                    logger.error(f"Error while processing batch: {e}")
 
-def process_batch(documents):
-    results = []
-    for doc in documents:
-        minhash = minhash_signature(doc.get('text'), doc.get('language'))
-        results.append({
-            "article_id": doc.get('article_id'),
-            "article_domain": doc.get('article_domain'),
-            "minhash": minhash
-        })
-    logger.info(f"Processed {len(results)} documents.")
-    return results
+    logger.info(f"Finished processing all batches, inserted {inserted} documents.")
+    return inserted
 
 
-def process_batches(lsh_with_ttl, documents, workers=4, batch_size=1000):
-    with ProcessPoolExecutor(max_workers=workers) as executor:
-        futures = {}
-        for i in range(0, len(documents), batch_size):
-            logger.info(f"Processing batch {i // batch_size + 1}...")
-            batch = documents[i:i + batch_size]
-            future = executor.submit(process_batch, batch)
-            futures[future] = i // batch_size + 1
-
-        results = {}
-        for future in as_completed(futures):
-            batch_number = futures[future]
-            results[batch_number] = future.result()
-
-    logger.info("Finished processing all batches.")
-    logger.info(f"Inserting MinHash signatures into LSH...")
-    # Insert into LSH with batch insertion
-    with lsh_with_ttl.lsh.insertion_session() as session:
-        for batch_number, batch_results in results.items():
-            logger.info(f"Inserting batch {batch_number}...")
-            for doc in batch_results:
-                key = f"{doc.get('article_id')}|{doc.get('article_domain')}"
-                session.insert(key, doc.get('minhash'))
-
-
-def fast_recovery():
+def fast_recovery(lsh_with_ttl=None, es_client=None, language="english", max_hours=Consts.MAX_HOURS_FOR_RECOVERY):
     """
-    Initialize LSH with TTL and load documents from Elasticsearch.
+    Initialize LSH with TTL and load the documents of a language crawled in the last max_hours from Elasticsearch.
     """
     start_time = time.time()
-    logger.info("Starting fast recovery...")
-    lsh_with_ttl = MinHashLSHTTL(threshold=0.9, num_perm=128)
-    documents = get_texts_from_es()
-    process_batches(lsh_with_ttl, documents)
+    logger.info(f"Starting fast recovery of {language}...")
+    if lsh_with_ttl is None:
+        lsh_with_ttl = new_memory_lsh()
+    es_client = es_client or get_es_connection()
+    if not es_client:
+        logger.error("Failed to connect to Elasticsearch.")
+        return lsh_with_ttl
+    documents = process_batches(lsh_with_ttl, es_client, language=language, max_hours=max_hours)
     end_time = time.time()
     logger.info(f"Fast recovery took {end_time - start_time:.4f} seconds.")
+    observe("recovery", (end_time - start_time) * 1000)
+    last_recovery.update(seconds=round(end_time - start_time, 3), documents=documents,
+                         finished_at=datetime.fromtimestamp(end_time).isoformat())
     return lsh_with_ttl
 
 
+# Rebuild an LSH from Elasticsearch over its whole TTL, into a new index unless it is shared by every replica
+def recover_lsh(lsh_with_ttl, language):
+    ttl = lsh_with_ttl.ttl if lsh_with_ttl is not None else 24
+    if lsh_with_ttl is not None and lsh_with_ttl.shared:
+        return fast_recovery(lsh_with_ttl, language=language, max_hours=ttl)
+    return fast_recovery(new_memory_lsh(ttl=ttl), language=language, max_hours=ttl)
+
+
 # Retrieve LSH object from Redis
-def get_lsh_from_redis(lsh_key=None):
+def get_lsh_from_redis(lsh_key=None, recover=True, language="english"):
     lsh_with_ttl = None
     try:
         with Redis(connection_pool=redis_pool) as redis_connection:
@@ -242,23 +359,184 @@ def get_lsh_from_redis(lsh_key=None):
     except TypeError:
         metrics.count(Consts.TOTAL_LSH_OBJECT_CREATED)
         logger.error("LSH object not found in Redis. Creating new LSH.")
-        lsh_with_ttl = fast_recovery()
+        lsh_with_ttl = fast_recovery(language=language) if recover else new_memory_lsh()
     except Exception as e:
         logger.error(f"Error while getting LSH from Redis: {str(e)}")
     finally:
         return lsh_with_ttl
 
 
-# Save LSH objects to Redis
-def save_lsh_to_redis(lsh_cache_dict):
+# Load the binary snapshot of a language, None when there is none or it can not be read
+def get_lsh_from_snapshot(language):
     try:
         with Redis(connection_pool=redis_pool) as redis_connection:
-            for language, lsh_with_ttl in lsh_cache_dict.items():
-                lsh_key = f"{language}:lsh_index"
-                serialized_lsh = pickle.dumps(lsh_with_ttl)
-                redis_connection.set(lsh_key, serialized_lsh)
+            return load_snapshot(language, redis_connection)
+    except Exception as e:
+        logger.error(f"Error while loading the LSH snapshot of {language}: {str(e)}")
+        return None
+
+
+# Get the shared LSH of a language stored in Redis, recovering it from Elasticsearch if it is empty
+def get_shared_lsh(language):
+    lsh_with_ttl = RedisMinHashLSHTTL(threshold=0.9, num_perm=128, basename=f"{language}:lsh".encode(),
+                                      redis_config={"host": Consts.LSH_REDIS_HOST, "port": Consts.LSH_REDIS_PORT,
+                                                    "db": Consts.LSH_REDIS_DB})
+    with Redis(connection_pool=redis_pool) as redis_connection:
+        # only one replica recovers an empty index
+        if language in Consts.RECOVERY_LANGUAGES and lsh_with_ttl.size() == 0 and redis_connection.set(f"{language}:lsh_recovery", 1, nx=True, ex=3600):
+            metrics.count(Consts.TOTAL_LSH_OBJECT_CREATED)
+            fast_recovery(lsh_with_ttl, language=language)
+    return lsh_with_ttl
+
+
+# Get the LSH of a language held in shared memory by the workers of this host, recovering it if it was just created
+def get_shared_memory_lsh(language):
+    lsh_with_ttl = SharedMemoryLSHTTL(path=os.path.join(Consts.SHARED_INDEX_DIR, f"duplicate-service-{language}.lsh"),
+                                      threshold=0.9, num_perm=128)
+    if lsh_with_ttl.created and language in Consts.RECOVERY_LANGUAGES:
+        metrics.count(Consts.TOTAL_LSH_OBJECT_CREATED)
+        fast_recovery(lsh_with_ttl, language=language)
+    return lsh_with_ttl
+
+
+# Get the LSH of a language from the configured storage
+def get_lsh(language):
+    if Consts.LSH_STORAGE == "redis":
+        return get_shared_lsh(language)
+    if Consts.LSH_STORAGE == "shm":
+        return get_shared_memory_lsh(language)
+    lsh_with_ttl = get_lsh_from_snapshot(language)
+    if lsh_with_ttl is None:
+        # indexes saved before the binary snapshots are still pickled
+        lsh_with_ttl = get_lsh_from_redis(lsh_key=f"{language}:lsh_index",
+                                          recover=language in Consts.RECOVERY_LANGUAGES, language=language)
+    else:
+        lsh_with_ttl = with_legacy_keys(lsh_with_ttl, language)
+    if lsh_with_ttl is not None and Consts.LSH_JOURNAL:
+        attach_journal(lsh_with_ttl, language)
+    return lsh_with_ttl
+
+
+# Keys of an index pickled before the binary snapshots have no signature, so snapshots leave them out and the
+# pickle is kept until they expire. While it is, the snapshot is loaded into the pickled index, which holds them.
+def with_legacy_keys(lsh_with_ttl, language):
+    try:
+        with Redis(connection_pool=redis_pool) as redis_connection:
+            serialized_lsh = redis_connection.get(f"{language}:lsh_index")
+        if not serialized_lsh:
+            return lsh_with_ttl
+        legacy = pickle.loads(serialized_lsh)
+    except Exception as e:
+        logger.error(f"Error while getting the pickled LSH of {language} from Redis: {str(e)}")
+        return lsh_with_ttl
+    # the snapshot was saved from the pickled index, its domain ids extend those of the pickle
+    legacy.key_codec = lsh_with_ttl.key_codec
+    for records in index_records(lsh_with_ttl):
+        insert_records(legacy, records)
+    logger.info(f"Loaded the LSH snapshot of {language} into its pickled index, {legacy.size()} keys.")
+    return legacy
+
+
+# Replay the inserts journaled since the last checkpoint into a loaded index and journal its next inserts
+def attach_journal(lsh_with_ttl, language):
+    journal = InsertJournal(redis_pool, language)
+    try:
+        journal.replay(lsh_with_ttl)
+    except Exception as e:
+        metrics.count(Consts.TOTAL_JOURNAL_ERRORS)
+        logger.error(f"Failed to replay the LSH journal of {language}: {str(e)}")
+    lsh_with_ttl.journal = journal
+
+
+# Swap a recovered index in for the current one, carrying over the inserts it missed from the journal
+def replace_lsh(lsh_cache_dict, language, recovered):
+    current = lsh_cache_dict.get(language)
+    if recovered is not current and current is not None and current.journal:
+        current.journal.flush()
+        attach_journal(recovered, language)
+    lsh_cache_dict.put(language, recovered)
+
+
+# Append the buffered journal entries of every resident index
+def flush_journals(lsh_cache_dict):
+    for language, lsh_with_ttl in lsh_cache_dict.items():
+        if lsh_with_ttl and lsh_with_ttl.journal:
+            lsh_with_ttl.journal.flush()
+
+
+# Drop the expired keys of every resident index, shared indexes also expire a bounded number of them while serving
+def expire_indexes(lsh_cache_dict):
+    for language, lsh_with_ttl in lsh_cache_dict.items():
+        if lsh_with_ttl:
+            with timed("cleanup_expired_keys"):
+                lsh_with_ttl.cleanup_expired_keys()
+
+
+checkpoint_sequence = itertools.count()
+checkpoint_lock = threading.Lock()
+# Sequence of the last saved copy of every language, so an older copy never overwrites a newer snapshot
+saved_sequences = {}
+
+
+# Start the copies of the resident in-memory indexes for a checkpoint, on the thread that writes them
+def checkpoint_copies(lsh_cache_dict):
+    """
+    :return: list of (language, index, SnapshotCopy, sequence of the copy, future of the last journal entry id
+             in the copy).
+    """
+    copies = []
+    for language, lsh_with_ttl in lsh_cache_dict.items():
+        if not lsh_with_ttl or lsh_with_ttl.shared:
+            # shared indexes are already stored in Redis
+            continue
+        copies.append((language, lsh_with_ttl, SnapshotCopy(lsh_with_ttl), next(checkpoint_sequence),
+                       lsh_with_ttl.journal.flush() if lsh_with_ttl.journal else None))
+    return copies
+
+
+# Save checkpoint copies as snapshots and trim their journals, off the thread that writes the indexes,
+# and return whether all of them were saved. on_writer(func) runs func on that thread, the copies are taken
+# there a chunk at a time.
+def save_checkpoints(copies, on_writer=None):
+    try:
+        with checkpoint_lock, Redis(connection_pool=redis_pool) as redis_connection:
+            for language, lsh_with_ttl, snapshot, sequence, flushed in copies:
+                if saved_sequences.get(language, -1) > sequence:
+                    continue
+                save_snapshot(snapshot.take(on_writer), language, redis_connection)
+                saved_sequences[language] = sequence
+                if snapshot.unsigned_until is None:
+                    # the pickled index of older versions would be loaded if the snapshot went missing
+                    redis_connection.delete(f"{language}:lsh_index")
+                else:
+                    # it holds the keys left out of the snapshot, until the last of them expires
+                    redis_connection.expireat(f"{language}:lsh_index", int(snapshot.unsigned_until) + 1)
+                # the snapshot holds every insert journaled before the copy
+                if flushed:
+                    lsh_with_ttl.journal.checkpointed(redis_connection, flushed.result())
+        return True
     except Exception as e:
         logger.critical(f"Failed to save LSH to Redis: {str(e)}")
+        return False
+
+
+# Save LSH objects to Redis, checkpointing their journals, and return whether all of them were saved
+def save_lsh_to_redis(lsh_cache_dict):
+    return save_checkpoints(checkpoint_copies(lsh_cache_dict))
+
+
+# Copy the indexes to spill for a checkpoint, on the thread that writes them, returning the time of the copy too
+def spill_copies(lsh_cache_dict):
+    saved_at = time.time()
+    return saved_at, checkpoint_copies({language: lsh_cache_dict[language]
+                                        for language in lsh_cache_dict.spill_candidates()})
+
+
+# Drop the spilled indexes once their copies are saved, appending the inserts made since the copy to their journals
+def evict_spilled(lsh_cache_dict, copies, saved_at):
+    for language, lsh_with_ttl, *_ in copies:
+        if lsh_cache_dict.evict(language, lsh_with_ttl, saved_at) and lsh_with_ttl.journal:
+            lsh_with_ttl.journal.flush()
 
 
 # Update Redis with candidates for duplicate detection
@@ -281,21 +559,187 @@ def get_status_from_candidates(article_domain, candidate_pairs, article_id):
     return status
 
 
+# Determine status from the encoded keys of the candidates, comparing document and domain ids
+def get_status_from_keys(key_codec, key, candidate_keys):
+    document = key >> DOMAIN_BITS
+    candidate_keys = [candidate for candidate in map(key_codec.decode, candidate_keys)
+                      if candidate >> DOMAIN_BITS != document]
+    if candidate_keys:
+        domain_id = key & DOMAIN_MASK
+        status = Consts.DUPLICATE if any(
+            candidate & DOMAIN_MASK == domain_id for candidate in candidate_keys) else Consts.SIMILARITY
+    else:
+        status = Consts.UNIQUE
+    return status
+
+
+# Insert a signature into the LSH and determine the document status from its verified candidates
+def check_signature(lsh_cache, minhash, article_domain, article_id, insert=True, fingerprint=None):
+    """
+    :param insert: False to only query the LSH, leaving the document out of the index.
+    :param fingerprint: document_fingerprint of the content, stored with the signature for later exact copies.
+    :return: dict with the status, the best estimated Jaccard similarity of the candidates (None when there
+             are none) and the matching keys as "article_id|domain", best first.
+             The status is duplicate_keys when the document is already indexed. Documents whose article_id
+             is not a lowercase sha256 hex digest get a None status and an error, their matches could not
+             be mapped back to them.
+    """
+    if not is_article_id(article_id):
+        return {"status": None, "error": Consts.INVALID_ARTICLE_ID}
+    key_codec = lsh_cache.key_codec
+    key = key_codec.encode(article_id, article_domain)
+    scored_candidates = lsh_cache.check_and_insert(key, minhash, insert, fingerprint)
+    if scored_candidates is None:
+        return {"status": Consts.DUPLICATE_KEYS}
+    with timed("status"):
+        candidates = [(key_codec.decode(candidate), score) for candidate, score in scored_candidates]
+        candidates = [(candidate, score) for candidate, score in candidates
+                      if candidate >> DOMAIN_BITS != key >> DOMAIN_BITS]
+        candidates.sort(key=lambda candidate: -1 if candidate[1] is None else candidate[1], reverse=True)
+        scores = [score for _, score in candidates if score is not None]
+        result = {
+            "status": get_status_from_keys(key_codec, key, [candidate for candidate, _ in candidates]),
+            "score": round(max(scores), 4) if scores else None,
+            "matches": [key_codec.format_key(candidate) for candidate, _ in candidates],
+        }
+    if insert:
+        result_cache.put(article_id, result)
+    return result
+
+
 # Run LSH check to determine document status
 def run_lsh_check(**kwargs):
-    content = kwargs.get('content')
-    language = kwargs.get('language')
-    article_domain = kwargs.get('article_domain')
-    article_id = kwargs.get('article_id')
     lsh_cache = kwargs.get('lsh_cache')
-
     if not lsh_cache:
         return None
+    document = {'content': kwargs.get('content'), 'language': kwargs.get('language'),
+                'domain': kwargs.get('article_domain'), 'article_id': kwargs.get('article_id')}
+    return run_lsh_check_batch([document], {document['language']: lsh_cache})[0]
 
-    minhash = minhash_signature(content, language)
-    lsh_cache.insert(f"{article_id}|{article_domain}", minhash)
-    candidate_pairs = lsh_cache.query(minhash)
-    return get_status_from_candidates(article_domain, candidate_pairs, article_id)
+
+# Run LSH check for one document, returning the same status as the /is_duplicate endpoint
+def run_lsh_check_document(document, lsh_cache_dict):
+    return run_lsh_check_batch([document], lsh_cache_dict)[0]
+
+
+# Compute signatures for the documents of a batch whose language is in languages
+def minhash_signatures_for_batch(documents, languages):
+    indexed = [i for i, doc in enumerate(documents) if doc.get('language') in languages]
+    minhashes = [None] * len(documents)
+    signatures = minhash_signatures([(documents[i].get('content'), documents[i].get('language')) for i in indexed])
+    for i, minhash in zip(indexed, signatures):
+        minhashes[i] = minhash
+    return minhashes
+
+
+# Content fingerprints of the documents of a batch, None for all of them when the fast path is disabled
+def document_fingerprints(documents):
+    return [document_fingerprint(doc.get('content')) for doc in documents]
+
+
+# Cached results of the retried documents of a batch, None for the documents still to check
+def cached_results(documents):
+    return [result_cache.get(doc.get('article_id')) for doc in documents]
+
+
+# Signatures of the documents of a batch with an exact copy already indexed, None for the others
+def fingerprint_minhashes(documents, fingerprints, lsh_cache_dict):
+    minhashes = []
+    for doc, fingerprint in zip(documents, fingerprints):
+        lsh_cache = lsh_cache_dict.get(doc.get('language')) if fingerprint is not None else None
+        minhashes.append(fingerprint_minhash(lsh_cache, fingerprint) if lsh_cache else None)
+    return minhashes
+
+
+# Check precomputed signatures in document order, returning one check_signature result per document.
+# The result cache is read per document, so a document repeated in the batch gets the result of its first copy.
+def check_signatures_batch(documents, minhashes, lsh_cache_dict, fingerprints=None):
+    results = []
+    for doc, minhash, fingerprint in zip(documents, minhashes, fingerprints or [None] * len(documents)):
+        cached_result = result_cache.get(doc.get('article_id'))
+        if cached_result is not None:
+            results.append(cached_result)
+            continue
+        lsh_cache = lsh_cache_dict.get(doc.get('language'))
+        if not lsh_cache or minhash is None:
+            results.append({"status": None})
+            continue
+        try:
+            results.append(check_signature(lsh_cache, minhash, doc.get('domain'), doc.get('article_id'),
+                                           doc.get('insert', True), fingerprint))
+        except ValueError:
+            results.append({"status": Consts.DUPLICATE_KEYS})
+    return results
+
+
+# Stages of check_documents, run by the hashing workers or by the thread that owns the indexes
+HASHING_STAGE = "hashing"
+INDEX_STAGE = "index"
+
+
+# Calls of func sharing the documents of a stage between workers, func taking its documents first
+def split_calls(func, documents, workers, *args):
+    chunk_size = max(1, -(-len(documents) // workers))
+    return [(func, (documents[i:i + chunk_size], *args)) for i in range(0, len(documents), chunk_size)]
+
+
+def check_documents(documents, lsh_cache_dict, workers=1):
+    """
+    Check and insert a batch of documents, the single implementation behind /is_duplicate, /is_duplicate_batch
+    and the consumer.
+
+    The check is a generator of stages: it yields (stage, calls), a list of (func, args), and is sent back the
+    list of their results. Calls of HASHING_STAGE are independent and can run on any hashing worker, calls of
+    INDEX_STAGE read or write the indexes and must run on the thread that owns them. Documents are fingerprinted,
+    exact copies of indexed documents get the signature of their copy, the others are tokenized and hashed,
+    then every document is inserted and queried in order, so duplicates within the batch get the same results
+    as sequential requests. Retried documents are answered from the result cache.
+
+    :param documents: list of dicts with 'content', 'language', 'domain', 'article_id' and optionally 'insert'.
+    :param lsh_cache_dict: mapping of language to MinHashLSHTTL.
+    :param workers: number of calls the hashing stages are split into.
+    :return: list of check_signature results, {"status": None} for documents whose language has no LSH cache.
+    """
+    results = cached_results(documents)
+    pending = [i for i, result in enumerate(results) if result is None]
+    documents = [documents[i] for i in pending]
+    languages = {doc.get('language') for doc in documents if lsh_cache_dict.get(doc.get('language'))}
+    fingerprints = [None] * len(documents)
+    minhashes = [None] * len(documents)
+    if Consts.EXACT_DUPLICATE_FAST_PATH and documents:
+        chunks = yield HASHING_STAGE, split_calls(document_fingerprints, documents, workers)
+        fingerprints = [fingerprint for chunk in chunks for fingerprint in chunk]
+        (minhashes,) = yield INDEX_STAGE, [(fingerprint_minhashes, (documents, fingerprints, lsh_cache_dict))]
+    missing = [i for i, minhash in enumerate(minhashes) if minhash is None]
+    chunks = yield HASHING_STAGE, split_calls(minhash_signatures_for_batch, [documents[i] for i in missing], workers,
+                                              languages)
+    for i, minhash in zip(missing, [minhash for chunk in chunks for minhash in chunk]):
+        minhashes[i] = minhash
+    (checked,) = yield INDEX_STAGE, [(check_signatures_batch, (documents, minhashes, lsh_cache_dict, fingerprints))]
+    for i, result in zip(pending, checked):
+        results[i] = result
+    return results
+
+
+# Run the stages of check_documents in the calling thread, returning its results
+def run_stages(stages):
+    results = None
+    while True:
+        try:
+            _, calls = stages.send(results)
+        except StopIteration as stop:
+            return stop.value
+        results = [func(*args) for func, args in calls]
+
+
+# Run LSH check for a batch of documents, returning one status per document in request order
+def run_lsh_check_batch(documents, lsh_cache_dict):
+    """
+    :param documents: list of dicts with 'content', 'language', 'domain' and 'article_id'.
+    :param lsh_cache_dict: mapping of language to MinHashLSHTTL.
+    :return: list of statuses, None for documents whose language has no LSH cache.
+    """
+    return [result["status"] for result in run_stages(check_documents(documents, lsh_cache_dict))]
 
 
 # Store article in Redis queue
@@ -305,3 +749,17 @@ def store_article_in_redis(url, queue_name="similarity"):
             redis_connection.sadd(queue_name, url)
     except Exception as e:
         logger.critical(f"Failed to store article in Redis: {str(e)}")
+
+
+# Store articles in their Redis queues with one pipeline, urls_by_queue maps queue name to urls
+def store_articles_in_redis(urls_by_queue):
+    if not urls_by_queue:
+        return
+    try:
+        with Redis(connection_pool=redis_pool) as redis_connection:
+            pipe = redis_connection.pipeline(transaction=False)
+            for queue_name, urls in urls_by_queue.items():
+                pipe.sadd(queue_name, *urls)
+            pipe.execute()
+    except Exception as e:
+        logger.critical(f"Failed to store articles in Redis: {str(e)}")